@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Compare the available codecs (see :mod:`commons.serialization`) for each message type: size of
+the encoded message and time needed to encode and decode it (decoding includes parsing the
+message object). Run it from the src/rhoa_sim directory::
+
+    python -m benchmarks.codec_benchmark
+
+"""
+from __future__ import print_function
+import timeit
+
+from commons.messages import Message
+from commons.serialization import CODECS
+from commons.utils import MessageIDGenerator, get_final_classes
+
+# Values used to fill the fields of the messages
+SAMPLE_VALUES = {
+    "id": MessageIDGenerator.get_new_message_id(),
+    "receiver": ("localhost", 25565),
+    "sender": ("127.0.0.1", 53412),
+    "reply_method": "immediate",
+    "reply_to": ("localhost", 25574),
+    "service": "SetRobotPosition",
+    "args": [],
+    "kwargs": {"name": "rHoA", "x": 1.2345678, "y": -3.4567891, "z": 0.0},
+    "action_id": 42,
+    "target": "Intersection_12",
+    "target_code": 7,
+    "source": "Intersection_3",
+    "destination": "Drugstore_1",
+    "is_subscribing": True,
+    "target_codes": [1, 2, 3, 5, 8],
+    "step": 0.5,
+    "linked_to": MessageIDGenerator.get_new_message_id(),
+    "data": [{"a": {"name": "Intersection_1", "x": 1.0, "y": 2.0, "radius": 0.5}}],
+    "chunk": 0,
+    "last": True,
+}
+
+# A big reply, like the result of a GetMapGraph
+MAP_GRAPH_REPLY = dict(SAMPLE_VALUES, data=[
+    {
+        "a": {"name": "Intersection_{}".format(i), "x": i * 1.5, "y": i * 0.5, "radius": 0.5},
+        "b": {"name": "Section_{}".format(i), "x": i * 1.5 + 0.75, "y": i * 0.5, "radius": 0.25}
+    } for i in range(1000)
+])
+
+
+def sample_messages():
+    """
+    Create one message dictionary per final message class, plus a big InformationMessage.
+
+    :return: a list of tuple (name, message dictionary)
+    """
+    samples = []
+    for message_class in sorted(get_final_classes(Message), key=lambda c: c.__name__):
+        params = message_class.get_required_params()
+        samples.append((
+            message_class.__name__,
+            {key: value for key, value in SAMPLE_VALUES.items() if key in params}
+        ))
+    samples.append((
+        "InformationMessage (map graph)",
+        {key: MAP_GRAPH_REPLY[key] for key in ("id", "receiver", "sender", "linked_to", "data")}
+    ))
+    return samples
+
+
+def measure(codec, message, number):
+    """
+    Measure a codec on a message.
+
+    :param message: a Message object
+    :return: a tuple (encoded size in bytes, encoding time in µs, decoding time in µs)
+    """
+    sender = message.sender
+    data = codec.encode_message(message, sender)
+    encode_time = timeit.timeit(lambda: codec.encode_message(message, sender), number=number)
+    decode_time = timeit.timeit(
+        lambda: Message.parse_from_dict(codec.decode(data)),
+        number=number
+    )
+    return len(data), encode_time / number * 10 ** 6, decode_time / number * 10 ** 6
+
+
+def main(number=2000):
+    codecs = sorted(CODECS.values(), key=lambda c: c.NAME)
+    print("{:<40} {:<8} {:>10} {:>12} {:>12}".format(
+        "Message", "Codec", "Bytes", "Encode (us)", "Decode (us)"
+    ))
+    for name, message in sample_messages():
+        n = number if len(message.get("data", "")) < 100 else max(1, number // 100)
+        for codec in codecs:
+            size, encode_time, decode_time = measure(codec, Message.parse_from_dict(message), n)
+            print("{:<40} {:<8} {:>10} {:>12.2f} {:>12.2f}".format(
+                name, codec.NAME, size, encode_time, decode_time
+            ))
+
+
+if __name__ == "__main__":
+    main()
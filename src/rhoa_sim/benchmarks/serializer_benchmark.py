@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Compare the ways of encoding the result of a DBService (see :class:`commons.utils.ResultSerializer`)
+on a big GetMapGraph result: size of the encoded data and time needed to encode it. Run it from
+the src/rhoa_sim directory::
+
+    python -m benchmarks.serializer_benchmark
+
+"""
+from __future__ import print_function
+import json
+import timeit
+
+from neo4j.v1 import Record, Node
+
+from commons.serialization import CODECS
+from commons.utils import CustomJSONEncoder, ResultSerializer
+
+
+def map_graph_result(size=1000):
+    """
+    Create records like the ones returned by GetMapGraph (`match (a)-[:LINK]-(b) return a, b`).
+
+    :param size: the number of records
+    :return: a list of Records
+    """
+    records = []
+    for i in range(size):
+        a = Node.hydrate(2 * i, {"Intersection"}, {
+            "name": "Intersection_{}".format(i), "x": i * 1.5, "y": i * 0.5, "radius": 0.5
+        })
+        b = Node.hydrate(2 * i + 1, {"Section"}, {
+            "name": "Section_{}".format(i), "x": i * 1.5 + 0.75, "y": i * 0.5, "radius": 0.25
+        })
+        records.append(Record(["a", "b"], [a, b]))
+    return records
+
+
+def methods():
+    """
+    The compared encodings, for each available codec.
+
+    :return: a list of tuple (name, function encoding a result)
+    """
+    result = [
+        ("json, encoder hook", lambda records: json.dumps(records, cls=CustomJSONEncoder)),
+        ("json, to_plain", lambda records: json.dumps(ResultSerializer.to_plain(records))),
+        ("json, to_columns", lambda records: json.dumps(ResultSerializer.to_columns(records))),
+    ]
+    if "msgpack" in CODECS:
+        codec = CODECS["msgpack"]
+        result.extend([
+            ("msgpack, encoder hook", lambda records: codec.encode(records)),
+            ("msgpack, to_plain", lambda records: codec.encode(ResultSerializer.to_plain(records))),
+            ("msgpack, to_columns",
+             lambda records: codec.encode(ResultSerializer.to_columns(records))),
+        ])
+    return result
+
+
+def main(number=50, size=1000):
+    records = map_graph_result(size)
+    print("{} records".format(size))
+    print("{:<24} {:>10} {:>12}".format("Method", "Bytes", "Encode (ms)"))
+    for name, encode in methods():
+        data = encode(records)
+        encode_time = timeit.timeit(lambda: encode(records), number=number)
+        print("{:<24} {:>10} {:>12.2f}".format(name, len(data), encode_time / number * 10 ** 3))
+
+
+if __name__ == "__main__":
+    main()
@@ -23,7 +23,19 @@ class EHoAProcessWithClient(EHoAProcess):
         """
         We setup our client here
         """
-        self.client = ClientProcess(self.handlers_store, logger=self._logger)
+        client_conf = self.conf.get("client", {})
+        self.client = ClientProcess(
+            self.handlers_store,
+            logger=self._logger,
+            connections_per_receiver=client_conf.get("connections_per_receiver", 1),
+            codec=client_conf.get("codec", "json")
+        )
+
+    def _after_exit(self):
+        """
+        Close the connections opened by our client
+        """
+        self.client.close()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,521 @@
+# -*- coding: utf-8 -*-
+"""
+asyncio variants of the process API (Python 3 only). They speak the same protocol as
+:class:`commons.process.ServerProcess` and :class:`commons.process.ClientProcess` (framed
+messages, codec negotiation), so both kinds of processes can talk to each other.
+
+Every connection is served by a coroutine running on a single event loop: a process can hold
+thousands of connections without a thread for each of them. Class-level handlers (see
+:meth:`Message.set_handler`) may be coroutine functions, which are awaited on the event loop, or
+regular functions, which are executed in a thread pool.::
+
+    async def main():
+        server = AsyncServerProcess("path/to/conf")
+        await server.start()
+
+        client = AsyncClientProcess()
+        reply = await client.send_order(msg)
+
+        await client.close()
+        await server.stop()
+"""
+import asyncio
+import concurrent.futures
+import functools
+import socket
+import traceback
+
+from commons.messages import InformationMessage
+from commons.network import Connection, ConnectionClosed, Receiver, Sender
+from commons.serialization import DEFAULT_CODEC, get_codec
+from commons.utils import ConfigurationLoader, LoggerConfigurator, MessageIDGenerator, HandlerStore
+
+
+async def read_frame(reader):
+    """
+    Read the data of the next message on a stream. The expected format is :
+        | datalen |    data    |
+
+    *datalen* occupying 4 octets and *data* datalen octets.
+
+    :param reader: a :class:`asyncio.StreamReader`
+    :return: the data (bytes)
+    :raise: ConnectionClosed if the peer has closed the connection
+    """
+    try:
+        header = await reader.readexactly(Receiver.HEADER.size)
+    except asyncio.IncompleteReadError as e:
+        if not e.partial:
+            raise ConnectionClosed()
+        raise ConnectionClosed("Connection closed in the middle of a message")
+
+    msg_len, = Receiver.HEADER.unpack(header)
+    try:
+        return await reader.readexactly(msg_len)
+    except asyncio.IncompleteReadError:
+        raise ConnectionClosed("Connection closed in the middle of a message")
+
+
+class StreamConnection(Connection):
+    """
+    A :class:`Connection` over asyncio streams. Like a Connection, it can be given to a
+    :class:`Sender` or to handlers written for the threaded processes: :meth:`sendall` can be
+    called from the event loop or from any other thread.
+    """
+
+    def __init__(self, reader, writer, logger=None):
+        """
+        Wrap the provided streams. Must be called from the event loop.
+
+        :param reader: a :class:`asyncio.StreamReader`
+        :param writer: a :class:`asyncio.StreamWriter`
+        """
+        super(StreamConnection, self).__init__(None, logger)
+        self.reader = reader
+        self.writer = writer
+        self._logger = logger
+        self._loop = asyncio.get_running_loop()
+        self._peername = writer.get_extra_info("peername")[:2]
+        self._sockname = writer.get_extra_info("sockname")[:2]
+
+        sock = writer.get_extra_info("socket")
+        if sock is not None:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def getpeername(self):
+        return self._peername
+
+    def getsockname(self):
+        return self._sockname
+
+    def sendall(self, data):
+        """
+        Write data on the stream. The data is buffered, use :meth:`drain` from the event loop
+        to wait until it is sent.
+        """
+        if self._in_loop():
+            self.writer.write(data)
+        else:
+            self._loop.call_soon_threadsafe(self.writer.write, data)
+
+    async def drain(self):
+        """
+        Wait until the buffered data is sent (see :meth:`asyncio.StreamWriter.drain`).
+        """
+        await self.writer.drain()
+
+    def close(self):
+        if self._in_loop():
+            self.writer.close()
+        else:
+            self._loop.call_soon_threadsafe(self.writer.close)
+
+    def _in_loop(self):
+        try:
+            return asyncio.get_running_loop() is self._loop
+        except RuntimeError:
+            return False  # Called from another thread
+
+    def __repr__(self):
+        return "StreamConnection({})".format(self._peername)
+
+
+class AsyncServerProcess(object):
+    """
+    The asyncio variant of :class:`commons.process.ServerProcess`. It is configured the same
+    way, and can be extended by overriding the same methods (:meth:`_custom_init`,
+    :meth:`_set_handlers`, :meth:`_before_run` and :meth:`_after_exit`).
+
+    Each received message is handled in its own task, so that a slow handler doesn't delay the
+    next messages of its connection. Regular (non coroutine) handlers are executed by a thread
+    pool, whose size is read from the "max_workers" key of the "server" section (default is
+    `DEFAULT_MAX_WORKER_NUMBER`).
+
+    Start the server with :meth:`start` and stop it with :meth:`stop` (both are coroutines):
+    stopping is immediate, handlers still running on the event loop are cancelled.
+    """
+
+    DEFAULT_MAX_WORKER_NUMBER = 12
+
+    def __init__(self, conf="conf.json"):
+        """
+        Create a new AsyncServerProcess with the provided configuration.
+
+        :param conf: path to a configuration file
+        """
+        # Setup configuration
+        self.conf = ConfigurationLoader.get_instance()
+        self.conf.file = conf
+
+        self.handlers_store = HandlerStore()
+        self._logger = LoggerConfigurator.get_logger("AsyncServerProcess", self.conf["logger"])
+        self._server = None
+        self._connections = set()
+        self._readers = set()  # A task reading each connection
+        self._tasks = set()  # Tasks handling messages
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+            self.conf["server"].get("max_workers", self.DEFAULT_MAX_WORKER_NUMBER)
+        )
+
+        # Customize stuff, according to what type of process it is
+        self._custom_init()
+
+        # Configure handlers
+        self._set_handlers()
+
+    async def start(self):
+        """
+        Start listening. Must be called from the event loop that will serve connections.
+        """
+        self._before_run()
+        self._server = await asyncio.start_server(
+            self._serve_connection,
+            self.conf["server"]["address"] or None,
+            self.conf["server"]["port"]
+        )
+        self._logger.info("Server: starting now ...")
+
+    async def stop(self):
+        """
+        Stop the server: connections are closed and running handlers are cancelled.
+        """
+        self._logger.info("Server: shutting down now ...")
+        if self._server is not None:
+            self._server.close()
+
+        for connection in list(self._connections):
+            connection.close()
+        tasks = list(self._readers) + list(self._tasks)
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+        if self._server is not None:
+            await self._server.wait_closed()
+            self._server = None
+        self._executor.shutdown(wait=False)
+
+        # Execute process-specific stuff
+        self._after_exit()
+
+    def stats(self):
+        """
+        Get statistics about the server.
+
+        :return: a dictionary with the number of open connections and of messages being handled
+        """
+        return {"connections": len(self._connections), "handling": len(self._tasks)}
+
+    async def _serve_connection(self, reader, writer):
+        """
+        Read a connection until the peer closes it, and handle each message in a new task.
+        """
+        connection = StreamConnection(reader, writer, self._logger)
+        self._connections.add(connection)
+        reader_task = asyncio.current_task()
+        self._readers.add(reader_task)
+        try:
+            while True:
+                data = await read_frame(reader)
+                handling = asyncio.ensure_future(self._handle(connection, data))
+                self._tasks.add(handling)
+                handling.add_done_callback(self._tasks.discard)
+        except (ConnectionClosed, ConnectionError, asyncio.CancelledError):
+            pass
+        finally:
+            self._readers.discard(reader_task)
+            self._connections.discard(connection)
+            writer.close()
+
+    async def _handle(self, connection, data):
+        """
+        Parse a message and run its handlers. If a handler fails, the other process is informed
+        that its request failed.
+        """
+        message = None
+        try:
+            message = connection.receiver.parse(data)
+            self._logger.debug("AsyncServerProcess : {}".format(message))
+
+            # Handle the message (class-level handler)
+            await self._call(message.get_handler(), message.handle, message=message,
+                             request=connection)
+
+            # Handle the message (id specific)
+            if isinstance(message, InformationMessage):
+                for handler in self.handlers_store.get_handlers_for(message.linked_to):
+                    await self._call(handler, handler, message)
+
+            await connection.drain()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            self._logger.warn("AsyncServerProcess : {}".format(e))
+            if message is None:
+                connection.close()
+                return
+            self._logger.debug(traceback.format_exc())
+            Sender(connection, self._logger).send({
+                "id": MessageIDGenerator.get_new_message_id(),
+                "receiver": connection.getpeername(),
+                "linked_to": message.id,
+                "data": str(e)
+            })
+
+    async def _call(self, handler, function, *args, **kwargs):
+        """
+        Call a function on the event loop if the handler is a coroutine function, or in the
+        thread pool otherwise.
+
+        :param handler: the handler, None if there is nothing to call
+        :param function: the function actually called (it calls the handler)
+        """
+        if handler is None:
+            return
+        if asyncio.iscoroutinefunction(handler):
+            await function(*args, **kwargs)
+        else:
+            await asyncio.get_running_loop().run_in_executor(
+                self._executor,
+                functools.partial(function, *args, **kwargs)
+            )
+
+    def _set_handlers(self):
+        """
+        This method is used to register your class-level handlers. It is executed in the
+        constructor (last instruction).
+        """
+        pass
+
+    def _custom_init(self):
+        """
+        Use this method if you want to use custom attributes. It is executed in the constructor,
+        before handlers being set.
+        """
+        pass
+
+    def _after_exit(self):
+        """
+        This method is called when the server stops.
+        """
+        pass
+
+    def _before_run(self):
+        """
+        This method is called when the server starts.
+        """
+        pass
+
+
+class AsyncClientConnection(StreamConnection):
+    """
+    A long-lived connection to a receiver, used by an :class:`AsyncClientProcess`. Like a
+    :class:`commons.network.PooledConnection`, many messages can be in flight at the same time
+    and messages are sent in JSON until the receiver agrees to use the preferred codec.
+    """
+
+    def __init__(self, reader, writer, logger=None, codec=DEFAULT_CODEC):
+        """
+        Wrap the provided streams, and start reading replies. Use :meth:`open` instead.
+
+        :param codec: the preferred codec
+        """
+        super(AsyncClientConnection, self).__init__(reader, writer, logger)
+        self._codec = DEFAULT_CODEC
+        self._preferred_codec = codec
+        self._negotiated = codec is DEFAULT_CODEC
+        self._pending = {}
+        self._alive = True
+        self._reader_task = asyncio.ensure_future(self._read_replies())
+
+    @classmethod
+    async def open(cls, address, logger=None, codec=DEFAULT_CODEC):
+        """
+        Open a new connection to the provided address.
+
+        :param address: a tuple (hostname, port)
+        :return: an AsyncClientConnection
+        """
+        reader, writer = await asyncio.open_connection(*address)
+        return cls(reader, writer, logger, codec)
+
+    @property
+    def alive(self):
+        return self._alive
+
+    async def send(self, message, wait_reply=False):
+        """
+        Send the message.
+
+        :param message: a Message object
+        :param wait_reply: if True, a reply linked to this message is expected
+        :return: a future, resolved with the reply, if `wait_reply` is True, None otherwise
+        """
+        pending = None
+        if wait_reply:
+            pending = asyncio.get_running_loop().create_future()
+            self._pending[MessageIDGenerator.get_key(message.id)] = pending
+
+        Sender(self, self._logger, self._codec).send(
+            message,
+            None if self._negotiated else [self._preferred_codec.NAME]
+        )
+        await self.drain()
+        return pending
+
+    def discard(self, message_id):
+        """
+        Stop waiting for the reply to the provided message id (after a timeout for example).
+
+        :param message_id: the id of the sent message
+        """
+        self._pending.pop(MessageIDGenerator.get_key(message_id), None)
+
+    def close(self, error=None):
+        """
+        Close the connection. Requests still waiting for a reply will fail.
+
+        :param error: the error given to waiting requests
+        """
+        if not self._alive:
+            return
+        self._alive = False
+        pending, self._pending = list(self._pending.values()), {}
+        for reply in pending:
+            if not reply.done():
+                reply.set_exception(error if error is not None else ConnectionClosed())
+        self._reader_task.cancel()
+        self.writer.close()
+
+    async def _read_replies(self):
+        """
+        Receive replies until the connection is closed. Replies that no one is waiting for are
+        dropped.
+        """
+        error = None
+        try:
+            while True:
+                reply = self.receiver.parse(await read_frame(self.reader))
+                if not self._negotiated:
+                    self._negotiated = True
+                    if self.receiver.last_codec is self._preferred_codec:
+                        self._codec = self._preferred_codec
+                key = MessageIDGenerator.get_key(getattr(reply, "linked_to", None))
+                pending = self._pending.pop(key, None)
+                if pending is not None and not pending.done():
+                    pending.set_result(reply)
+                elif self._logger is not None:
+                    self._logger.debug("AsyncClientConnection : unexpected reply {}".format(reply))
+        except asyncio.CancelledError:
+            return
+        except Exception as e:
+            error = e
+            if not isinstance(e, ConnectionClosed) and self._logger is not None:
+                self._logger.warn("AsyncClientConnection : {}".format(e))
+        self.close(error)
+
+
+class AsyncClientProcess(object):
+    """
+    The asyncio variant of :class:`commons.process.ClientProcess`. One connection is kept open
+    to each receiver, and shared by every message sent to it. Remember to call :meth:`close`
+    once you are done with the client.
+    """
+
+    def __init__(self, handler_store=None, logger=None, timeout=None, codec="json"):
+        """
+        Create a new AsyncClientProcess. To receive replies sent later (delayed replies or
+        subscriptions), give the HandlerStore of a server.
+
+        :param timeout: how many seconds to wait for a reply, None means forever
+        :param codec: the preferred codec (if the receiver supports it), see
+                      :mod:`commons.serialization`
+        """
+        self._store = HandlerStore() if handler_store is None else handler_store
+        self._logger = logger
+        self._timeout = timeout
+        self._codec = get_codec(codec)
+        self._connections = {}
+        self._opening = {}
+
+    async def send_order(self, message, handlers=None):
+        """
+        Send a message. The reply is awaited if the reply method of the message is "immediate".
+
+        :param message: a Message object (or one of its subclasses)
+        :param handlers: a callback or or list of them
+        :return: the reply, or None
+        """
+        return await self._send(
+            message,
+            handlers,
+            getattr(message, "reply_method", "") == "immediate"
+        )
+
+    async def send_subscription(self, message, handlers=None):
+        """
+        Send a subscription message, and wait for the reply.
+
+        :param message: a Message object (or one of its subclasses)
+        :param handlers: a callback or or list of them
+        :return: the reply, or None
+        """
+        return await self._send(message, handlers, True)
+
+    async def close(self):
+        """
+        Close every connection opened by the client.
+        """
+        connections, self._connections = self._connections, {}
+        for connection in connections.values():
+            connection.close()
+
+    async def _send(self, message, handlers, wait_reply):
+        """
+        Send a message, and wait for its reply if needed. Errors are logged.
+        """
+        if handlers is not None:
+            if isinstance(handlers, (tuple, list)):
+                self._store.set_handlers_for(message.id, handlers)
+            else:
+                self._store.set_handlers_for(message.id, [handlers])
+
+        connection = None
+        try:
+            connection = await self._get_connection(tuple(message.receiver))
+            pending = await connection.send(message, wait_reply)
+            if pending is None:
+                return None
+            return await asyncio.wait_for(pending, self._timeout)
+        except Exception:
+            if self._logger is not None:
+                self._logger.error(traceback.format_exc())
+            return None
+        finally:
+            if connection is not None and wait_reply:
+                connection.discard(message.id)
+
+    async def _get_connection(self, address):
+        """
+        Get the connection to the provided address, opening it if needed.
+
+        :param address: a tuple (hostname, port)
+        :return: an :class:`AsyncClientConnection`
+        """
+        connection = self._connections.get(address)
+        if connection is not None and connection.alive:
+            return connection
+
+        # Only one task opens the connection, the others wait for it
+        opening = self._opening.get(address)
+        if opening is None:
+            opening = asyncio.ensure_future(
+                AsyncClientConnection.open(address, self._logger, self._codec)
+            )
+            self._opening[address] = opening
+            try:
+                self._connections[address] = await opening
+            finally:
+                del self._opening[address]
+            return self._connections[address]
+        return await asyncio.shield(opening)
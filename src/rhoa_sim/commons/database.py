@@ -0,0 +1,268 @@
+# -*- coding: utf-8 -*-
+"""
+This module holds helpers for the access to the Neo4j database, shared by every service of a
+process.
+"""
+import threading
+import time
+
+
+class SessionPoolTimeout(Exception):
+    """
+    Raised by a :class:`SessionPool` when no session became available in time.
+    """
+    pass
+
+
+class PooledSession(object):
+    """
+    A session borrowed from a :class:`SessionPool`. It can be used like a Neo4j session (every
+    session method is available) and should be used in a `with` statement: the session goes back
+    to the pool at the end instead of being closed.
+    """
+
+    def __init__(self, pool, session):
+        """
+        Wrap a session of the provided pool.
+
+        :param pool: the :class:`SessionPool` owning the session
+        :param session: a Neo4j session
+        """
+        self._pool = pool
+        self._session = session
+
+    def close(self):
+        """
+        Give the session back to the pool.
+        """
+        if self._session is not None:
+            self._pool.release(self._session)
+            self._session = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self._session is not None:
+            # The session may be broken by the error, don't reuse it
+            self._pool.release(self._session, broken=exc_type is not None)
+            self._session = None
+
+    def __getattr__(self, name):
+        return getattr(self._session, name)
+
+
+class SessionPool(object):
+    """
+    A SessionPool keeps Neo4j sessions open, so that executing a query doesn't cost a new
+    session each time. It can be given to a :class:`DBService` in place of the driver, as it
+    provides the same `session` method::
+
+        pool = SessionPool(GraphDatabase.driver(uri, auth=auth), size=10)
+
+        with pool.session() as session:
+            with session.begin_transaction() as tx:
+                tx.run(query, params)
+
+        pool.close()
+
+    At most `size` sessions are open at the same time, a thread asking for a session while they
+    are all used waits for one. A thread gets back the session it used last time if it is
+    available (sessions are then reused by the same threads as much as possible). A session which
+    has been idle for more than `health_check_interval` seconds is checked before being reused,
+    and replaced if it is broken.
+
+    Utilization and waiting time are available through :meth:`stats`.
+    """
+
+    HEALTH_CHECK_QUERY = "RETURN 1"
+
+    def __init__(self, driver, size=10, health_check_interval=30.0, timeout=None, logger=None):
+        """
+        Create a new SessionPool. Sessions are opened when they are needed.
+
+        :param driver: a :class:`neo4j.v1.Driver` (see :meth:`neo4j.v1.GraphDatabase.driver`)
+        :param size: the maximum number of open sessions
+        :param health_check_interval: how long (in seconds) a session can be idle before being
+                                      checked, None to disable checks
+        :param timeout: the default number of seconds to wait for a session, None means forever
+        """
+        if size < 1:
+            raise ValueError("Invalid pool size {}".format(size))
+
+        self.size = size
+        self.health_check_interval = health_check_interval
+        self.timeout = timeout
+        self._driver = driver
+        self._logger = logger
+
+        self._condition = threading.Condition()
+        self._local = threading.local()  # The last session used by each thread
+        self._idle = []  # Available sessions
+        self._idle_since = {}
+        self._opened = 0
+        self._closed = False
+
+        # Metrics
+        self._acquired = 0
+        self._waits = 0
+        self._wait_time = 0.0
+        self._max_wait_time = 0.0
+        self._replaced = 0
+
+    def session(self, timeout=None):
+        """
+        Borrow a session, use it in a `with` statement.
+
+        :param timeout: overrides the default timeout of the pool
+        :return: a :class:`PooledSession`
+        :raise: SessionPoolTimeout if no session is available in time
+        """
+        timeout = self.timeout if timeout is None else timeout
+        session = self._acquire(timeout)
+
+        while self._needs_check(session) and not self._is_healthy(session):
+            self._replaced += 1
+            self.release(session, broken=True)
+            session = self._acquire(timeout)
+
+        return PooledSession(self, session)
+
+    def release(self, session, broken=False):
+        """
+        Give a session back to the pool. It is closed if it is broken.
+
+        :param session: a session given by the pool
+        :param broken: True if the session shouldn't be reused
+        """
+        if broken or self._closed:
+            self._close_session(session)
+            with self._condition:
+                self._opened -= 1
+                self._condition.notify()
+            return
+
+        self._local.session = session
+        with self._condition:
+            self._idle.append(session)
+            self._idle_since[id(session)] = time.time()
+            self._condition.notify()
+
+    def close(self):
+        """
+        Close the idle sessions, and the sessions in use once they are released. The driver is
+        not closed.
+        """
+        with self._condition:
+            self._closed = True
+            idle, self._idle = self._idle, []
+            self._opened -= len(idle)
+            self._condition.notify_all()
+        for session in idle:
+            self._close_session(session)
+
+    def stats(self):
+        """
+        Get metrics about the pool.
+
+        :return: a dictionary with the size of the pool, the number of open, used and idle
+                 sessions, the utilization (used sessions / size), how many times a session
+                 was borrowed, how many times a thread had to wait for one (with the total,
+                 average and maximum waiting times in seconds) and how many broken sessions
+                 were replaced
+        """
+        with self._condition:
+            in_use = self._opened - len(self._idle)
+            return {
+                "size": self.size,
+                "open": self._opened,
+                "in_use": in_use,
+                "idle": len(self._idle),
+                "utilization": float(in_use) / self.size,
+                "acquired": self._acquired,
+                "waits": self._waits,
+                "wait_time": self._wait_time,
+                "avg_wait_time": self._wait_time / self._acquired if self._acquired else 0.0,
+                "max_wait_time": self._max_wait_time,
+                "replaced": self._replaced
+            }
+
+    def _acquire(self, timeout):
+        """
+        Take an idle session (preferably the last one used by the current thread), open a new
+        one if possible, or wait for one.
+        """
+        start = time.time()
+        waited = False
+        with self._condition:
+            while True:
+                if self._closed:
+                    raise RuntimeError("The session pool is closed")
+
+                if self._idle:
+                    session = getattr(self._local, "session", None)
+                    if session is None or session not in self._idle:
+                        session = self._idle[-1]
+                    self._idle.remove(session)
+                    break
+
+                if self._opened < self.size:
+                    self._opened += 1
+                    session = None
+                    break
+
+                waited = True
+                remaining = None if timeout is None else timeout - (time.time() - start)
+                if remaining is not None and remaining <= 0:
+                    raise SessionPoolTimeout(
+                        "No session available after {} seconds".format(timeout)
+                    )
+                self._condition.wait(remaining)
+
+            self._acquired += 1
+            if waited:
+                wait_time = time.time() - start
+                self._waits += 1
+                self._wait_time += wait_time
+                self._max_wait_time = max(self._max_wait_time, wait_time)
+
+        if session is None:
+            try:
+                session = self._driver.session()
+            except Exception:
+                with self._condition:
+                    self._opened -= 1
+                    self._condition.notify()
+                raise
+            self._idle_since[id(session)] = time.time()
+        return session
+
+    def _needs_check(self, session):
+        """
+        Check if a session has been idle for too long.
+        """
+        if self.health_check_interval is None:
+            return False
+        return time.time() - self._idle_since.get(id(session), 0) > self.health_check_interval
+
+    def _is_healthy(self, session):
+        """
+        Run a trivial query on a session.
+        """
+        try:
+            session.run(SessionPool.HEALTH_CHECK_QUERY).consume()
+            return True
+        except Exception as e:
+            if self._logger is not None:
+                self._logger.warn("SessionPool : broken session ({})".format(e))
+            return False
+
+    def _close_session(self, session):
+        """
+        Close a session, ignoring errors (it may be broken).
+        """
+        self._idle_since.pop(id(session), None)
+        try:
+            session.close()
+        except Exception:
+            pass
@@ -0,0 +1,318 @@
+# -*- coding: utf-8 -*-
+"""
+An in-process, append-only store of the experiences (the passage times measured on sections
+and intersections), kept in columns so that range filters and statistics are computed with
+vectorized operations instead of database queries. It needs the `numpy` package.
+"""
+import threading
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+class ExperienceStore(object):
+    """
+    A columnar store of experiences: begin times, passage times and concerned node ids are
+    stored in NumPy arrays (node names are replaced by ids). Experiences are usually added in
+    chronological order: the store keeps an order sorted by begin time, so time ranges are found
+    by binary search, and sorts again only when an experience arrives out of order.
+
+    The store is loaded from the graph the first time it is needed (see :meth:`ensure_loaded`)
+    and is then fed by the code writing experiences (see :meth:`add`). Use :meth:`get_instance`
+    to get the store shared by every service of the process::
+
+        store = ExperienceStore.get_instance()
+        if store.ensure_loaded(session_pool):
+            # Passage time statistics of each section, by hour, for the last day
+            stats = store.statistics(min_begin_time=now - 86400, window=3600)
+
+    """
+
+    LOAD_QUERY = (
+        "MATCH (e:Experience)-[:CONCERNS]->(c)"
+        " RETURN e.beginTime AS begin_time, e.passageTime AS passage_time,"
+        " c.name AS concerned_name"
+    )
+
+    INITIAL_CAPACITY = 1024
+
+    _instance = None
+
+    @classmethod
+    def get_instance(cls):
+        """
+        Get the ExperienceStore shared by the services of the process.
+
+        :return: an ExperienceStore instance
+        """
+        if cls._instance is None:
+            cls._instance = ExperienceStore()
+        return cls._instance
+
+    @staticmethod
+    def is_available():
+        """
+        Check if the store can be used (NumPy is installed).
+        """
+        return numpy is not None
+
+    def __init__(self, capacity=INITIAL_CAPACITY, logger=None):
+        """
+        Create a new (empty) ExperienceStore.
+
+        :param capacity: the initial size of the columns, they grow when needed
+        """
+        self._logger = logger
+        self._lock = threading.RLock()
+        self._capacity = capacity
+        self._size = 0
+        self._names = []  # Node names, by id
+        self._ids = {}  # Node ids, by name
+        self._loaded = False
+        self._generation = 0
+        if numpy is not None:
+            self._begin_times = numpy.empty(capacity, dtype=numpy.float64)
+            self._passage_times = numpy.empty(capacity, dtype=numpy.float64)
+            self._concerned = numpy.empty(capacity, dtype=numpy.int32)
+            # Indexes sorted by begin time, and the begin times in that order
+            self._order = numpy.empty(capacity, dtype=numpy.intp)
+            self._sorted_begin_times = numpy.empty(capacity, dtype=numpy.float64)
+            self._sorted = True  # True if the order is up to date
+
+    @property
+    def loaded(self):
+        return self._loaded
+
+    @property
+    def generation(self):
+        """
+        A counter incremented when a load starts and when it ends (it is odd while the store is
+        loading). A writer reading it before writing an experience, and again after, knows if a
+        load ran meanwhile (and may already hold the experience).
+        """
+        return self._generation
+
+    def __len__(self):
+        return self._size
+
+    def ensure_loaded(self, connection):
+        """
+        Load the store from the graph, if it is not loaded yet.
+
+        :param connection: a :class:`commons.database.SessionPool` or a Neo4j driver
+        :return: True if the store is loaded (False if NumPy is not installed)
+        """
+        if self._loaded:
+            return True
+        if numpy is None:
+            return False
+
+        with self._lock:
+            if self._loaded:
+                return True
+            self._generation += 1
+            try:
+                with connection.session() as session:
+                    records = list(session.run(ExperienceStore.LOAD_QUERY))
+
+                self.clear()
+                self.add_many(
+                    (record["begin_time"], record["passage_time"], record["concerned_name"])
+                    for record in records
+                )
+                self._loaded = True
+                return True
+            except Exception as e:
+                if self._logger is not None:
+                    self._logger.warn("ExperienceStore : can't load the experiences ({})".format(e))
+                return False
+            finally:
+                self._generation += 1
+
+    def clear(self):
+        """
+        Remove every experience.
+        """
+        with self._lock:
+            self._size = 0
+            self._names = []
+            self._ids = {}
+            self._sorted = True
+
+    def invalidate(self):
+        """
+        Forget the content of the store, it will be loaded again when needed.
+        """
+        with self._lock:
+            self._loaded = False
+
+    def add(self, begin_time, passage_time, concerned_name):
+        """
+        Add an experience.
+
+        :param begin_time: the timestamp of the beginning of the experience
+        :param passage_time: the passage time
+        :param concerned_name: the name of the concerned section or intersection
+        """
+        self.add_many([(begin_time, passage_time, concerned_name)])
+
+    def add_many(self, experiences):
+        """
+        Add experiences.
+
+        :param experiences: an iterable of tuples (begin time, passage time, concerned name)
+        """
+        experiences = [item for item in experiences if None not in item]
+        if not experiences:
+            return
+
+        with self._lock:
+            count = len(experiences)
+            self._reserve(self._size + count)
+            begin_times, passage_times, names = zip(*experiences)
+            new = slice(self._size, self._size + count)
+            self._begin_times[new] = begin_times
+            self._passage_times[new] = passage_times
+            self._concerned[new] = [self._get_id(name) for name in names]
+
+            # The order stays sorted if the new experiences follow the previous ones
+            added = self._begin_times[new]
+            if self._sorted and (
+                    (self._size > 0 and added[0] < self._sorted_begin_times[self._size - 1])
+                    or (count > 1 and numpy.any(added[1:] < added[:-1]))):
+                self._sorted = False
+            if self._sorted:
+                self._order[new] = numpy.arange(self._size, self._size + count)
+                self._sorted_begin_times[new] = added
+            self._size += count
+
+    def statistics(self, min_begin_time=None, max_begin_time=None, min_passage_time=None,
+                   max_passage_time=None, concerned_name=None, window=None):
+        """
+        Compute passage time statistics for each concerned node, among the experiences matching
+        the provided bounds (all of them are optional and inclusive).
+
+        :param window: if provided, the statistics are also grouped by time window, experiences
+                       beginning between `k * window` and `(k + 1) * window` being in the same
+                       window
+        :return: a list of dictionaries, with the concerned_name, the window_start (if a window
+                 is given), and the count, mean, min, max and std (population standard
+                 deviation) of the passage times
+        """
+        with self._lock:
+            indexes = self._select(
+                min_begin_time,
+                max_begin_time,
+                min_passage_time,
+                max_passage_time,
+                concerned_name
+            )
+            if not len(indexes):
+                return []
+            begin_times = self._begin_times[indexes]
+            passage_times = self._passage_times[indexes]
+            concerned = self._concerned[indexes].astype(numpy.int64)
+            names = list(self._names)
+
+        # A group per node (and per window), numbered from 0
+        if window is not None:
+            windows = numpy.floor(begin_times / window).astype(numpy.int64)
+            windows -= windows.min()
+            keys = concerned * (int(windows.max()) + 1) + windows
+        else:
+            keys = concerned
+        groups, group_of = numpy.unique(keys, return_inverse=True)
+        group_of = group_of.reshape(-1)
+
+        counts = numpy.bincount(group_of, minlength=len(groups))
+        sums = numpy.bincount(group_of, weights=passage_times, minlength=len(groups))
+        squares = numpy.bincount(group_of, weights=passage_times ** 2, minlength=len(groups))
+        means = sums / counts
+        stds = numpy.sqrt(numpy.maximum(squares / counts - means ** 2, 0))
+        minimums = numpy.full(len(groups), numpy.inf)
+        maximums = numpy.full(len(groups), -numpy.inf)
+        numpy.minimum.at(minimums, group_of, passage_times)
+        numpy.maximum.at(maximums, group_of, passage_times)
+
+        # Describe each group with one of its experiences
+        first = numpy.full(len(groups), len(group_of), dtype=numpy.intp)
+        numpy.minimum.at(first, group_of, numpy.arange(len(group_of)))
+
+        result = []
+        for group in range(len(groups)):
+            row = {
+                "concerned_name": names[concerned[first[group]]],
+                "count": int(counts[group]),
+                "mean": float(means[group]),
+                "min": float(minimums[group]),
+                "max": float(maximums[group]),
+                "std": float(stds[group])
+            }
+            if window is not None:
+                begin_time = begin_times[first[group]]
+                row["window_start"] = float(numpy.floor(begin_time / window) * window)
+            result.append(row)
+        return result
+
+    def _select(self, min_begin_time, max_begin_time, min_passage_time, max_passage_time,
+                concerned_name):
+        """
+        Get the indexes of the matching experiences, sorted by begin time. The lock must be
+        held.
+        """
+        order = self._get_order()
+        begin_times = self._sorted_begin_times[:self._size]
+        start = 0 if min_begin_time is None else numpy.searchsorted(
+            begin_times, min_begin_time, side="left"
+        )
+        end = len(order) if max_begin_time is None else numpy.searchsorted(
+            begin_times, max_begin_time, side="right"
+        )
+        indexes = order[start:end]
+
+        mask = None
+        if min_passage_time is not None:
+            mask = self._passage_times[indexes] >= min_passage_time
+        if max_passage_time is not None:
+            condition = self._passage_times[indexes] <= max_passage_time
+            mask = condition if mask is None else mask & condition
+        if concerned_name is not None:
+            condition = self._concerned[indexes] == self._ids.get(concerned_name, -1)
+            mask = condition if mask is None else mask & condition
+        return indexes if mask is None else indexes[mask]
+
+    def _get_order(self):
+        """
+        Get the indexes of the experiences sorted by begin time, sort them if needed (the sorted
+        begin times are updated too).
+        """
+        if not self._sorted:
+            order = numpy.argsort(self._begin_times[:self._size], kind="mergesort")
+            self._order[:self._size] = order
+            self._sorted_begin_times[:self._size] = self._begin_times[order]
+            self._sorted = True
+        return self._order[:self._size]
+
+    def _get_id(self, name):
+        node_id = self._ids.get(name)
+        if node_id is None:
+            node_id = self._ids[name] = len(self._names)
+            self._names.append(name)
+        return node_id
+
+    def _reserve(self, size):
+        """
+        Grow the columns so that they can hold `size` experiences.
+        """
+        if size <= self._capacity:
+            return
+        capacity = max(size, 2 * self._capacity)
+        for name in ("_begin_times", "_passage_times", "_concerned", "_order",
+                     "_sorted_begin_times"):
+            column = getattr(self, name)
+            grown = numpy.empty(capacity, dtype=column.dtype)
+            grown[:self._size] = column[:self._size]
+            setattr(self, name, grown)
+        self._capacity = capacity
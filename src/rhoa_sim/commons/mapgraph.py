@@ -0,0 +1,421 @@
+# -*- coding: utf-8 -*-
+"""
+An in-process copy of the map graph (the intersections and sections joined by LINK
+relationships), with cached shortest paths. Crossing a node costs its mean passage time,
+learnt from the experiences, so paths avoid the slow parts of the map. Path requests
+(:class:`commons.messages.GetPathMessage`) are answered from memory, see :class:`GetPathHandler`.
+"""
+import heapq
+import threading
+
+from commons.network import Sender
+from commons.utils import MessageIDGenerator
+
+
+class MapGraph(object):
+    """
+    The LINK graph, held as an adjacency list, with the shortest paths from the nodes paths were
+    asked from. The cost of a path is the sum of the mean passage times of the nodes it enters
+    (nodes without experience cost the mean passage time of the whole map, or 1 if there is no
+    experience at all).
+
+    The shortest paths from a node are computed (a Dijkstra) the first time a path from this node
+    is asked, without holding the lock of the graph, so other requests are still served meanwhile.
+    A path is only built the first time it is asked: later requests for the same source and
+    destination are served by a cache. Experiences are added as they are created (see
+    :meth:`add_experiences`). Paths are computed again, lazily, only when the cost of a node has
+    changed by more than `tolerance` since the last computation. Use :meth:`get_instance` to get
+    the graph shared by every service of the process::
+
+        graph = MapGraph.get_instance()
+        if graph.ensure_loaded(session_pool):
+            # Positions [x, y] to go through to reach Section_3 from Intersection_1
+            waypoints = graph.waypoints("Intersection_1", "Section_3")
+
+    """
+
+    LOAD_QUERY = (
+        "MATCH (a)-[:LINK]-(b)"
+        " RETURN a.name AS a, a.x AS a_x, a.y AS a_y, b.name AS b, b.x AS b_x, b.y AS b_y"
+    )
+
+    EXPERIENCES_QUERY = (
+        "MATCH (e:Experience)-[:CONCERNS]->(c)"
+        " RETURN c.name AS name, count(e) AS count, sum(e.passageTime) AS total"
+    )
+
+    DEFAULT_TOLERANCE = 0.1
+
+    _instance = None
+
+    @classmethod
+    def get_instance(cls):
+        """
+        Get the MapGraph shared by the services of the process.
+
+        :return: a MapGraph instance
+        """
+        if cls._instance is None:
+            cls._instance = MapGraph()
+        return cls._instance
+
+    def __init__(self, tolerance=DEFAULT_TOLERANCE, logger=None):
+        """
+        Create a new (empty) MapGraph.
+
+        :param tolerance: how much the cost of a node can change (relatively to the cost used by
+                          the current paths) before paths are computed again
+        """
+        self.tolerance = tolerance
+        self._logger = logger
+        self._lock = threading.RLock()
+        self._loaded = False
+        self._generation = 0
+
+        self._names = []  # Node names, by index
+        self._indexes = {}  # Node indexes, by name
+        self._positions = []  # [x, y], by index
+        self._neighbours = []  # Sets of indexes, by index
+
+        # Passage times of the experiences, by node name: [count, total]
+        self._experiences = {}
+        self._count = 0
+        self._total = 0.0
+
+        self._costs = None  # The costs used by the current paths, by index (None if outdated)
+        self._default_cost = None
+        # By source index, the distance of each destination and the node before it in its path
+        self._trees = {}
+        self._paths = {}  # (source, destination) -> list of names
+
+        # Metrics
+        self._computations = 0
+        self._hits = 0
+        self._misses = 0
+
+    @property
+    def loaded(self):
+        return self._loaded
+
+    @property
+    def generation(self):
+        """
+        A counter incremented when a load starts and when it ends (it is odd while the graph is
+        loading). A writer reading it before writing an experience, and again after, knows if a
+        load ran meanwhile (and may already hold the experience).
+        """
+        return self._generation
+
+    def __len__(self):
+        return len(self._names)
+
+    def ensure_loaded(self, connection, session=None):
+        """
+        Load the graph and the passage times from the database, if they are not loaded yet.
+
+        :param connection: a :class:`commons.database.SessionPool` or a Neo4j driver
+        :param session: a session to use instead of borrowing one from the connection (give
+                        the session you hold, if any: a bounded pool may have no other one)
+        :return: True if the graph is loaded
+        """
+        if self._loaded:
+            return True
+
+        with self._lock:
+            if self._loaded:
+                return True
+            self._generation += 1
+            try:
+                if session is not None:
+                    links, experiences = self._read(session)
+                else:
+                    with connection.session() as session:
+                        links, experiences = self._read(session)
+            except Exception as e:
+                if self._logger is not None:
+                    self._logger.warn("MapGraph : can't load the map ({})".format(e))
+                return False
+            finally:
+                self._generation += 1
+
+            self.load(
+                [((link["a"], link["a_x"], link["a_y"]), (link["b"], link["b_x"], link["b_y"]))
+                 for link in links],
+                [(record["name"], record["count"], record["total"]) for record in experiences]
+            )
+            return True
+
+    def load(self, links, experiences=()):
+        """
+        Replace the content of the graph.
+
+        :param links: an iterable of tuples ((name, x, y), (name, x, y)), the two nodes of a
+                      LINK (links are not directed)
+        :param experiences: an iterable of tuples (name, number of experiences, total passage
+                            time), the experiences of each node
+        """
+        with self._lock:
+            self._names = []
+            self._indexes = {}
+            self._positions = []
+            self._neighbours = []
+            for a, b in links:
+                a, b = self._add_node(*a), self._add_node(*b)
+                if a != b:
+                    self._neighbours[a].add(b)
+                    self._neighbours[b].add(a)
+
+            self._experiences = {}
+            self._count = 0
+            self._total = 0.0
+            for name, count, total in experiences:
+                if count:
+                    self._experiences[name] = [count, float(total)]
+                    self._count += count
+                    self._total += total
+
+            self._invalidate_paths()
+            self._loaded = True
+            self._generation += 2  # A whole load (see generation)
+
+    def invalidate(self):
+        """
+        Forget the content of the graph, it will be loaded again when needed.
+        """
+        with self._lock:
+            self._loaded = False
+
+    def add_experiences(self, experiences):
+        """
+        Take new experiences into account. Paths are computed again only if the cost of a node
+        has changed enough (see `tolerance`).
+
+        :param experiences: an iterable of tuples (begin time, passage time, concerned name)
+        """
+        with self._lock:
+            for _, passage_time, name in experiences:
+                if passage_time is None or name is None:
+                    continue
+                counters = self._experiences.setdefault(name, [0, 0.0])
+                counters[0] += 1
+                counters[1] += passage_time
+                self._count += 1
+                self._total += passage_time
+
+            if self._costs is not None and self._costs_changed():
+                self._invalidate_paths()
+
+    def path(self, source, destination):
+        """
+        Get the shortest path between two nodes.
+
+        :param source: the name of the starting node
+        :param destination: the name of the node to reach
+        :return: the list of the names of the nodes of the path (source and destination
+                 included), or None if there is no such path
+        """
+        key = (source, destination)
+        path = self._paths.get(key)
+        if path is not None:
+            self._hits += 1
+            return path
+
+        self._misses += 1
+        search = self._search(source, destination)
+        if search is None:
+            return None
+        costs, names, source_index, destination_index, (_, previous) = search
+        if source_index != destination_index and previous[destination_index] is None:
+            return None
+        path = [destination_index]
+        while path[-1] != source_index:
+            path.append(previous[path[-1]])
+        path = [names[index] for index in reversed(path)]
+
+        with self._lock:
+            if self._costs is costs:
+                self._paths[key] = path
+        return path
+
+    def distance(self, source, destination):
+        """
+        Get the cost of the shortest path between two nodes.
+
+        :return: the cost, or None if there is no path
+        """
+        search = self._search(source, destination)
+        if search is None:
+            return None
+        _, _, _, destination_index, (distances, _) = search
+        return distances[destination_index]
+
+    def waypoints(self, source, destination):
+        """
+        Get the positions to go through to reach a node. If the source is unknown (or not
+        given), the position of the destination is the only waypoint.
+
+        :param source: the name of the starting node
+        :param destination: the name of the node to reach
+        :return: a list of positions [x, y] (the source excluded), empty if the destination is
+                 unknown or can't be reached
+        """
+        if destination not in self._indexes:
+            return []
+        path = self.path(source, destination) if source in self._indexes else [destination]
+        if path is None:
+            return []
+        return [list(self._positions[self._indexes[name]]) for name in path[1:] or path]
+
+    def stats(self):
+        """
+        Get metrics about the graph.
+
+        :return: a dictionary with the number of nodes and experiences, how many times the paths
+                 from a node were computed, the number of nodes having their paths computed, the
+                 number of cached paths, and the hits and misses of the cache
+        """
+        with self._lock:
+            return {
+                "nodes": len(self._names),
+                "experiences": self._count,
+                "computations": self._computations,
+                "sources": len(self._trees),
+                "paths": len(self._paths),
+                "hits": self._hits,
+                "misses": self._misses
+            }
+
+    @staticmethod
+    def _read(session):
+        """
+        Read the links and the experiences of each node.
+        """
+        links = list(session.run(MapGraph.LOAD_QUERY))
+        experiences = list(session.run(MapGraph.EXPERIENCES_QUERY))
+        return links, experiences
+
+    def _add_node(self, name, x, y):
+        index = self._indexes.get(name)
+        if index is None:
+            index = self._indexes[name] = len(self._names)
+            self._names.append(name)
+            self._positions.append([x, y])
+            self._neighbours.append(set())
+        return index
+
+    def _get_costs(self):
+        """
+        Compute the cost of each node, and the default cost (for nodes without experience).
+        """
+        default_cost = self._total / self._count if self._count else 1.0
+        costs = []
+        for name in self._names:
+            counters = self._experiences.get(name)
+            costs.append(counters[1] / counters[0] if counters else default_cost)
+        return costs, default_cost
+
+    def _costs_changed(self):
+        """
+        Check if the cost of a node moved away from the cost used by the current paths.
+        """
+        costs, _ = self._get_costs()
+        for used, cost in zip(self._costs, costs):
+            if abs(cost - used) > self.tolerance * max(abs(used), 1e-9):
+                return True
+        return False
+
+    def _invalidate_paths(self):
+        self._costs = None
+        self._trees = {}
+        self._paths = {}
+
+    def _search(self, source, destination):
+        """
+        Get the shortest paths from a node, computed if needed. The computation runs without the
+        lock: its result is kept only if the graph and the costs didn't change meanwhile.
+
+        :return: a tuple (costs, names, source index, destination index, (distances, previous)),
+                 or None if a node is unknown
+        """
+        with self._lock:
+            names = self._names
+            source_index = self._indexes.get(source)
+            destination_index = self._indexes.get(destination)
+            if source_index is None or destination_index is None:
+                return None
+            if self._costs is None:
+                self._costs, self._default_cost = self._get_costs()
+            costs, neighbours = self._costs, self._neighbours
+            tree = self._trees.get(source_index)
+
+        if tree is None:
+            tree = self._dijkstra(source_index, costs, neighbours)
+            with self._lock:
+                self._computations += 1
+                if self._costs is costs:
+                    tree = self._trees.setdefault(source_index, tree)
+        return costs, names, source_index, destination_index, tree
+
+    @staticmethod
+    def _dijkstra(source, costs, neighbours):
+        """
+        Compute the shortest paths from a node.
+
+        :return: a tuple (distances, previous): the distance of each node, and the node before it
+                 in its path
+        """
+        size = len(costs)
+        distances = [None] * size
+        previous = [None] * size
+        distances[source] = 0.0
+        heap = [(0.0, source)]
+        while heap:
+            distance, node = heapq.heappop(heap)
+            if distance > distances[node]:
+                continue
+            for neighbour in neighbours[node]:
+                candidate = distance + costs[neighbour]
+                if distances[neighbour] is None or candidate < distances[neighbour]:
+                    distances[neighbour] = candidate
+                    previous[neighbour] = node
+                    heapq.heappush(heap, (candidate, neighbour))
+        return distances, previous
+
+
+class GetPathHandler(object):
+    """
+    A class-level handler answering :class:`commons.messages.GetPathMessage` from a
+    :class:`MapGraph`: the reply data is the list of waypoints (see :meth:`MapGraph.waypoints`).
+    Register it in the :meth:`commons.process.ServerProcess._set_handlers` of the process
+    serving paths::
+
+        def _set_handlers(self):
+            GetPathMessage.set_handler(GetPathHandler(self._connection, logger=self._logger))
+
+    """
+
+    def __init__(self, connection, graph=None, logger=None):
+        """
+        Create a new GetPathHandler.
+
+        :param connection: a :class:`commons.database.SessionPool` or a Neo4j driver, used to
+                           load the graph
+        :param graph: the MapGraph to use, the shared one by default
+        """
+        self._connection = connection
+        self._graph = graph if graph is not None else MapGraph.get_instance()
+        self._logger = logger
+
+    def __call__(self, message, request):
+        waypoints = []
+        if self._graph.ensure_loaded(self._connection):
+            waypoints = self._graph.waypoints(message.source, message.destination)
+        elif self._logger is not None:
+            self._logger.warn("GetPathHandler : no map to answer {}".format(message.id))
+
+        Sender(request).send({
+            "id": MessageIDGenerator.get_new_message_id(),
+            "receiver": request.getpeername(),
+            "linked_to": message.id,
+            "data": waypoints
+        })
@@ -1,25 +1,205 @@
-from commons.utils import get_final_classes
+import threading
+from operator import attrgetter
 
+from future.utils import with_metaclass
 
-class Message(object):
+from commons.utils import get_all_classes, get_final_classes
+
+
+class MessageRegistry(object):
+    """
+    The MessageRegistry knows every message class and is able to find which one should parse a
+    dictionary. It is built once, when it is first needed, and rebuilt only if a new message
+    class has been defined since (see :class:`MessageType`).
+
+    A dictionary is resolved according to its `type` field if there is one (the name of a
+    message class whose required params are provided). Otherwise, its keys are used: the chosen
+    class is the final class with the most required params among those whose required params
+    are all provided. The result is memorized for each set of keys, so resolving a message
+    doesn't depend on the size of the hierarchy.
+    """
+
+    _lock = threading.Lock()
+    _index = None
+
+    @classmethod
+    def invalidate(cls):
+        """
+        Forget the current index, it will be rebuilt when needed.
+        """
+        cls._index = None
+
+    @classmethod
+    def get_class(cls, params):
+        """
+        Find the class that should parse the provided dictionary.
+
+        :param params: a message dictionary
+        :return: a class derived from Message, or None if there is no such class
+        """
+        index = cls._index
+        if index is None:
+            index = cls._build()
+
+        message_class = index["by_name"].get(params.get("type"))
+        if message_class is not None and index["required"][message_class].issubset(params):
+            return message_class
+
+        # Only known keys are relevant (and it keeps the memo small)
+        keys = index["known_keys"].intersection(params)
+        by_keys = index["by_keys"]
+        try:
+            return by_keys[keys]
+        except KeyError:
+            pass
+
+        result = None
+        for final_class, required_params in index["candidates"]:
+            if required_params.issubset(keys):
+                result = final_class
+                break
+        by_keys[keys] = result
+        return result
+
+    @classmethod
+    def get_class_by_name(cls, name):
+        """
+        Get a message class according to its name.
+
+        :param name: the name of the class
+        :return: a class derived from Message, or None if there is no such class
+        """
+        index = cls._index
+        if index is None:
+            index = cls._build()
+        return index["by_name"].get(name)
+
+    @classmethod
+    def get_required_params(cls, message_class):
+        """
+        Get the (cached) required params of a message class.
+
+        :param message_class: a class derived from Message
+        :return: a frozenset of required params
+        """
+        index = cls._index
+        if index is None:
+            index = cls._build()
+        return index["required"][message_class]
+
+    @classmethod
+    def _build(cls):
+        """
+        Build the index of message classes.
+
+        :return: the new index
+        """
+        with cls._lock:
+            if cls._index is not None:
+                return cls._index
+
+            message_classes = get_all_classes(Message)
+            required = {
+                message_class: frozenset(message_class.get_required_params())
+                for message_class in message_classes
+            }
+            final_classes = get_final_classes(Message)
+            index = {
+                "by_name": {message_class.__name__: message_class
+                            for message_class in message_classes},
+                "required": required,
+                # Final classes with the most required params come first
+                "candidates": sorted(
+                    [(final_class, required[final_class]) for final_class in final_classes],
+                    key=lambda item: (-len(item[1]), item[0].__name__)
+                ),
+                "known_keys": frozenset().union(*required.values()),
+                "by_keys": {}
+            }
+            cls._index = index
+            return index
+
+
+class MessageType(type):
+    """
+    The metaclass of every message. It builds the schema of each message class: the `FIELDS`
+    declared by the class are appended to the schema of its base. Fields are stored in
+    `__slots__`, so messages don't carry a dictionary. Classes which don't declare `FIELDS` but
+    override `get_my_required_params` get their required params as fields.
+
+    Defining a new message class also invalidates the :class:`MessageRegistry`.
+    """
+
+    def __new__(mcs, name, bases, namespace):
+        fields = namespace.get("FIELDS")
+        if fields is None:
+            get_my_required_params = namespace.get("get_my_required_params")
+            if isinstance(get_my_required_params, staticmethod):
+                fields = sorted(get_my_required_params.__func__())
+            else:
+                fields = ()
+
+        schema = []
+        for base in bases:
+            for field in getattr(base, "_schema", ()):
+                if field not in schema:
+                    schema.append(field)
+        new_fields = tuple(field for field in fields if field not in schema)
+        schema.extend(new_fields)
+
+        namespace = dict(namespace)
+        namespace["FIELDS"] = tuple(fields)
+        namespace.setdefault("__slots__", new_fields)
+        namespace["_schema"] = tuple(schema)
+        namespace["_get_values"] = attrgetter(*schema) if schema else None
+        return super(MessageType, mcs).__new__(mcs, name, bases, namespace)
+
+    def __init__(cls, name, bases, namespace):
+        super(MessageType, cls).__init__(name, bases, namespace)
+        MessageRegistry.invalidate()
+
+
+class Message(with_metaclass(MessageType, object)):
     """
     This class is the root of all messages
     It comes with common attributes : (id, receiver, sender) and common methods
+
+    Each subclass declares the fields it adds in `FIELDS`. Fields are required params, and they
+    are filled from the dictionary given to the constructor.
     """
 
+    FIELDS = ("id", "receiver", "sender")
+
     _handler = None
 
     def __init__(self, params):
-        self.id = params["id"]
-        self.receiver = params["receiver"]
-        self.sender = params["sender"]
+        for field in self._schema:
+            setattr(self, field, params[field])
 
     def to_dict(self):
         """
-        This method returns dictionary containing the attribute values of the current object
+        This method returns a new dictionary containing the field values of the current object
+        :return:
+        """
+        return dict(zip(self._schema, self._get_values(self)))
+
+    def to_tuple(self):
+        """
+        This method returns the field values of the current object, in the order of the schema
+        (see :meth:`get_schema`)
+        :return:
+        """
+        return self._get_values(self)
+
+    @classmethod
+    def get_schema(cls):
+        """
+        This method retrieves the fields of the current class, from the Message class to the
+        current class
         :return:
+        A tuple of field names
         """
-        return vars(self)
+        return cls._schema
 
     def handle(self, *args, **kwargs):
         if self._handler is None:
@@ -30,20 +210,13 @@ class Message(object):
     def parse_from_dict(params):
         """
         This method parses a dictionary and returns the appropriate object derived from Message
+        (see :class:`MessageRegistry`)
         :param params:
         :return:
         An object of a class derived from Message if the parsing was successful, None otherwise
         """
-        final_classes = get_final_classes(Message)
-        possible_classes = list()
-        for final_class in final_classes:
-            if final_class.get_required_params().issubset(params):
-                possible_classes.append((
-                    final_class,
-                    len(final_class.get_required_params())
-                ))
-        possible_classes.sort(key=lambda x: x[1])
-        return possible_classes[-1][0](params) if len(possible_classes) > 0 else None
+        message_class = MessageRegistry.get_class(params)
+        return message_class(params) if message_class is not None else None
 
     @staticmethod
     def check_parsing_determinism():
@@ -76,14 +249,14 @@ class Message(object):
                         result.append([class1, class2])
         return result
 
-    @staticmethod
-    def get_my_required_params():
+    @classmethod
+    def get_my_required_params(cls):
         """
-        This static method retrieves the required params of only the current class (Message)
+        This method retrieves the required params of only the current class (its `FIELDS`)
         :return:
         A set of required params
         """
-        return {"id", "receiver", "sender"}
+        return set(cls.FIELDS)
 
     @classmethod
     def get_required_params(cls):
@@ -103,8 +276,17 @@ class Message(object):
     def set_handler(cls, handler):
         cls._handler = handler
 
+    @classmethod
+    def get_handler(cls):
+        """
+        Get the class-level handler set by :meth:`set_handler`.
+
+        :return: the handler, or None
+        """
+        return cls._handler
+
     def __repr__(self):
-        return vars(self).__repr__()
+        return self.to_dict().__repr__()
 
 
 class OrderMessage(Message):
@@ -112,19 +294,7 @@ class OrderMessage(Message):
     This class describes a order message
     It is built on the Message class and adds a reply method attribute
     """
-    def __init__(self, params):
-        super(OrderMessage, self).__init__(params)
-        self.reply_method = params["reply_method"]
-        self.reply_to = params["reply_to"]
-
-    @staticmethod
-    def get_my_required_params():
-        """
-        This static method retrieves the required params of only the current class
-        :return:
-        A set of required params
-        """
-        return {"reply_method", "reply_to"}
+    FIELDS = ("reply_method", "reply_to")
 
 
 class ServiceOrderMessage(OrderMessage):
@@ -132,21 +302,7 @@ class ServiceOrderMessage(OrderMessage):
     This order is a service asked to a process (mainly the ContextProcess).
     It adds service, args and kwargs attributes.
     """
-
-    def __init__(self, params):
-        super(ServiceOrderMessage, self).__init__(params)
-        self.service = params["service"]
-        self.args = params["args"]
-        self.kwargs = params["kwargs"]
-
-    @staticmethod
-    def get_my_required_params():
-        """
-        This static method retrieves the required params of only the current class
-        :return:
-        A set of required params
-        """
-        return {"service", "args", "kwargs"}
+    FIELDS = ("service", "args", "kwargs")
 
 
 class RobotActionOrderMessage(OrderMessage):
@@ -154,18 +310,7 @@ class RobotActionOrderMessage(OrderMessage):
     This class describes an order message for the robot (action process)
     It is built on the OrderMessageClass and adds an action identifier attribute
     """
-    def __init__(self, params):
-        super(RobotActionOrderMessage, self).__init__(params)
-        self.action_id = params["action_id"]
-
-    @staticmethod
-    def get_my_required_params():
-        """
-        This static method retrieves the required params of only the current class
-        :return:
-        A set of required params
-        """
-        return {"action_id"}
+    FIELDS = ("action_id",)
 
 
 class MoveActionMessage(RobotActionOrderMessage):
@@ -173,18 +318,7 @@ class MoveActionMessage(RobotActionOrderMessage):
     This class describes a move order message for the robot (action process)
     It is built on the RobotActionOrderMessage and adds a target location attribute
     """
-    def __init__(self, params):
-        super(MoveActionMessage, self).__init__(params)
-        self.target = params["target"]
-
-    @staticmethod
-    def get_my_required_params():
-        """
-        This static method retrieves the required params of only the current class
-        :return:
-        A set of required params
-        """
-        return {"target"}
+    FIELDS = ("target",)
 
 
 class ScanActionMessage(RobotActionOrderMessage):
@@ -192,19 +326,7 @@ class ScanActionMessage(RobotActionOrderMessage):
     This class describes a scan order message for the robot (action process)
     It is built on the RobotActionOrderMessage and adds a target code attribute
     """
-    def __init__(self, params):
-        super(ScanActionMessage, self).__init__(params)
-        self.target = params["target"]
-        self.target_code = params["target_code"]
-
-    @staticmethod
-    def get_my_required_params():
-        """
-        This static method retrieves the required params of only the current class
-        :return:
-        A set of required params
-        """
-        return {"target", "target_code"}
+    FIELDS = ("target", "target_code")
 
 
 class LearningOrderMessage(OrderMessage):
@@ -212,8 +334,6 @@ class LearningOrderMessage(OrderMessage):
     This class describes a learning order message for the learning process
     It is built ont the OrderMessage Class
     """
-    def __init__(self, params):
-        super(LearningOrderMessage, self).__init__(params)
 
 
 class GetPathMessage(LearningOrderMessage):
@@ -221,19 +341,7 @@ class GetPathMessage(LearningOrderMessage):
     This class describes get path order for the learning
     It is built on the LearningOrderMessage class and adds source and destination attributes
     """
-    def __init__(self, params):
-        super(GetPathMessage, self).__init__(params)
-        self.source = params["source"]
-        self.destination = params["destination"]
-
-    @staticmethod
-    def get_my_required_params():
-        """
-        This static method retrieves the required params of only the current class
-        :return:
-        A set of required params
-        """
-        return {"source", "destination"}
+    FIELDS = ("source", "destination")
 
 
 class ObservationOrderMessage(OrderMessage):
@@ -241,8 +349,6 @@ class ObservationOrderMessage(OrderMessage):
     This class describes an observation order message for the observation process
     It is built ont the OrderMessage Class
     """
-    def __init__(self, params):
-        super(ObservationOrderMessage, self).__init__(params)
 
 
 class SubscriptionMessage(Message):
@@ -251,19 +357,7 @@ class SubscriptionMessage(Message):
     It is built on the Message class
     it adds an attribute for precising if it is a message for subscribing or unsubscribing
     """
-    def __init__(self, params):
-        super(SubscriptionMessage, self).__init__(params)
-        self.is_subscribing = params["is_subscribing"]
-        self.reply_to = params["reply_to"]
-
-    @staticmethod
-    def get_my_required_params():
-        """
-        This static method retrieves the required params of only the current class
-        :return:
-        A set of required params
-        """
-        return {"is_subscribing", "reply_to"}
+    FIELDS = ("is_subscribing", "reply_to")
 
 
 class ContextSubscriptionMessage(SubscriptionMessage):
@@ -271,20 +365,7 @@ class ContextSubscriptionMessage(SubscriptionMessage):
     This class describes a service subscription to the context process
     It is built on the ContextSubscriptionMessage and adds the service, args and kwargs attributes
     """
-    def __init__(self, params):
-        super(ContextSubscriptionMessage, self).__init__(params)
-        self.service = params["service"]
-        self.args = params["args"]
-        self.kwargs = params["kwargs"]
-
-    @staticmethod
-    def get_my_required_params():
-        """
-        This static method retrieves the required params of only the current class
-        :return:
-        A set of required params
-        """
-        return {"service", "args", "kwargs"}
+    FIELDS = ("service", "args", "kwargs")
 
 
 class ObservationSubscriptionMessage(SubscriptionMessage):
@@ -292,8 +373,6 @@ class ObservationSubscriptionMessage(SubscriptionMessage):
     This class describes a subscription to the observation process
     It is built on the SubscriptionMessage class
     """
-    def __init__(self, params):
-        super(ObservationSubscriptionMessage, self).__init__(params)
 
 
 class CollisionSubscriptionMessage(ObservationSubscriptionMessage):
@@ -301,8 +380,6 @@ class CollisionSubscriptionMessage(ObservationSubscriptionMessage):
     This class describes a subscription to collision events to the observation process
     It is built on the ObservationSubscriptionMessage class
     """
-    def __init__(self, params):
-        super(CollisionSubscriptionMessage, self).__init__(params)
 
 
 class ArucoEncounterSubscriptionMessage(ObservationSubscriptionMessage):
@@ -313,18 +390,7 @@ class ArucoEncounterSubscriptionMessage(ObservationSubscriptionMessage):
     specifying the aruco codes whose encounter should be signaled to the subscriber
     if the list is empty, every code will be signaled to the subscriber
     """
-    def __init__(self, params):
-        super(ArucoEncounterSubscriptionMessage, self).__init__(params)
-        self.target_codes = params["target_codes"]
-
-    @staticmethod
-    def get_my_required_params():
-        """
-        This static method retrieves the required params of only the current class
-        :return:
-        A set of required params
-        """
-        return {"target_codes"}
+    FIELDS = ("target_codes",)
 
 
 class PositionChangeSubscriptionMessage(ObservationSubscriptionMessage):
@@ -332,18 +398,7 @@ class PositionChangeSubscriptionMessage(ObservationSubscriptionMessage):
     This class describes a subscription to position change events to the observation process
     It is built on the ObservationSubscriptionMessage class
     """
-    def __init__(self, params):
-        super(PositionChangeSubscriptionMessage, self).__init__(params)
-        self.step = params["step"]
-
-    @staticmethod
-    def get_my_required_params():
-        """
-        This static method retrieves the required params of only the current class
-        :return:
-        A set of required params
-        """
-        return {"step"}
+    FIELDS = ("step",)
 
 
 class InformationMessage(Message):
@@ -351,16 +406,14 @@ class InformationMessage(Message):
     This class describes an information message
     It is built on the Message class
     """
-    def __init__(self, params):
-        super(InformationMessage, self).__init__(params)
-        self.linked_to = params["linked_to"]
-        self.data = params["data"]
+    FIELDS = ("linked_to", "data")
 
-    @staticmethod
-    def get_my_required_params():
-        """
-        This static method retrieves the required params of only the current class
-        :return:
-        A set of required params
-        """
-        return {"linked_to", "data"}
\ No newline at end of file
+
+class ChunkMessage(Message):
+    """
+    This class describes a part of a streamed reply (see the "stream" reply method)
+    It is built on the Message class and adds the linked_to, data, chunk and last attributes
+    The chunk attribute is the number of the chunk, starting at 0
+    The last chunk of a stream has its last attribute set to True (and carries no data)
+    """
+    FIELDS = ("linked_to", "data", "chunk", "last")
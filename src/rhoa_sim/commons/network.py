@@ -4,42 +4,68 @@
 Asynchronous multi-threaded server over TCP. Uses a pool of threads to handle requests.
 """
 import future
-import sys
+import collections
+import math
 import threading
 import queue
+import select
+import socket
 import socketserver
 import struct
-import json
+import time
 
-from commons.utils import LoggerConfigurator, MessageIDGenerator, CustomJSONEncoder
-from commons.messages import Message, InformationMessage
+from commons.utils import LoggerConfigurator, MessageIDGenerator, ResultSerializer
+from commons.messages import Message, InformationMessage, ChunkMessage
+from commons.serialization import CODECS, DEFAULT_CODEC, find_codec, get_codec
+
+try:
+    import selectors
+except ImportError:
+    # Python 2: use the selectors2 backport if it is installed, or the select-based selector
+    try:
+        import selectors2 as selectors
+    except ImportError:
+        selectors = None
 
 
 class TCPRequestHandler(socketserver.BaseRequestHandler):
     """
-    A simple Handler for the ThreadPoolTCPServer. It just adds the request to the queue provided by
-    the server.
+    A simple Handler for the ThreadPoolTCPServer. It just gives the new connection to the
+    connection monitor of the server.
     """
 
     def handle(self):
         """
         This method is called when a new request has arrived and the server wants to treat it. In
-        this case, it adds the request to the queue.
+        this case, the connection is watched by the server's connection monitor, which will put
+        its messages into the queue (so that no consumer blocks on a silent connection).
         """
-        self.server.queue.put(self.request)
+        self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.server.monitor.watch(Connection(self.request))
 
 
 class ThreadPoolTCPServer(socketserver.TCPServer):
     """
     This subclass of :class:`socketserver.TCPServer` is relying on a queue. The server is acting
     like a producer, providing the requests. On the other side of the queue, consumers should
-    consume the requests. Because of this behaviour, the user is responsible to properly handle
-    the request (which is a :class:`socket.socket` object). Remember that you need to close the
-    request manually. You can access to the currently used Queue through the `queue` attribute
+    consume the requests. You can access to the currently used Queue through the `queue`
+    attribute.
+
+    Connections are kept open between messages: they are read by the `monitor` (a
+    :class:`ConnectionMonitor`), which puts a :class:`Request` into the queue for each received
+    message. This way, a client can send many messages over one connection. Consumers should not
+    close connections, the monitor closes them once the peer has closed its side.
+
+    If the queue is a :class:`RequestQueue`, its overload policy is applied when it is full.
+
+    New connections are also accepted by the monitor, so that :meth:`shutdown` doesn't wait
+    for a polling loop. The address can be reused as soon as the server is closed.
     """
 
+    allow_reuse_address = True
+
     def __init__(self, server_address, handler=TCPRequestHandler,
-                 bind_and_activate=True, _queue=None):
+                 bind_and_activate=True, _queue=None, logger=None):
         """
         Creates a new ThreadPoolTCPServer.
 
@@ -55,7 +81,35 @@ class ThreadPoolTCPServer(socketserver.TCPServer):
             handler,
             bind_and_activate
         )
-        self.queue = queue.Queue() if _queue is None else _queue
+        self.queue = RequestQueue() if _queue is None else _queue
+        self.monitor = ConnectionMonitor(self.queue, logger)
+
+    def serve_forever(self, poll_interval=None):
+        """
+        Overridden method, the connection monitor accepts new connections. Block until
+        :meth:`shutdown` is called.
+
+        :param poll_interval: unused, there is no polling
+        """
+        self.monitor.listen(self)
+        self.monitor.start()
+        self.monitor.join()
+
+    def shutdown(self):
+        """
+        Overridden method, stop the connection monitor: connections are not read anymore, but
+        they stay open (consumers can still reply) until :meth:`server_close` is called.
+        """
+        self.monitor.stop_soon()
+        if self.monitor.is_alive():
+            self.monitor.join()
+
+    def server_close(self):
+        """
+        Overridden method, also close kept-alive connections.
+        """
+        socketserver.TCPServer.server_close(self)
+        self.monitor.close()
 
     def process_request(self, request, client_address):
         """
@@ -69,13 +123,368 @@ class ThreadPoolTCPServer(socketserver.TCPServer):
             self.shutdown_request(request)
 
 
+class RequestQueue(queue.Queue):
+    """
+    A queue of :class:`Request` objects, which may be bounded. When a bounded queue is full, new
+    requests are handled according to the overload policy:
+
+        * "block": the producer waits until there is room in the queue. As the connection monitor
+            stops reading sockets, clients are slowed down by TCP itself.
+        * "reject": the new request is refused, the client receives an error reply.
+        * "drop_oldest": the oldest queued request calling one of the droppable services (a stale
+            position update, for example) is refused to make room for the new one. If there is
+            none, the new request is rejected.
+
+    Refused requests are returned by :meth:`offer`, it is up to the producer to inform clients.
+    Counters are available through :meth:`stats`.
+    """
+
+    POLICIES = ("block", "reject", "drop_oldest")
+
+    def __init__(self, maxsize=0, policy="block", droppable_services=()):
+        """
+        Create a new RequestQueue.
+
+        :param maxsize: the maximum number of waiting requests (0 means infinite)
+        :param policy: the overload policy, one of `RequestQueue.POLICIES`
+        :param droppable_services: names of the services whose requests may be dropped by the
+                                   "drop_oldest" policy
+        """
+        if policy not in RequestQueue.POLICIES:
+            raise ValueError("Unknown overload policy {}".format(policy))
+
+        queue.Queue.__init__(self, maxsize)
+        self.policy = policy
+        self._droppable_services = frozenset(droppable_services)
+        self._accepted = 0
+        self._rejected = 0
+        self._dropped = 0
+
+    def offer(self, request):
+        """
+        Put a request into the queue, applying the overload policy if the queue is full.
+
+        :param request: a :class:`Request`
+        :return: the refused request (the provided one if rejected, an older one if dropped), or
+                 None
+        """
+        if self.maxsize <= 0 or self.policy == "block":
+            self.put(request)
+            with self.mutex:
+                self._accepted += 1
+            return None
+
+        with self.not_full:
+            if self._qsize() < self.maxsize:
+                self._push(request)
+                return None
+
+            if self.policy == "drop_oldest":
+                for index, queued in enumerate(self.queue):
+                    if self._is_droppable(queued):
+                        del self.queue[index]
+                        self.unfinished_tasks -= 1
+                        self._dropped += 1
+                        self._push(request)
+                        return queued
+
+            self._rejected += 1
+            return request
+
+    def stats(self):
+        """
+        Get the current state of the queue.
+
+        :return: a dictionary with the depth of the queue, its maximum size, and the number of
+                 accepted, rejected and dropped requests
+        """
+        with self.mutex:
+            return {
+                "depth": self._qsize(),
+                "max_size": self.maxsize,
+                "policy": self.policy,
+                "accepted": self._accepted,
+                "rejected": self._rejected,
+                "dropped": self._dropped
+            }
+
+    def _push(self, request):
+        """
+        Put a request without waiting. The mutex must be held.
+        """
+        self._put(request)
+        self.unfinished_tasks += 1
+        self._accepted += 1
+        self.not_empty.notify()
+
+    def _is_droppable(self, request):
+        """
+        Check if a queued request calls one of the droppable services.
+        """
+        try:
+            return getattr(request.message, "service", None) in self._droppable_services
+        except Exception:
+            return False  # Can't be parsed, a worker will report it
+
+
+class SelectSelector(object):
+    """
+    A minimal replacement for :class:`selectors.SelectSelector`, used on Python 2 when the
+    `selectors2` package is not installed. It only supports what the :class:`ConnectionMonitor`
+    needs: watching file objects for reading.
+    """
+
+    EVENT_READ = 1
+
+    Key = collections.namedtuple("Key", ("fileobj", "fd", "events", "data"))
+
+    def __init__(self):
+        self._keys = {}
+
+    def register(self, fileobj, events, data=None):
+        fd = self._fileno(fileobj)
+        if fd < 0:
+            raise ValueError("Invalid file descriptor {}".format(fd))
+        if fd in self._keys:
+            raise KeyError("{} is already registered".format(fileobj))
+        key = self._keys[fd] = SelectSelector.Key(fileobj, fd, events, data)
+        return key
+
+    def unregister(self, fileobj):
+        for fd, key in list(self._keys.items()):
+            if key.fileobj is fileobj:
+                return self._keys.pop(fd)
+        raise KeyError("{} is not registered".format(fileobj))
+
+    def select(self, timeout=None):
+        try:
+            readable, _, _ = select.select(list(self._keys), [], [], timeout)
+        except (select.error, OSError, ValueError):
+            # A watched file object has been closed, drop it
+            for fd, key in list(self._keys.items()):
+                if self._fileno(key.fileobj) < 0:
+                    del self._keys[fd]
+            return []
+        return [(self._keys[fd], SelectSelector.EVENT_READ) for fd in readable
+                if fd in self._keys]
+
+    def get_map(self):
+        return dict(self._keys)
+
+    def close(self):
+        self._keys = {}
+
+    @staticmethod
+    def _fileno(fileobj):
+        """
+        Get the file descriptor of a file object, -1 if it is closed.
+        """
+        try:
+            return fileobj.fileno()
+        except (socket.error, ValueError):
+            return -1
+
+
+if selectors is None:
+    DefaultSelector, EVENT_READ = SelectSelector, SelectSelector.EVENT_READ
+else:
+    DefaultSelector, EVENT_READ = selectors.DefaultSelector, selectors.EVENT_READ
+
+
+class ConnectionMonitor(threading.Thread):
+    """
+    The ConnectionMonitor is reading every connection of a server, without blocking on any of
+    them. Each time a whole message has been received on a connection, a :class:`Request` is put
+    into the queue, so that a consumer can handle it. Use :meth:`watch` to give it a connection.
+
+    If the queue is a :class:`RequestQueue`, refused requests receive an error reply (an
+    :class:`InformationMessage` linked to them).
+    """
+
+    def __init__(self, _queue, logger=None):
+        """
+        Create a new ConnectionMonitor feeding the provided queue.
+
+        :param _queue: the queue where requests will be put
+        """
+        super(ConnectionMonitor, self).__init__()
+        self.daemon = True
+        self._queue = _queue
+        self._logger = logger
+        self._stop_flag = False
+        self._pending = []
+        self._lock = threading.Lock()
+        self._selector = DefaultSelector()
+
+        # Used to wake up the monitor when a connection needs to be watched or when stopping
+        self._wake_reader, self._wake_writer = socket.socketpair()
+        self._wake_reader.setblocking(False)
+        self._selector.register(self._wake_reader, EVENT_READ)
+
+    def listen(self, server):
+        """
+        Accept the new connections of the provided server (through its
+        `_handle_request_noblock` method). Must be called before the monitor is started.
+
+        :param server: a :class:`socketserver.TCPServer`
+        """
+        self._selector.register(server.socket, EVENT_READ, server)
+
+    def watch(self, connection):
+        """
+        Watch the provided connection until the peer closes it. Can be called from any thread.
+
+        :param connection: a :class:`Connection`
+        """
+        connection.monitor = self
+        self._schedule(True, connection)
+
+    def forget(self, connection):
+        """
+        Stop watching the provided connection. Can be called from any thread.
+
+        :param connection: a :class:`Connection`
+        """
+        self._schedule(False, connection)
+
+    def run(self):
+        """
+        Read connections until the stop flag is set. Watched connections stay open until
+        :meth:`close` is called.
+        """
+        while not self._stop_flag:
+            for key, _ in self._selector.select():
+                if key.fileobj is self._wake_reader:
+                    self._apply_pending()
+                elif key.data is not None:
+                    key.data._handle_request_noblock()
+                else:
+                    self._read(key.fileobj)
+
+    def stop_soon(self):
+        """
+        Stop the monitor. You should call join after.
+        """
+        self._stop_flag = True
+        self._wake_up()
+
+    def _read(self, connection):
+        """
+        Read the bytes available on a readable connection, and queue every whole message.
+        """
+        try:
+            connection.receiver.receive_available()
+            while connection.receiver.has_frame():
+                self._dispatch(Request(connection, connection.receiver.receive_frame()))
+        except (ConnectionClosed, socket.error):
+            self._unregister(connection)
+            connection.socket.close()
+
+    def _dispatch(self, request):
+        """
+        Queue a request, and reply to the refused one if the queue is full.
+        """
+        if not isinstance(self._queue, RequestQueue):
+            self._queue.put(request)
+            return
+
+        refused = self._queue.offer(request)
+        if refused is None:
+            return
+
+        if self._logger is not None:
+            self._logger.warning("ConnectionMonitor : queue is full, refusing {}".format(
+                refused.connection
+            ))
+
+        try:
+            Sender(refused.connection, self._logger).send({
+                "id": MessageIDGenerator.get_new_message_id(),
+                "receiver": refused.connection.getpeername(),
+                "linked_to": refused.message.id,
+                "data": "Request refused, the server is overloaded"
+            })
+        except Exception as e:
+            if self._logger is not None:
+                self._logger.debug("ConnectionMonitor : can't reply ({})".format(e))
+
+    def _schedule(self, watch, connection):
+        """
+        Ask the monitor thread to (un)register a connection.
+        """
+        with self._lock:
+            self._pending.append((watch, connection))
+        self._wake_up()
+
+    def _wake_up(self):
+        """
+        Interrupt the current select call.
+        """
+        try:
+            self._wake_writer.send(b"\0")
+        except socket.error:
+            pass  # The buffer is full, the monitor will wake up anyway
+
+    def _apply_pending(self):
+        """
+        (Un)register connections given by :meth:`watch` and :meth:`forget` since the last wake
+        up, in order.
+        """
+        try:
+            while self._wake_reader.recv(1024):
+                pass
+        except socket.error:
+            pass
+
+        with self._lock:
+            pending, self._pending = self._pending, []
+
+        for watch, connection in pending:
+            if not watch:
+                self._unregister(connection)
+                continue
+
+            try:
+                self._selector.register(connection, EVENT_READ)
+            except (KeyError, ValueError, OSError):
+                # Already watched, or closed in the meantime
+                if self._logger is not None:
+                    self._logger.debug("ConnectionMonitor : can't watch {}".format(connection))
+
+    def _unregister(self, connection):
+        """
+        Stop watching a connection, if it is watched.
+        """
+        try:
+            self._selector.unregister(connection)
+        except (KeyError, ValueError):
+            pass
+
+    def close(self):
+        """
+        Close every watched connection and the internal wake up sockets (the listening socket is
+        closed by its server). Call it once the monitor is stopped.
+        """
+        for key in list(self._selector.get_map().values()):
+            if key.data is None:
+                key.fileobj.close()
+        self._selector.close()
+        self._wake_writer.close()
+
+
 class Worker(threading.Thread):
     """
     A `Worker` is designed to act like a consumer. Each `Worker` is running on its own thread.
     Subclasses should override the `work` method.
     As a thread, you have to call the `run` method to start the **Worker**.
+
+    A Worker waits for items without any timeout: it is stopped by a sentinel (`Worker.STOP`)
+    put into its queue, see :meth:`stop_soon`.
     """
 
+    # Put into a queue, it stops the first worker getting it
+    STOP = object()
+
     def __init__(self, _queue, logger=None):
         """
         Creates a new Worker with the provided :class:`Queue`
@@ -87,6 +496,11 @@ class Worker(threading.Thread):
         self._stop_flag = False
         self._logger = logger
 
+        # Activity, read by a WorkerPool
+        self.busy_since = None
+        self.handled = 0
+        self.busy_time = 0.0
+
     def work(self, item):
         """
         The work that will be done.
@@ -95,26 +509,29 @@ class Worker(threading.Thread):
         """
         pass
 
-    def run(self, blocking=True, timeout=1):
+    def run(self):
         """
         Overrides the `run` method from the :class:`Thread` class. The **Worker** is running
-        until the stop flag is set (done through the `stop_soon` method).
-        If an unexpected error occurs while executing the
-
-        :param blocking: see :meth:`Queue.get`
-        :param timeout:  see :meth:`Queue.get`
+        until it gets the `Worker.STOP` sentinel (see :meth:`stop_soon`). Once the stop flag is
+        set, items are discarded instead of being handled.
         """
-        while not self._stop_flag:
-            try:
-                item = self._queue.get(block=blocking, timeout=timeout)
-            except queue.Empty:
-                continue  # Loop until the stop flag is set
+        while True:
+            item = self._queue.get()
+            if item is Worker.STOP or self._stop_flag:
+                self._queue.task_done()
+                if item is Worker.STOP:
+                    break
+                continue
 
+            self.busy_since = time.time()
             try:
                 self.work(item)
             except Exception as e:
                 self.handle_error(e, item)
             finally:
+                self.handled += 1
+                self.busy_time += time.time() - self.busy_since
+                self.busy_since = None
                 self._queue.task_done()
 
         if self._logger is not None:
@@ -123,14 +540,34 @@ class Worker(threading.Thread):
                 threading.current_thread()
             ))
 
-    def stop_soon(self):
+    def stop_soon(self, drain=False):
         """
-        Stop the thread as soon as possible. It depends on the timeout from the run method and
-        the time it takes to do the job.
+        Stop the thread as soon as possible: the worker finishes its current item, and the next
+        items of the queue are discarded. With `drain`, the items already waiting in the queue
+        are handled first.
         Calling stop_soon is not enough to ensure the thread is dead, you should also call join
         after.
+
+        The sentinel stopping the thread is taken by the first worker waiting on the queue: if
+        several workers share the queue, stop all of them (or use a :class:`WorkerPool`).
+
+        :param drain: if True, waiting items are handled before stopping
         """
-        self._stop_flag = True
+        if not drain:
+            self._stop_flag = True
+        Worker.put_stop(self._queue)
+
+    @staticmethod
+    def put_stop(_queue):
+        """
+        Put the `Worker.STOP` sentinel into a queue, even if the queue is full.
+
+        :param _queue: a :class:`queue.Queue`
+        """
+        with _queue.mutex:
+            _queue._put(Worker.STOP)
+            _queue.unfinished_tasks += 1
+            _queue.not_empty.notify()
 
     def handle_error(self, error, item):
         """
@@ -143,6 +580,255 @@ class Worker(threading.Thread):
         raise error
 
 
+class WorkerPool(object):
+    """
+    A pool of :class:`Worker` objects consuming the same queue, whose size changes with the load.
+    Every `interval` seconds, the pool checks its queue:
+
+        * if items are waiting while every worker is busy, workers are added: enough of them to
+            handle the waiting items within one interval (according to the average handling time
+            observed), at least one.
+        * if workers have been idle for `idle_delay` seconds while the queue is empty, one of them
+            is stopped (and then another one, `idle_delay` seconds later, and so on) by putting a
+            `Worker.STOP` sentinel into the queue.
+
+    The size of the pool always stays between `min_size` and `max_size` (workers which died
+    because of an error are replaced). Scaling decisions are logged, and metrics are available
+    through :meth:`stats`.::
+
+        pool = WorkerPool(my_queue, lambda: MyWorker(my_queue), min_size=2, max_size=10)
+        pool.start()
+        ...
+        # Handle the waiting items (for 5 seconds at most) and stop
+        pool.stop(drain=True, timeout=5)
+    """
+
+    def __init__(self, _queue, factory, min_size=1, max_size=None, logger=None, name=None,
+                 interval=1.0, idle_delay=10.0):
+        """
+        Create a new WorkerPool. Workers are created by the provided factory, they are started by
+        the pool.
+
+        :param _queue: the queue consumed by the workers
+        :param factory: a callable without parameters, returning a new :class:`Worker`
+        :param min_size: the minimum number of workers
+        :param max_size: the maximum number of workers (default is `min_size`, a fixed size)
+        :param name: the name used in logs
+        :param interval: the time between two scaling decisions (in seconds)
+        :param idle_delay: how long workers have to be idle before the pool shrinks (in seconds)
+        """
+        if max_size is None:
+            max_size = min_size
+        if not 0 < min_size <= max_size:
+            raise ValueError("Invalid pool size ({}, {})".format(min_size, max_size))
+
+        self.min_size = min_size
+        self.max_size = max_size
+        self.interval = interval
+        self.idle_delay = idle_delay
+        self.name = name or self.__class__.__name__
+        self._queue = _queue
+        self._factory = factory
+        self._logger = logger
+
+        self._lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._supervisor = threading.Thread(target=self._supervise)
+        self._supervisor.daemon = True
+        self._workers = []
+        self._retiring = 0  # Sentinels put into the queue by the pool to shrink
+        self._idle_since = None
+
+        # Metrics
+        self._handled = 0  # Items handled by retired workers
+        self._busy_time = 0.0
+        self._last_handled = 0
+        self._last_busy_time = 0.0
+        self._avg_handling_time = 0.0
+        self._grown = 0
+        self._shrunk = 0
+
+    @property
+    def size(self):
+        """
+        The current number of workers.
+        """
+        return len(self._workers) - self._retiring
+
+    def start(self):
+        """
+        Start `min_size` workers, and the thread replacing dead workers and scaling the pool.
+        """
+        with self._lock:
+            for _ in range(self.min_size):
+                self._add_worker()
+        self._supervisor.start()
+
+    def stop(self, drain=False, timeout=None):
+        """
+        Stop every worker, and wait for them. Call it once the producers are stopped.
+        Workers finish their current item, the items still waiting in the queue are discarded
+        unless `drain` is True.
+
+        :param drain: if True, waiting items are handled before stopping
+        :param timeout: when draining, the maximum number of seconds to wait for the queue to be
+                        drained (None means forever). Then, the remaining items are discarded.
+        """
+        self._stop_event.set()
+        if self._supervisor.is_alive():
+            self._supervisor.join()
+
+        with self._lock:
+            workers, self._workers = self._workers, []
+            sentinels = len(workers) - self._retiring
+            self._retiring = 0
+
+        if not drain:
+            for worker in workers:
+                worker._stop_flag = True
+        for _ in range(sentinels):
+            Worker.put_stop(self._queue)
+
+        deadline = None if timeout is None else time.time() + timeout
+        for worker in workers:
+            if not drain or deadline is None:
+                worker.join()
+                continue
+
+            worker.join(max(0, deadline - time.time()))
+            if worker.is_alive():
+                # Too late, discard what remains
+                self._log("drain timeout, discarding {} waiting items".format(
+                    self._queue.qsize()
+                ))
+                for late_worker in workers:
+                    late_worker._stop_flag = True
+                deadline = None
+                worker.join()
+
+    def stats(self):
+        """
+        Get metrics about the pool.
+
+        :return: a dictionary with the current size of the pool (and its bounds), the number of
+                 busy workers, the number of handled items, the average handling time (in
+                 seconds) and how many times workers have been added or stopped by the pool
+        """
+        with self._lock:
+            return {
+                "size": len(self._workers) - self._retiring,
+                "min_size": self.min_size,
+                "max_size": self.max_size,
+                "busy": sum(1 for worker in self._workers if worker.busy_since is not None),
+                "handled": self._handled + sum(worker.handled for worker in self._workers),
+                "avg_handling_time": self._avg_handling_time,
+                "grown": self._grown,
+                "shrunk": self._shrunk
+            }
+
+    def _supervise(self):
+        """
+        Replace dead workers and scale the pool (if its size may change) every `interval`
+        seconds, until it is stopped.
+        """
+        while not self._stop_event.wait(self.interval):
+            with self._lock:
+                if self.max_size > self.min_size:
+                    self._scale()
+                else:
+                    self._update()
+
+    def _scale(self):
+        """
+        Take a scaling decision. The lock must be held.
+        """
+        self._update()
+
+        depth = self._queue.qsize()
+        size = len(self._workers) - self._retiring
+        busy = sum(1 for worker in self._workers if worker.busy_since is not None)
+
+        if depth > 0 and busy >= size and size < self.max_size:
+            self._idle_since = None
+            needed = int(math.ceil(depth * self._avg_handling_time / self.interval))
+            count = min(self.max_size - size, max(1, needed))
+            for _ in range(count):
+                self._add_worker()
+            self._grown += count
+            self._log("{} waiting items, {:.3f}s per item, {} -> {} workers".format(
+                depth,
+                self._avg_handling_time,
+                size,
+                size + count
+            ))
+        elif depth == 0 and busy < size and size > self.min_size:
+            now = time.time()
+            if self._idle_since is None:
+                self._idle_since = now
+            elif now - self._idle_since >= self.idle_delay:
+                self._idle_since = now
+                self._retiring += 1
+                Worker.put_stop(self._queue)
+                self._shrunk += 1
+                self._log("workers are idle, {} -> {} workers".format(size, size - 1))
+        else:
+            self._idle_since = None
+
+    def _update(self):
+        """
+        Replace dead workers and update the average handling time. The lock must be held.
+        """
+        for worker in [worker for worker in self._workers if not worker.is_alive()]:
+            self._workers.remove(worker)
+            self._handled += worker.handled
+            self._busy_time += worker.busy_time
+            if self._retiring > 0:
+                self._retiring -= 1  # Stopped by the pool
+            else:
+                self._log("{} died".format(worker.name))
+        while len(self._workers) - self._retiring < self.min_size:
+            self._add_worker()
+
+        handled = self._handled + sum(worker.handled for worker in self._workers)
+        busy_time = self._busy_time + sum(worker.busy_time for worker in self._workers)
+        if handled > self._last_handled:
+            latest = (busy_time - self._last_busy_time) / (handled - self._last_handled)
+            if self._avg_handling_time:
+                self._avg_handling_time = (self._avg_handling_time + latest) / 2
+            else:
+                self._avg_handling_time = latest
+        self._last_handled = handled
+        self._last_busy_time = busy_time
+
+    def _add_worker(self):
+        """
+        Create and start a new worker. The lock must be held.
+        """
+        worker = self._factory()
+        worker.start()
+        self._workers.append(worker)
+
+    def _log(self, text):
+        if self._logger is not None:
+            self._logger.info("{} : {}".format(self.name, text))
+
+
+class ConnectionClosed(EOFError):
+    """
+    Raised by a :class:`Receiver` when the peer closed the connection before a new message
+    began.
+    """
+    pass
+
+
+class StreamError(Exception):
+    """
+    Raised while reading a streamed reply, when the receiver replied with an error instead of
+    the next chunk.
+    """
+    pass
+
+
 class Receiver(object):
     """
     A small object designed to receive a message to a provided socket and then parse it. To use
@@ -162,9 +848,16 @@ class Receiver(object):
         # You can access to the last parsed message
         msg = recv.last_msg
 
+    Bytes are received in an internal buffer, which is reused (and grown if needed) from one
+    message to the next. Bytes received after the end of a message are kept for the next one, so
+    you should use the same Receiver for every message of a connection.
+
+    The codec of each message is detected (see :mod:`commons.serialization`). The Receiver also
+    keeps track of the codecs the peer announced, in the `codecs` field of its messages.
     """
 
-    BUFFER_SIZE = 1024
+    BUFFER_SIZE = 4096
+    HEADER = struct.Struct("!I")
 
     def __init__(self, sock, logger=None):
         """
@@ -174,53 +867,265 @@ class Receiver(object):
         """
         self._sock = sock
         self._last_msg = None
+        self._last_codec = None
+        self._peer_codecs = []
         self._logger = logger
 
+        # Received bytes that haven't been read yet are buffer[start:end]
+        self._buffer = bytearray(Receiver.BUFFER_SIZE)
+        self._view = memoryview(self._buffer)
+        self._start = 0
+        self._end = 0
+
     @property
     def last_msg(self):
         return self._last_msg
 
-    def receive(self):
+    @property
+    def last_codec(self):
         """
-        Start receiving a message on the socket provided in the constructor. Might raise several
-        errors, like the ones raised by a wrong format in :meth:`struct.unpack`
+        The codec of the last received message (None if no message has been received yet).
+        """
+        return self._last_codec
 
-        :return: a message, which has a Message subclass type
+    @property
+    def peer_codecs(self):
+        """
+        The names of the codecs announced by the peer, by order of preference.
         """
-        msg = self._sock.recv(Receiver.BUFFER_SIZE)
+        return self._peer_codecs
 
-        # Find the size of the message and the remaining bytes
-        msg_len = len(msg)
+    def has_frame(self):
+        """
+        Check if a whole message has already been received (and not read yet).
+
+        :return: True if the next call to :meth:`receive` won't wait for the socket
+        """
+        available = self._end - self._start
+        if available < Receiver.HEADER.size:
+            return False
+        msg_len, = Receiver.HEADER.unpack_from(self._buffer, self._start)
+        return available >= Receiver.HEADER.size + msg_len
+
+    def receive_frame(self):
+        """
+        Receive the data of the next message, without parsing it. The expected format is :
+            | datalen |    data    |
+
+        *datalen* occupying 4 octets and *data* datalen octets.
+
+        :return: the data (bytes)
+        :raise: ConnectionClosed if the peer has closed the connection
+        """
+        self._fill(Receiver.HEADER.size)
+        msg_len, = Receiver.HEADER.unpack_from(self._buffer, self._start)
+
+        self._fill(Receiver.HEADER.size + msg_len)
+        begin = self._start + Receiver.HEADER.size
+        data = self._view[begin:begin + msg_len].tobytes()
+
+        self._start = begin + msg_len
+        if self._start == self._end:
+            self._start = self._end = 0
 
         if self._logger is not None:
-            self._logger.debug("Receiver : buffer size is {}".format(msg_len))
-            self._logger.debug("Receiver : message is {}".format(msg))
+            self._logger.debug("Receiver : message is {}".format(data))
 
-        msg_len, msg = struct.unpack(
-            "!I" + str(msg_len - 4) + "s",
-            msg
-        )
+        return data
+
+    def receive_available(self):
+        """
+        Receive the bytes available on the socket, with a single call: it only blocks if no byte
+        is available. Use :meth:`has_frame` to know if a whole message has been received.
+
+        :raise: ConnectionClosed if the peer has closed the connection
+        """
+        available = self._end - self._start
+        size = Receiver.HEADER.size
+        if available >= size:
+            size += Receiver.HEADER.unpack_from(self._buffer, self._start)[0]
+
+        # Make room at the end of the buffer (for the whole message, if its size is known)
+        size = max(size, available + 1)
+        if self._start + size > len(self._buffer):
+            self._reserve(size)
 
-        # Keep receiving until we reach the desired size
-        while len(msg) != msg_len:
-            msg += self._sock.recv(Receiver.BUFFER_SIZE)
+        received = self._sock.recv_into(self._view[self._end:])
+        if received == 0:
+            raise ConnectionClosed()
+        self._end += received
+
+    def receive(self):
+        """
+        Start receiving a message on the socket provided in the constructor. Might raise several
+        errors, like the ones raised by a wrong format in :meth:`json.loads`
+
+        :return: a message, which has a Message subclass type
+        :raise: ConnectionClosed if the peer has closed the connection
+        """
+        return self.parse(self.receive_frame())
+
+    def parse(self, data):
+        """
+        Parse the data of a message received by this Receiver (see :meth:`receive_frame`).
+
+        :param data: the data of a message
+        :return: a message, which has a Message subclass type
+        """
+        # Decode the message
+        codec = find_codec(data)
+        msg = codec.decode(data)
+        self._last_codec = codec
 
-        msg = msg.decode("ascii")
+        # Remember which codecs the peer is able to decode
+        codecs = msg.pop("codecs", None)
+        if codecs is not None:
+            self._peer_codecs = codecs
 
         # Parse the message
-        msg = json.loads(msg)
         self._last_msg = Message.parse_from_dict(msg)
 
         return self._last_msg
 
+    def _fill(self, size):
+        """
+        Receive bytes until at least `size` bytes are available in the buffer.
+
+        :param size: the number of bytes needed
+        :raise: ConnectionClosed if the peer closes the connection before
+        """
+        if self._end - self._start >= size:
+            return
+
+        # Make room at the end of the buffer
+        if self._start + size > len(self._buffer):
+            self._reserve(size)
+
+        while self._end - self._start < size:
+            received = self._sock.recv_into(self._view[self._end:])
+            if received == 0:
+                if self._end == self._start:
+                    raise ConnectionClosed()
+                raise ConnectionClosed("Connection closed in the middle of a message")
+            self._end += received
+
+    def _reserve(self, size):
+        """
+        Move unread bytes at the beginning of the buffer, and grow it so that it can hold at
+        least `size` bytes.
+
+        :param size: the number of bytes the buffer must be able to hold
+        """
+        available = self._end - self._start
+        if size > len(self._buffer):
+            capacity = len(self._buffer)
+            while capacity < size:
+                capacity *= 2
+            buffer = bytearray(capacity)
+            buffer[:available] = self._view[self._start:self._end]
+            self._view = None  # Python 2 memoryviews have no release method
+            self._buffer = buffer
+            self._view = memoryview(self._buffer)
+        else:
+            self._buffer[:available] = self._buffer[self._start:self._end]
+        self._start = 0
+        self._end = available
+
+
+class Connection(object):
+    """
+    A connected socket and the :class:`Receiver` reading it. A Connection can be used like the
+    underlying socket (every socket method is available), so you can give it to a
+    :class:`Sender` or call `getpeername` on it. A :class:`Sender` will use the codec of the
+    connection, negotiated with the peer.
+
+    Several threads may reply through the same Connection: data given to :meth:`sendall` is
+    never interleaved.
+    """
+
+    def __init__(self, sock, logger=None):
+        """
+        Wrap the provided socket.
+
+        :param sock: a connected socket
+        """
+        self.socket = sock
+        self.receiver = Receiver(sock, logger)
+        self.monitor = None
+        self._send_lock = threading.Lock()
+
+    def sendall(self, data):
+        """
+        Send data through the socket, see :meth:`socket.sendall`. Can be called from any thread.
+        """
+        with self._send_lock:
+            self.socket.sendall(data)
+
+    def close(self):
+        """
+        Close the socket (the monitor watching it, if any, forgets it).
+        """
+        if self.monitor is not None:
+            self.monitor.forget(self)
+        self.socket.close()
+
+    @property
+    def codec(self):
+        """
+        The codec used to reply: the preferred one among the codecs announced by the peer,
+        otherwise the codec of its last message.
+        """
+        for name in self.receiver.peer_codecs:
+            if name in CODECS:
+                return CODECS[name]
+        return self.receiver.last_codec or DEFAULT_CODEC
+
+    def __getattr__(self, name):
+        return getattr(self.socket, name)
+
+    def __repr__(self):
+        return "Connection({})".format(self.socket)
+
+
+class Request(object):
+    """
+    A message received on a :class:`Connection`, waiting to be handled. The message is parsed
+    the first time it is needed.
+    """
+
+    __slots__ = ("connection", "data", "_message")
+
+    def __init__(self, connection, data):
+        """
+        Create a new Request.
+
+        :param connection: the connection where the message has been received
+        :param data: the data of the message
+        """
+        self.connection = connection
+        self.data = data
+        self._message = None
+
+    @property
+    def message(self):
+        """
+        The parsed message (see :meth:`Receiver.parse`).
+        """
+        if self._message is None:
+            self._message = self.connection.receiver.parse(self.data)
+        return self._message
+
+    def __repr__(self):
+        return "Request({})".format(self.connection)
+
 
 class Sender(object):
     """
     This small object is designed to send a message through a provided socket. To use it,
     first create a new object with the socket you want to write. Then, call :meth:`send`.
-    The sender field will be properly positioned to the socket address. The Sender object store
-    the last sent message, you can access to it be using the read-only property
-    `last_msg`.::
+    The sender field of the sent data will be properly positioned to the socket address. The
+    Sender object store the last sent message, you can access to it be using the read-only
+    property `last_msg`.::
 
         with socket.create_connection(my_message.receiver) as sock:
             # Create the sender
@@ -235,72 +1140,90 @@ class Sender(object):
             # You can access to the last sent message
             msg = sender.last_msg
 
+    Messages are encoded with the provided codec. By default, the Sender uses the codec of the
+    socket if it is a :class:`Connection`, JSON otherwise.
     """
 
-    def __init__(self, sock, logger=None):
+    def __init__(self, sock, logger=None, codec=None):
         """
         Create a new Sender object with the provided socket.
 
         :param sock: the socket you want to write on
+        :param codec: the codec used to encode messages (see :mod:`commons.serialization`)
         """
         self._sock = sock
         self._last_msg = None
-        self._logger = None
+        self._logger = logger
+        self._codec = codec if codec is not None else getattr(sock, "codec", DEFAULT_CODEC)
 
     @property
     def last_msg(self):
-        return self.last_msg
+        return self._last_msg
 
-    def send(self, msg):
+    def send(self, msg, codecs=None):
         """
-        Send a message through the socket provided to the constructor. This method is setting the
-        sender field to the socket address.
+        Send a message through the socket provided to the constructor. The sent data has its
+        sender field set to the socket address (the message itself is left untouched).
 
         :param msg: the message you want to send (either a dict or a Message instance)
+        :param codecs: if provided, a list of codec names announced to the peer (it will be
+                       able to reply with one of them)
         """
         # Keep in memory the last message
         self._last_msg = msg
 
         addr, port = self._sock.getsockname()
 
-        # Pack data into a buffer
-        if isinstance(msg, dict):
-            # Set the sender address to the current socket address and dump the message
-            msg["sender"] = (addr, port)
-            data = json.dumps(msg, cls=CustomJSONEncoder)
-        else:
-            # Set the sender address to the current socket address and dump the message
-            msg.sender = (addr, port)
-            data = json.dumps(msg.to_dict(), cls=CustomJSONEncoder)
+        # Encode the message with the sender address set to the current socket address (the
+        # message itself is not modified) and prefix it with its length
+        data = self._codec.encode_message(msg, (addr, port), codecs)
 
         if self._logger is not None:
             self._logger.debug("Sender : message is {}".format(data))
 
-        # Pack the data into a buffer
-        l_data = len(data)
+        # Send data
+        self._sock.sendall(Receiver.HEADER.pack(len(data)) + data)
 
-        if sys.version_info >= (3,):  # In python3 must be a bytearray
-            msg = struct.pack("!I" + str(l_data) + "s", l_data, bytearray(data, "ascii"))
-        else:
-            msg = struct.pack("!I" + str(l_data) + "s", l_data, data)
+    def send_stream(self, linked_to, chunks):
+        """
+        Send a reply as a sequence of :class:`ChunkMessage`, followed by a last, empty, chunk.
+        Chunks are consumed one at a time, so a lazy iterable (for example,
+        :meth:`DBService.stream`) is never fully in memory.::
 
-        if self._logger is not None:
-            self._logger.debug("Sender : buffer is {}".format(msg))
+            Sender(request).send_stream(message.id, service.stream(**message.kwargs))
 
-        # Send data
-        self._sock.sendall(msg)
+        :param linked_to: the id of the message the stream replies to
+        :param chunks: an iterable of lists
+        """
+        receiver = self._sock.getpeername()
+        number = 0
+        for chunk in chunks:
+            self.send({
+                "id": MessageIDGenerator.get_new_message_id(),
+                "receiver": receiver,
+                "linked_to": linked_to,
+                "data": ResultSerializer.to_plain(list(chunk)),
+                "chunk": number,
+                "last": False
+            })
+            number += 1
+
+        self.send({
+            "id": MessageIDGenerator.get_new_message_id(),
+            "receiver": receiver,
+            "linked_to": linked_to,
+            "data": [],
+            "chunk": number,
+            "last": True
+        })
 
 
 class MessageWorker(Worker):
     """
-    This :class:`Worker` is consuming TCP requests. The expected message format is :
-        | datalen |    data    |
-
-    *datalen* occupying 4 octets and *data* datalen octets.
+    This :class:`Worker` is consuming :class:`Request` objects, provided by the connection
+    monitor of a :class:`ThreadPoolTCPServer`.
     """
 
-    BUFFER_SIZE = 1024
-
     def __init__(self, _queue, handler_store, logger=None):
         """
         Create a new MessageWorker. In addition of the required parameter `_queue`, you need to
@@ -319,19 +1242,19 @@ class MessageWorker(Worker):
     def work(self, request):
         """
         Do the work. First, it parses the message. Then, according to the message type, it calls
-        the class-level handler. Then, the request is closed.
+        the class-level handler. The connection stays open, watched by the monitor until the
+        next message arrives.
 
         :param request: the request the Worker has to handle
         """
+        connection = request.connection
 
         if self._logger is not None:
             self._logger.info("MessageWorker : Handle request from {}".format(
-                request.getpeername()
+                connection.getpeername()
             ))
 
-        # Receive the message
-        receiver = Receiver(request, self._logger)
-        parsed_message = receiver.receive()
+        parsed_message = request.message
 
         if self._logger is not None:
             self._logger.debug("MessageWorker : {}".format(parsed_message))
@@ -342,7 +1265,7 @@ class MessageWorker(Worker):
         # Handle the message (class-level handler)
         parsed_message.handle(
             message=parsed_message,
-            request=request
+            request=connection
         )
 
         # Handle the message (id specific)
@@ -351,9 +1274,8 @@ class MessageWorker(Worker):
             for handler in self._handler_store.get_handlers_for(parsed_message.linked_to):
                 handler(parsed_message)
 
-        # Close the connection and reset current message
+        # Reset current message
         self._msg = None
-        request.close()
 
     def handle_error(self, error, request):
         """
@@ -364,19 +1286,411 @@ class MessageWorker(Worker):
         :param request: the original request
         """
         if self._msg is None:
-            request.close()
+            request.connection.close()
             raise error
 
-        msg = {
-            "id": MessageIDGenerator.get_new_message_id(),
-            "receiver": request.getpeername(),
-            "linked_to": self._msg.id,
-            "data": str(error)
-        }
-
         if self._logger is not None:
             self._logger.warn("MessageWorker : {}".format(error))
 
-        sender = Sender(request, self._logger)
-        sender.send(msg)
-        request.close()
+        try:
+            sender = Sender(request.connection, self._logger)
+            sender.send({
+                "id": MessageIDGenerator.get_new_message_id(),
+                "receiver": request.connection.getpeername(),
+                "linked_to": self._msg.id,
+                "data": str(error)
+            })
+        except socket.error as e:
+            if self._logger is not None:
+                self._logger.warn("MessageWorker : can't report the error ({})".format(e))
+        self._msg = None
+
+
+class PendingReply(object):
+    """
+    A reply that hasn't been received yet. The thread waiting for it calls :meth:`wait`,
+    while the connection reading replies calls either :meth:`set` or :meth:`fail`.
+    """
+
+    def __init__(self):
+        self._event = threading.Event()
+        self._reply = None
+        self._error = None
+
+    def is_complete(self, reply):
+        """
+        Check if no other reply is expected after the provided one.
+
+        :param reply: a received message
+        """
+        return True
+
+    def set(self, reply):
+        """
+        Set the reply and wake up the waiting thread.
+
+        :param reply: the received message
+        """
+        self._reply = reply
+        self._event.set()
+
+    def fail(self, error):
+        """
+        The reply will never arrive, wake up the waiting thread with the provided error.
+
+        :param error: the error that will be raised by :meth:`wait`
+        """
+        self._error = error
+        self._event.set()
+
+    def wait(self, timeout=None):
+        """
+        Block until the reply is received.
+
+        :param timeout: a number of seconds, None means no timeout
+        :return: the reply
+        :raise: socket.timeout if the reply didn't arrive in time, or the error given to
+                :meth:`fail`
+        """
+        if not self._event.wait(timeout):
+            raise socket.timeout("No reply received after {} seconds".format(timeout))
+        if self._error is not None:
+            raise self._error
+        return self._reply
+
+
+class PendingStream(PendingReply):
+    """
+    A streamed reply, made of :class:`ChunkMessage`. The connection reading replies adds the
+    chunks as they arrive, while the waiting thread iterates over them with :meth:`chunks`. At
+    most `max_chunks` chunks are kept: the reading connection waits for the consumer beyond,
+    so the memory used by a stream is bounded by the size of its chunks.
+    """
+
+    DEFAULT_MAX_CHUNKS = 8
+
+    def __init__(self, max_chunks=DEFAULT_MAX_CHUNKS):
+        super(PendingStream, self).__init__()
+        self.max_chunks = max_chunks
+        self._chunks = collections.deque()
+        self._condition = threading.Condition()
+        self._discarded = False
+
+    def is_complete(self, reply):
+        return not isinstance(reply, ChunkMessage) or reply.last
+
+    def set(self, reply):
+        """
+        Add a chunk, waiting for the consumer if too many chunks are waiting.
+
+        :param reply: the received message
+        """
+        with self._condition:
+            while len(self._chunks) >= self.max_chunks and not self._discarded:
+                self._condition.wait()
+            if not self._discarded:
+                self._chunks.append(reply)
+                self._condition.notify_all()
+
+    def fail(self, error):
+        with self._condition:
+            self._error = error
+            self._condition.notify_all()
+
+    def discard(self):
+        """
+        The consumer stopped reading, drop the chunks.
+        """
+        with self._condition:
+            self._discarded = True
+            self._chunks.clear()
+            self._condition.notify_all()
+
+    def chunks(self, timeout=None):
+        """
+        Iterate over the chunks, until the last one.
+
+        :param timeout: the maximum number of seconds to wait for each chunk
+        :return: an iterator of :class:`ChunkMessage`
+        :raise: socket.timeout if a chunk didn't arrive in time, StreamError if the receiver
+                replied with an error, or the error given to :meth:`fail`
+        """
+        while True:
+            with self._condition:
+                deadline = None if timeout is None else time.time() + timeout
+                while not self._chunks and self._error is None:
+                    remaining = None if deadline is None else deadline - time.time()
+                    if remaining is not None and remaining <= 0:
+                        raise socket.timeout(
+                            "No chunk received after {} seconds".format(timeout)
+                        )
+                    self._condition.wait(remaining)
+                if not self._chunks:
+                    raise self._error
+                reply = self._chunks.popleft()
+                self._condition.notify_all()
+
+            if not isinstance(reply, ChunkMessage):
+                raise StreamError(getattr(reply, "data", reply))
+            if reply.last:
+                return
+            yield reply
+
+
+class PooledConnection(object):
+    """
+    A long-lived connection to a receiver, used by a :class:`ConnectionPool`. Many messages can
+    be in flight at the same time: a reading thread is receiving the replies and matches them
+    with the waiting requests thanks to their `linked_to` field.
+
+    Messages are sent in JSON until the receiver agrees to use the preferred codec: it is
+    announced with every message until a first reply arrives, and used if this reply is encoded
+    with it.
+    """
+
+    def __init__(self, address, logger=None, codec=DEFAULT_CODEC):
+        """
+        Open a new connection to the provided address.
+
+        :param address: a tuple (hostname, port)
+        :param codec: the preferred codec
+        """
+        self.address = address
+        self._logger = logger
+        self._codec = DEFAULT_CODEC
+        self._preferred_codec = codec
+        self._negotiated = codec is DEFAULT_CODEC
+        self._sock = socket.create_connection(address)
+        self._sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self._send_lock = threading.Lock()
+        self._pending = {}
+        self._pending_lock = threading.Lock()
+        self._alive = True
+
+        # Start reading replies
+        self._reader = threading.Thread(target=self._read_replies)
+        self._reader.daemon = True
+        self._reader.start()
+
+    @property
+    def alive(self):
+        return self._alive
+
+    @property
+    def in_flight(self):
+        """
+        The number of requests still waiting for their reply.
+        """
+        return len(self._pending)
+
+    def send(self, message, wait_reply=False, stream=False):
+        """
+        Send the message. Can be called by several threads at the same time.
+
+        :param message: a Message object
+        :param wait_reply: if True, a reply linked to this message is expected
+        :param stream: if True, a streamed reply linked to this message is expected
+        :return: a :class:`PendingReply` (a :class:`PendingStream` if `stream` is True) if a
+                 reply is expected, None otherwise
+        """
+        pending = None
+        if stream:
+            pending = PendingStream()
+        elif wait_reply:
+            pending = PendingReply()
+        if pending is not None:
+            with self._pending_lock:
+                self._pending[MessageIDGenerator.get_key(message.id)] = pending
+
+        try:
+            with self._send_lock:
+                Sender(self._sock, self._logger, self._codec).send(
+                    message,
+                    None if self._negotiated else [self._preferred_codec.NAME]
+                )
+        except Exception as e:
+            self.discard(message.id)
+            self.close(e)
+            raise
+
+        return pending
+
+    def discard(self, message_id):
+        """
+        Stop waiting for the reply to the provided message id (after a timeout for example).
+
+        :param message_id: the id of the sent message
+        """
+        with self._pending_lock:
+            pending = self._pending.pop(MessageIDGenerator.get_key(message_id), None)
+        if isinstance(pending, PendingStream):
+            pending.discard()
+
+    def close(self, error=None):
+        """
+        Close the connection. Requests still waiting for a reply will fail.
+
+        :param error: the error given to waiting requests
+        """
+        with self._pending_lock:
+            if not self._alive:
+                return
+            self._alive = False
+            pending, self._pending = list(self._pending.values()), {}
+
+        for reply in pending:
+            reply.fail(error if error is not None else ConnectionClosed(self.address))
+
+        try:
+            self._sock.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+        self._sock.close()
+
+        # Wait for the reader to stop (on Python 2, a daemon thread still running when the
+        # interpreter exits fails noisily)
+        if self._reader is not threading.current_thread():
+            self._reader.join(1.0)
+
+    def _read_replies(self):
+        """
+        Receive replies until the connection is closed. Replies that no one is waiting for are
+        dropped.
+        """
+        receiver = Receiver(self._sock, self._logger)
+        error = None
+        try:
+            while self._alive:
+                reply = receiver.receive()
+                if not self._negotiated:
+                    self._negotiated = True
+                    if receiver.last_codec is self._preferred_codec:
+                        self._codec = self._preferred_codec
+                key = MessageIDGenerator.get_key(getattr(reply, "linked_to", None))
+                with self._pending_lock:
+                    pending = self._pending.get(key)
+                    # Streams are waiting for more replies, until the last chunk
+                    if pending is not None and pending.is_complete(reply):
+                        del self._pending[key]
+                if pending is not None:
+                    pending.set(reply)
+                elif self._logger is not None:
+                    self._logger.debug("PooledConnection : unexpected reply {}".format(reply))
+        except Exception as e:
+            error = e
+            if self._alive and not isinstance(e, ConnectionClosed) and self._logger is not None:
+                self._logger.warn("PooledConnection : {}".format(e))
+        finally:
+            self.close(error)
+
+
+class ConnectionPool(object):
+    """
+    A ConnectionPool keeps connections to receivers open, so that sending a message doesn't
+    cost a new TCP connection each time. Connections are grouped by receiver address, and each of
+    them can carry many requests at the same time. A new connection to a receiver is only
+    opened when the existing ones are busy, up to `connections_per_receiver`.::
+
+        pool = ConnectionPool()
+
+        # Send a message and wait for the reply
+        reply = pool.send(my_message, wait_reply=True)
+
+        # Close every connection
+        pool.close()
+
+    """
+
+    def __init__(self, connections_per_receiver=1, timeout=None, logger=None, codec="json"):
+        """
+        Create a new (empty) ConnectionPool.
+
+        :param connections_per_receiver: how many connections can be opened to a same receiver
+        :param timeout: the default number of seconds to wait for a reply, None means forever
+        :param codec: the name of the preferred codec, see :mod:`commons.serialization`
+        """
+        self._codec = get_codec(codec)
+        self._connections = {}
+        self._address_locks = {}
+        self._lock = threading.Lock()
+        self._connections_per_receiver = max(1, connections_per_receiver)
+        self._timeout = timeout
+        self._logger = logger
+
+    def send(self, message, wait_reply=False, timeout=None):
+        """
+        Send the message to its receiver.
+
+        :param message: a Message object (or one of its subclasses)
+        :param wait_reply: if True, wait for the reply linked to the message
+        :param timeout: overrides the default timeout of the pool
+        :return: the reply if `wait_reply` is True, None otherwise
+        """
+        connection = self._get_connection(tuple(message.receiver))
+        pending = connection.send(message, wait_reply)
+        if pending is None:
+            return None
+
+        try:
+            return pending.wait(self._timeout if timeout is None else timeout)
+        finally:
+            connection.discard(message.id)
+
+    def send_stream(self, message, timeout=None):
+        """
+        Send the message to its receiver, and iterate over the rows of the streamed reply (see
+        :meth:`Sender.send_stream`). Chunks are received while the rows are consumed.
+
+        :param message: a Message object (or one of its subclasses)
+        :param timeout: overrides the default timeout of the pool, for each chunk
+        :return: an iterator of rows
+        """
+        connection = self._get_connection(tuple(message.receiver))
+        pending = connection.send(message, stream=True)
+        timeout = self._timeout if timeout is None else timeout
+        return self._iterate_stream(connection, message, pending, timeout)
+
+    @staticmethod
+    def _iterate_stream(connection, message, pending, timeout):
+        try:
+            for chunk in pending.chunks(timeout):
+                for row in chunk.data:
+                    yield row
+        finally:
+            connection.discard(message.id)
+
+    def close(self):
+        """
+        Close every connection of the pool.
+        """
+        with self._lock:
+            connections, self._connections = self._connections, {}
+        for address_connections in connections.values():
+            for connection in address_connections:
+                connection.close()
+
+    def _get_connection(self, address):
+        """
+        Get the least busy connection to the provided address, or open a new one if they are all
+        busy (and the limit is not reached yet).
+
+        :param address: a tuple (hostname, port)
+        :return: a :class:`PooledConnection`
+        """
+        with self._lock:
+            address_lock = self._address_locks.setdefault(address, threading.Lock())
+
+        # Only connections to the same receiver have to wait for each other
+        with address_lock:
+            connections = [c for c in self._connections.get(address, []) if c.alive]
+            connection = min(connections, key=lambda c: c.in_flight) if connections else None
+
+            if connection is None or (connection.in_flight > 0
+                                      and len(connections) < self._connections_per_receiver):
+                connection = PooledConnection(address, self._logger, self._codec)
+                connections.append(connection)
+
+            with self._lock:
+                self._connections[address] = connections
+
+        return connection
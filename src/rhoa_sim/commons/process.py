@@ -3,13 +3,12 @@ The process API allows you to create your own process by simply overriding base
 """
 from __future__ import print_function
 import future
-import queue
-import socket
 import threading
 import traceback
 
 from commons.utils import ConfigurationLoader, LoggerConfigurator, MessageIDGenerator, HandlerStore
-from commons.network import ThreadPoolTCPServer, MessageWorker, Sender, Receiver
+from commons.network import ThreadPoolTCPServer, MessageWorker, ConnectionPool, RequestQueue, \
+    WorkerPool
 
 
 class ServerProcess(object):
@@ -37,11 +36,27 @@ class ServerProcess(object):
             executed
         * :meth:`_before_run` : this method is the first one executed in the :meth:`run`.
 
+    The queue of waiting requests is configured in the "server" section of the configuration:
+
+        * "queue_size": the maximum number of waiting requests (default is 0, no limit)
+        * "overload_policy": what to do when the queue is full, "block" (the default), "reject" or
+            "drop_oldest" (see :class:`RequestQueue`)
+        * "droppable_services": the services whose requests may be dropped by the "drop_oldest"
+            policy (default is `DEFAULT_DROPPABLE_SERVICES`)
+
+    Requests are handled by a :class:`WorkerPool` of MessageWorkers, growing and shrinking with
+    the load between "min_workers" (default is `DEFAULT_WORKER_NUMBER`) and "max_workers"
+    (default is `DEFAULT_MAX_WORKER_NUMBER`), also read from the "server" section.
+
 
 
     """
 
     DEFAULT_WORKER_NUMBER = 3
+    DEFAULT_MAX_WORKER_NUMBER = 12
+
+    # Position updates are sent continuously, a newer one will soon replace a dropped one
+    DEFAULT_DROPPABLE_SERVICES = ("SetRobotPosition",)
 
     def __init__(self, conf="conf.json", *args, **kwargs):
         """
@@ -60,12 +75,21 @@ class ServerProcess(object):
         self.conf.file = conf
 
         # Create the queue that will hold waiting requests
-        self._queue = queue.Queue()
+        server_conf = self.conf["server"]
+        self._queue = RequestQueue(
+            server_conf.get("queue_size", 0),
+            server_conf.get("overload_policy", "block"),
+            server_conf.get("droppable_services", self.DEFAULT_DROPPABLE_SERVICES)
+        )
+
+        # Configure logger
+        self._logger = LoggerConfigurator.get_logger("ServerProcess", self.conf["logger"])
 
         # Create the server
         self._server = ThreadPoolTCPServer(
-            (self.conf["server"]["address"], self.conf["server"]["port"]),
-            _queue=self._queue
+            (server_conf["address"], server_conf["port"]),
+            _queue=self._queue,
+            logger=self._logger
         )
 
         # Create its thread
@@ -81,20 +105,22 @@ class ServerProcess(object):
         # self._connection = None
         self.handlers_store = HandlerStore()
 
-        # Configure logger
-        self._logger = LoggerConfigurator.get_logger("ServerProcess", self.conf["logger"])
-
         # Customize stuff, according to what type of process it is
         self._custom_init()
 
-        # Create workers
-        self._workers = [
-            MessageWorker(
-                self._queue,
-                self.handlers_store,
-                self._logger
-            ) for _ in range(self.DEFAULT_WORKER_NUMBER)
-        ]
+        # Create the pool of workers
+        min_workers = server_conf.get("min_workers", self.DEFAULT_WORKER_NUMBER)
+        self._workers = WorkerPool(
+            self._queue,
+            lambda: MessageWorker(self._queue, self.handlers_store, self._logger),
+            min_size=min_workers,
+            max_size=server_conf.get(
+                "max_workers",
+                max(min_workers, self.DEFAULT_MAX_WORKER_NUMBER)
+            ),
+            logger=self._logger,
+            name="MessageWorker pool"
+        )
 
         # Configure handlers
         self._set_handlers()
@@ -108,28 +134,40 @@ class ServerProcess(object):
         self._before_run()
 
         # Start workers
-        for worker in self._workers:
-            worker.start()
+        self._workers.start()
 
         self._logger.info("Server: starting now ...")
         self._server_thread.start()
 
-    def stop(self):
+    def stop(self, drain=False, timeout=None):
         """
         Stop the server. If you need to perform clean up, consider using the :meth:`_after_exit`.
-        :return:
+        Requests being handled are finished, waiting ones are discarded unless `drain` is True.
+
+        :param drain: if True, waiting requests are handled before stopping
+        :param timeout: when draining, the maximum number of seconds to wait for the waiting
+                        requests (None means forever)
         """
         self._server.shutdown()
         self._server_thread.join()
         self._logger.info("Server: shutting down now ...")
         # Shutdown workers
-        for thread in self._workers:
-            thread.stop_soon()
-            thread.join()
+        self._workers.stop(drain, timeout)
+        self._server.server_close()
 
         # Execute process-specific stuff
         self._after_exit()
 
+    def stats(self):
+        """
+        Get statistics about the server.
+
+        :return: a dictionary, where "queue" holds the state of the request queue (see
+                 :meth:`RequestQueue.stats`) and "workers" the state of the pool of workers (see
+                 :meth:`WorkerPool.stats`)
+        """
+        return {"queue": self._queue.stats(), "workers": self._workers.stats()}
+
     def _set_handlers(self):
         """
         This method is used to register your class-level handlers. It is executed in the
@@ -166,10 +204,13 @@ class ServerProcess(object):
 
 class ClientProcess(object):
     """
-    The ClientProcess is designed to send messages
+    The ClientProcess is designed to send messages. Connections to receivers are kept open in a
+    :class:`ConnectionPool` and shared by every message sent to the same receiver. Remember to
+    call :meth:`close` once you are done with the client.
     """
 
-    def __init__(self, handler_store=None, logger=None):
+    def __init__(self, handler_store=None, logger=None, connections_per_receiver=1, timeout=None,
+                 codec="json"):
         """
         Create a new Client. Client are able to send messages (orders or subscription) in sync
         mode. If you want to use async mode (for subscription for example), you have to use a
@@ -186,50 +227,46 @@ class ClientProcess(object):
             # Send messages
             rtrn = client.send_order(msg, handlers=...)
 
+        :param connections_per_receiver: how many connections can be opened to a same receiver
+        :param timeout: how many seconds to wait for a reply, None means forever
+        :param codec: the preferred codec (if the receiver supports it), see
+                      :mod:`commons.serialization`
         """
         # Create a store if necessary
         self._store = HandlerStore() if handler_store is None else handler_store
         self._logger = logger
+        self._pool = ConnectionPool(connections_per_receiver, timeout, logger, codec)
 
     def send_order(self, message, handlers=None):
         """
         Send a message. The destination must be provided (use the sender, receiver and the
-        reply_to if necessary).
+        reply_to if necessary). If the reply method of the message is "stream", an iterator over
+        the rows of the reply is returned: rows are received while they are consumed (errors are
+        then raised by the iterator).::
+
+            for row in client.send_order(msg):
+                ...
 
         :param message: a Message object (or one of its subclasses)
         :param handlers: a callback or or list of them
         """
-        # Register callback
-        if handlers is not None:
-            if isinstance(handlers, (tuple, list)):
-                self._store.set_handlers_for(message.id, handlers)
-            else:
-                self._store.set_handlers_for(message.id, [handlers])
+        self._register_handlers(message, handlers)
+
+        if getattr(message, "reply_method", "") == "stream":
+            return self._pool.send_stream(message)
 
         # Send messages
-        sock = None
         result = None
 
         try:
-            sock = socket.create_connection(tuple(message.receiver))
-
-            # Send the message
-            sender = Sender(sock, self._logger)
-            sender.send(message)
-
-            if message.to_dict().get("reply_method", "") == "immediate":
-                # Create a receiver and receive the reply
-                receiver = Receiver(sock, self._logger)
-                result = receiver.receive()
-
+            result = self._pool.send(
+                message,
+                wait_reply=getattr(message, "reply_method", "") == "immediate"
+            )
         except Exception:
             if self._logger is not None:
                 self._logger.error(traceback.format_exc())
 
-        finally:
-            if sock is not None:
-                sock.close()
-
         return result
 
     def send_subscription(self, message, handlers=None):
@@ -240,37 +277,37 @@ class ClientProcess(object):
         :param message: a Message object (or one of its subclasses)
         :param handlers: a callback or or list of them
         """
-        # Register callback
-        if handlers is not None:
-            if isinstance(handlers, (tuple, list)):
-                self._store.set_handlers_for(message.id, handlers)
-            else:
-                self._store.set_handlers_for(message.id, [handlers])
+        self._register_handlers(message, handlers)
 
         # Send messages
-        sock = None
         result = None
 
         try:
-            sock = socket.create_connection(tuple(message.receiver))
-
-            # Send the message
-            sender = Sender(sock, self._logger)
-            sender.send(message)
-
-            # Create a receiver and receive the reply
-            receiver = Receiver(sock, self._logger)
-            result = receiver.receive()
-
+            result = self._pool.send(message, wait_reply=True)
         except Exception:
             print(traceback.format_exc())
 
-        finally:
-            if sock is not None:
-                sock.close()
-
         return result
 
+    def close(self):
+        """
+        Close every connection opened by the client.
+        """
+        self._pool.close()
+
+    def _register_handlers(self, message, handlers):
+        """
+        Register the callbacks for the provided message.
+
+        :param message: a Message object
+        :param handlers: a callback or or list of them
+        """
+        if handlers is not None:
+            if isinstance(handlers, (tuple, list)):
+                self._store.set_handlers_for(message.id, handlers)
+            else:
+                self._store.set_handlers_for(message.id, [handlers])
+
 
 if __name__ == '__main__':
     from commons.messages import Message
@@ -294,4 +331,5 @@ if __name__ == '__main__':
     import time
 
     time.sleep(5)
+    client.close()
     server.stop()
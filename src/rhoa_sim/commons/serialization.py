@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+"""
+This module holds the codecs used to turn messages into bytes (and back). JSON is the default
+codec, understood by every process. Binary codecs are more compact and faster, but they need an
+optional dependency (for example, the MsgPackCodec needs the `msgpack` package).
+
+Binary data starts with a marker byte identifying the codec, so a receiver always knows how to
+decode a message. JSON data has no marker.
+"""
+import json
+
+from commons.messages import Message, MessageRegistry
+from commons.utils import CustomJSONEncoder, ResultSerializer
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+class Codec(object):
+    """
+    The interface every codec should follow. A codec encodes a dictionary (the message) into
+    bytes and decodes bytes into a dictionary.
+    """
+
+    # The name used in configuration files and when processes negotiate a codec
+    NAME = None
+
+    # The first byte of encoded data (None for JSON)
+    MARKER = None
+
+    def encode(self, data):
+        """
+        Encode the provided data.
+
+        :param data: a dictionary
+        :return: bytes
+        """
+        raise NotImplementedError()
+
+    def decode(self, data):
+        """
+        Decode the provided data.
+
+        :param data: bytes (including the marker, if any)
+        :return: a dictionary
+        """
+        raise NotImplementedError()
+
+    def encode_message(self, message, sender, codecs=None):
+        """
+        Encode a message, with the provided sender. The message itself is not modified.
+
+        :param message: a Message object or a dictionary
+        :param sender: the sender address
+        :param codecs: if provided, the codec names announced to the receiver
+        :return: bytes
+        """
+        data = message.to_dict() if isinstance(message, Message) else dict(message)
+        data["sender"] = sender
+        if codecs is not None:
+            data["codecs"] = codecs
+        return self.encode(data)
+
+
+class JSONCodec(Codec):
+    """
+    The default codec. Data is encoded in JSON (using the :class:`CustomJSONEncoder`) and then
+    in UTF-8. As non-ASCII characters are escaped, the output is still readable by processes
+    expecting ASCII data.
+    """
+
+    NAME = "json"
+
+    def __init__(self):
+        self._encoder = CustomJSONEncoder()
+
+    def encode(self, data):
+        return self._encoder.encode(data).encode("utf-8")
+
+    def decode(self, data):
+        return json.loads(data.decode("utf-8"))
+
+
+class MsgPackCodec(Codec):
+    """
+    A binary codec, based on the MessagePack format. Only available if the `msgpack` package is
+    installed.
+
+    Message objects are encoded without their field names, as an array
+    `[class name, field values, extra fields]` (field values follow the schema of the class, see
+    :meth:`Message.get_schema`). Dictionaries are encoded as maps.
+    """
+
+    NAME = "msgpack"
+    MARKER = b"\x01"
+
+    def encode(self, data):
+        return MsgPackCodec.MARKER + msgpack.packb(
+            data,
+            default=ResultSerializer.to_plain,
+            use_bin_type=True
+        )
+
+    def encode_message(self, message, sender, codecs=None):
+        if not isinstance(message, Message):
+            return super(MsgPackCodec, self).encode_message(message, sender, codecs)
+
+        values = list(message.to_tuple())
+        values[message.get_schema().index("sender")] = sender
+        return self.encode([
+            message.__class__.__name__,
+            values,
+            {"codecs": codecs} if codecs is not None else None
+        ])
+
+    def decode(self, data):
+        data = msgpack.unpackb(memoryview(data)[1:], raw=False)
+        if not isinstance(data, list):
+            return data
+
+        # A message encoded with its schema
+        name, values, extra = data
+        message_class = MessageRegistry.get_class_by_name(name)
+        if message_class is None:
+            raise ValueError("Unknown message type {}".format(name))
+
+        result = dict(zip(message_class.get_schema(), values))
+        result["type"] = name
+        if extra:
+            result.update(extra)
+        return result
+
+
+DEFAULT_CODEC = JSONCodec()
+
+# Available codecs, by name and by marker
+CODECS = {DEFAULT_CODEC.NAME: DEFAULT_CODEC}
+if msgpack is not None:
+    CODECS[MsgPackCodec.NAME] = MsgPackCodec()
+
+_CODECS_BY_MARKER = {codec.MARKER: codec for codec in CODECS.values() if codec.MARKER is not None}
+
+
+def get_codec(name):
+    """
+    Get an available codec according to its name.
+
+    :param name: the name of the codec (like "json" or "msgpack")
+    :return: the codec, or the default one if it is not available
+    """
+    return CODECS.get(name, DEFAULT_CODEC)
+
+
+def find_codec(data):
+    """
+    Find the codec able to decode the provided data.
+
+    :param data: encoded bytes
+    :return: a codec (the default one if there is no known marker)
+    """
+    return _CODECS_BY_MARKER.get(bytes(data[:1]), DEFAULT_CODEC)
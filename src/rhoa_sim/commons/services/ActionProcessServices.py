@@ -1,6 +1,7 @@
 # -*- coding: utf-8 -*-
 
 from commons.services.common import DBService
+from commons.spatial import SpatialIndex
 
 
 class GetDrugStoreService(DBService):
@@ -31,10 +32,19 @@ class FuelLevelService(DBService):
     DBService subclass, you have to provide a database connection.
     """
 
+    CACHEABLE = True
+    NOTIFY_KEYS = ("name",)
+
+    def _prepare_params(self, kwargs, session=None):
+        # An empty name means every robot
+        if not kwargs.get("name", False):
+            kwargs.pop("name", None)
+        return kwargs
+
     @staticmethod
     def _build_query(**kwargs):
         query = "MATCH (a:Robot)"
-        if kwargs.get("name", False):
+        if "name" in kwargs:
             query += " WHERE a.name = $name"
         query += " RETURN a.fuel_level"
         return query
@@ -47,6 +57,7 @@ class SetFuelLevelService(DBService):
 
     # Dependencies
     DEPENDENCIES = [FuelLevelService]
+    NOTIFY_KEYS = ("name",)
 
     @staticmethod
     def _build_query(**kwargs):
@@ -55,9 +66,20 @@ class SetFuelLevelService(DBService):
         query += " RETURN a.name, a.fuel_level"
         return query
 
+    @staticmethod
+    def _build_batch_query(**kwargs):
+        query = "UNWIND $batch AS row"
+        query += " MATCH (a:Robot {name: row.name})"
+        query += " SET a.fuel_level = row.fuel_level"
+        query += " RETURN row._index AS _index, a.name, a.fuel_level"
+        return query
+
 
 class GetRobotPosition(DBService):
 
+    CACHEABLE = True
+    NOTIFY_KEYS = ("name",)
+
     @staticmethod
     def _build_query(**kwargs):
         query = "MATCH(a: Robot {name: $name})-[: STATE]->(o:Odometry),"
@@ -71,6 +93,21 @@ class GetRobotPosition(DBService):
 class SetRobotPosition(DBService):
 
     DEPENDENCIES = [GetRobotPosition]
+    NOTIFY_KEYS = ("name",)
+
+    # The places where a robot can be
+    PLACE_LABELS = ("Intersection", "Section")
+
+    def _prepare_params(self, kwargs, session=None):
+        index = SpatialIndex.get_instance()
+        if index.ensure_loaded(self.connection, session):
+            kwargs["containers"] = index.containing(
+                kwargs["x"],
+                kwargs["y"],
+                "radius",
+                SetRobotPosition.PLACE_LABELS
+            )
+        return kwargs
 
     @staticmethod
     def _build_query(**kwargs):
@@ -78,13 +115,33 @@ class SetRobotPosition(DBService):
         query += " SET o.x = $x, o.y = $y, o.z = $z"
         query += " WITH a, o"
         query += " MATCH (i), (a)<-[rel:CONTAINS]-()"
-        query += " WHERE (i:Intersection OR i:Section) AND sqrt((i.x - $x) ^ 2 + (i.y - $y) ^ 2) " \
-                 "<= i.radius"
+        if "containers" in kwargs:
+            query += " WHERE id(i) IN $containers"
+        else:
+            query += " WHERE (i:Intersection OR i:Section)"
+            query += " AND sqrt((i.x - $x) ^ 2 + (i.y - $y) ^ 2) <= i.radius"
         query += " DELETE rel "
         query += " CREATE (a)<-[:CONTAINS]-(i)"
         query += " RETURN a.name, o"
         return query
 
+    @staticmethod
+    def _build_batch_query(**kwargs):
+        query = "UNWIND $batch AS row"
+        query += " MATCH (a:Robot {name: row.name})-[:STATE]->(o:Odometry)"
+        query += " SET o.x = row.x, o.y = row.y, o.z = row.z"
+        query += " WITH a, o, row"
+        query += " MATCH (i), (a)<-[rel:CONTAINS]-()"
+        if "containers" in kwargs:
+            query += " WHERE id(i) IN row.containers"
+        else:
+            query += " WHERE (i:Intersection OR i:Section)"
+            query += " AND sqrt((i.x - row.x) ^ 2 + (i.y - row.y) ^ 2) <= i.radius"
+        query += " DELETE rel "
+        query += " CREATE (a)<-[:CONTAINS]-(i)"
+        query += " RETURN row._index AS _index, a.name, o"
+        return query
+
 
 def load_services(service_store):
     """
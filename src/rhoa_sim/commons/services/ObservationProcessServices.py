@@ -1,13 +1,23 @@
 # -*- coding: utf-8 -*-
 
 from commons.services.common import DBService
+from commons.spatial import SpatialIndex
 
 class SetArucoService(DBService):
 
+    def _prepare_params(self, kwargs, session=None):
+        index = SpatialIndex.get_instance()
+        if index.ensure_loaded(self.connection, session):
+            kwargs["containers"] = index.containing(kwargs["x"], kwargs["y"], "r")
+        return kwargs
+
     @staticmethod
     def _build_query(**kwargs):
         query = "MATCH (i)"
-        query += " WHERE sqrt((i.x - $x) ^ 2 + (i.y - $y) ^ 2) <= i.r"
+        if "containers" in kwargs:
+            query += " WHERE id(i) IN $containers"
+        else:
+            query += " WHERE sqrt((i.x - $x) ^ 2 + (i.y - $y) ^ 2) <= i.r"
         query += " SET i.aruco = $aruco"
         query += " RETURN i"
         return query
\ No newline at end of file
@@ -6,14 +6,24 @@ If you want to provide your own services, put them on a module and define a **lo
 function. See the one define in this module.
 """
 import future
+import collections
+import hashlib
+import heapq
+import json
 import sys
 
 import os
 import queue
-import socket
+import threading
+import time
 
-from commons.network import Worker, Sender
-from commons.utils import get_final_classes, LoggerConfigurator, MessageIDGenerator
+from commons.messages import InformationMessage
+from commons.experiences import ExperienceStore
+from commons.mapgraph import MapGraph
+from commons.network import Worker, WorkerPool, PooledConnection
+from commons.spatial import SpatialIndex
+from commons.utils import get_final_classes, CustomJSONEncoder, LoggerConfigurator, \
+    MessageIDGenerator, DeltaView, ResultSerializer
 
 if sys.version_info >= (3,):
     import importlib.util
@@ -170,48 +180,368 @@ class ServiceStore(object):
 class SubscriptionStore(object):
     """
     This object is storing Services that need to be notified when changes are occurring. Services
-    are stored in an internal dictionary, grouped by class name. Each subscriptions is a tuple
-    containing the following information:
+    are stored in an internal dictionary, grouped by class name. Each subscription is a
+    :class:`SubscriptionStore.Subscription`, holding the instantiated service, the original
+    request message (it should be an instance of :class:`commons.messages.SubscriptionMessage`),
+    the last value and the parameters that need to be passed to the execute method.
 
-        - the instantiate service
-        - the original request message (it should be an instance of :class:`old.messages.SubscriptionMessage`)
-        - the last value
-        - some additional parameters that need to be passed to the execute method.
+    Subscriptions are also indexed by the values of the NOTIFY_KEYS of their service (see
+    :attr:`Service.NOTIFY_KEYS`). A write telling which entities it changed (for instance, the
+    robot named "A") only re-executes the subscriptions concerning these entities, so the work
+    done for a write depends on the number of affected subscribers, not on the total number
+    of subscribers.
 
     The SubscriptionStore is lazy, which means it won't send messages if the value hasn't
-    changed. Notice that it will still execute concerned services at each time.
+    changed since the last one sent to the subscriber (results are compared through a digest of
+    their JSON form, see :meth:`Subscription.digest`). Notice that it will still execute
+    concerned services at each time.
+
+    Subscribers can also opt in to delta notifications (see :meth:`set_delta_mode`): instead of
+    the whole result, they receive the rows added, removed and changed since the last value they
+    were sent, with a full snapshot from time to time. Use a :class:`commons.utils.DeltaView` to
+    rebuild the result on the subscriber side.
+
+    A subscription has at most one pending recomputation: notifications received while it is
+    waiting to be executed are merged into it. A minimum interval between two recomputations
+    can be set for each subscriber (see :meth:`set_min_interval`), notifications received
+    before the end of the interval are delayed, so that the load stays bounded when writes spike.
     Because the ServiceStore is using a bunch of threads internally, remember calling the
     :meth:`stop_workers` method before deleting the object.
     """
 
+    class Subscription(object):
+        """
+        A subscription of a process to a service, for some parameters.
+        """
+
+        DEFAULT_SNAPSHOT_INTERVAL = 50
+
+        def __init__(self, service, request, last_value, args, kwargs):
+            """
+            Create a new Subscription.
+
+            :param service: an object that have an execute method
+            :param request: the received message
+            :param last_value: the last result obtained by running the service
+            :param args: additional parameters that will be passed to the execute method
+            :param kwargs: additional parameters that will be passed to the execute method
+            """
+            self.service = service
+            self.request = request
+            self.last_value = last_value  # The last value sent to the subscriber
+            self.last_digest = SubscriptionStore.Subscription.digest(last_value)
+            self.lock = threading.Lock()  # Serializes the recomputations
+            self.args = args
+            self.kwargs = kwargs
+            self.keys = {}  # The values of the NOTIFY_KEYS, a missing key matches every value
+            self.pending = False  # True while a recomputation is waiting
+            self.last_run = 0.0
+
+            # Delta mode, the rows of the last value sent (identity -> (JSON form, row))
+            self.delta = False
+            self.snapshot_interval = SubscriptionStore.Subscription.DEFAULT_SNAPSHOT_INTERVAL
+            self.sequence = 0
+            self._rows = None
+            self._deltas = 0  # Deltas sent since the last snapshot
+            for name in getattr(service.__class__, "NOTIFY_KEYS", ()):
+                value = kwargs.get(name)
+                if value is None or value == "":
+                    continue
+                try:
+                    hash(value)
+                except TypeError:
+                    continue
+                self.keys[name] = value
+
+        def set_delta_mode(self, enabled=True, snapshot_interval=None):
+            """
+            Enable or disable delta notifications. The next notification is a snapshot.
+
+            :param enabled: True to send deltas
+            :param snapshot_interval: a snapshot is sent after this number of deltas
+            """
+            self.delta = enabled
+            if snapshot_interval is not None:
+                self.snapshot_interval = snapshot_interval
+            self._rows = None
+
+        def update(self, value):
+            """
+            Remember the value if it is different from the last one.
+
+            :param value: a result of the service
+            :return: a tuple (changed, data). If changed is True, data should be sent to the
+                     subscriber: the value itself, or a snapshot or a delta in delta mode (see
+                     :class:`commons.utils.DeltaView`)
+            """
+            digest = SubscriptionStore.Subscription.digest(value)
+            if digest == self.last_digest:
+                return False, None
+            self.last_value = value
+            self.last_digest = digest
+            if not self.delta:
+                return True, value
+            return True, self._get_delta(value)
+
+        def _get_delta(self, value):
+            """
+            Compare the rows of a value with the rows of the last value sent.
+            """
+            key = getattr(self.service.__class__, "ROW_KEY", None)
+            rows = collections.OrderedDict()
+            for row in value:
+                data = json.dumps(row, cls=CustomJSONEncoder, sort_keys=True)
+                row = json.loads(data)
+                if key is not None:
+                    identity = DeltaView.get_row_key(row, key)
+                else:
+                    # Identical rows are told apart by their rank
+                    identity = (data, 0)
+                    while identity in rows:
+                        identity = (data, identity[1] + 1)
+                rows[identity] = (data, row)
+
+            last_rows, self._rows = self._rows, rows
+            self.sequence += 1
+            if last_rows is None or self._deltas + 1 >= self.snapshot_interval:
+                return self._get_snapshot()
+
+            added = [row for identity, (_, row) in rows.items() if identity not in last_rows]
+            removed = [row for identity, (_, row) in last_rows.items() if identity not in rows]
+            changed = [
+                row for identity, (data, row) in rows.items()
+                if identity in last_rows and last_rows[identity][0] != data
+            ]
+            # A snapshot is smaller when most rows changed
+            if len(added) + len(removed) + len(changed) >= len(rows):
+                return self._get_snapshot()
+
+            self._deltas += 1
+            return {
+                "mode": DeltaView.DELTA,
+                "sequence": self.sequence,
+                "base": self.sequence - 1,
+                "key": list(key) if key is not None else None,
+                "added": added,
+                "removed": removed,
+                "changed": changed
+            }
+
+        def _get_snapshot(self):
+            self._deltas = 0
+            return {
+                "mode": DeltaView.SNAPSHOT,
+                "sequence": self.sequence,
+                "rows": [row for _, row in self._rows.values()]
+            }
+
+        @staticmethod
+        def digest(value):
+            """
+            Get a digest of a result, as it would be sent (Records and Nodes are compared through
+            their dictionary form).
+
+            :param value: a result of a service
+            :return: a string
+            """
+            try:
+                data = json.dumps(value, cls=CustomJSONEncoder, sort_keys=True)
+            except (TypeError, ValueError):
+                data = repr(value)
+            return hashlib.sha1(data.encode("utf-8")).hexdigest()
+
+        def matches(self, change):
+            """
+            Check if a change concerns this subscription.
+
+            :param change: a dictionary, the values of the keys identifying the changed entity
+            :return: True if every key known by both sides has the same value
+            """
+            for name, value in change.items():
+                if name in self.keys and self.keys[name] != value:
+                    return False
+            return True
+
+        def is_same(self, request):
+            """
+            Check if a (un)subscription message targets this subscription: same sender and, if
+            the message provides them, same parameters.
+
+            :param request: a subscription message
+            """
+            if self.request.sender != request.sender:
+                return False
+            kwargs = getattr(request, "kwargs", None)
+            return not kwargs or kwargs == self.kwargs
+
+    class PushChannel(object):
+        """
+        A long-lived connection to a subscriber, with its own queue of outgoing notifications.
+        Notifications are sent in order, by one ReplySender at a time: other senders can deliver
+        to other subscribers meanwhile. When a notification can't be sent, the connection is
+        closed and the channel waits before trying again (the delay doubles after each failure).
+        """
+
+        DEFAULT_MAX_QUEUE = 1000
+
+        def __init__(self, address, logger=None, backoff=0.5, max_backoff=30.0, max_retries=5,
+                     max_queue=DEFAULT_MAX_QUEUE):
+            """
+            Create a new PushChannel. The connection is opened when the first notification is
+            sent.
+
+            :param address: the address of the subscriber, a tuple (hostname, port)
+            :param backoff: the number of seconds to wait after the first failure
+            :param max_backoff: the maximum number of seconds to wait between two attempts
+            :param max_retries: the number of failures after which the subscriber is dropped
+            :param max_queue: the maximum number of waiting notifications, the oldest ones are
+                              dropped first
+            """
+            self.address = address
+            self.backoff = backoff
+            self.max_backoff = max_backoff
+            self.max_retries = max_retries
+            self._logger = logger
+            self._queue = collections.deque(maxlen=max_queue)
+            self._lock = threading.Lock()
+            self._connection = None
+            self._delivering = False  # True while a sender owns the channel
+            self._retry_at = 0.0
+            self.failures = 0  # Consecutive failures
+            self.closed = False
+
+            # Metrics
+            self.sent = 0
+            self.dropped = 0
+
+        @property
+        def waiting(self):
+            return len(self._queue)
+
+        def push(self, message):
+            """
+            Queue a notification.
+
+            :param message: the message to send
+            :return: True if the caller should deliver the channel (see :meth:`deliver`)
+            """
+            with self._lock:
+                if len(self._queue) == self._queue.maxlen:
+                    self.dropped += 1
+                self._queue.append(message)
+            return self.acquire()
+
+        def acquire(self):
+            """
+            Become the sender of the channel, unless another thread is delivering it or the
+            channel is waiting before a retry.
+
+            :return: True if the caller should deliver the channel
+            """
+            with self._lock:
+                if self._delivering or self.closed or time.time() < self._retry_at:
+                    return False
+                self._delivering = True
+                return True
+
+        def deliver(self):
+            """
+            Send the waiting notifications, until the queue is empty or sending fails. Should
+            only be called after :meth:`push` or :meth:`acquire` returned True.
+
+            :return: None, or the number of seconds to wait before trying again
+            """
+            while True:
+                with self._lock:
+                    if not self._queue or self.closed:
+                        self._delivering = False
+                        return None
+                    message = self._queue[0]
+
+                try:
+                    if self._connection is None or not self._connection.alive:
+                        self._connection = PooledConnection(self.address, self._logger)
+                    self._connection.send(message)
+                except Exception as e:
+                    with self._lock:
+                        self._connection = None
+                        self.failures += 1
+                        delay = min(self.backoff * 2 ** (self.failures - 1), self.max_backoff)
+                        self._retry_at = time.time() + delay
+                        self._delivering = False
+                    if self._logger is not None:
+                        self._logger.warn("PushChannel : can't notify {} ({})".format(
+                            self.address,
+                            e
+                        ))
+                    return delay
+
+                with self._lock:
+                    if self._queue and self._queue[0] is message:
+                        self._queue.popleft()
+                    self.failures = 0
+                    self.sent += 1
+
+        def close(self):
+            """
+            Close the connection, waiting notifications are dropped.
+            """
+            with self._lock:
+                self.closed = True
+                self.dropped += len(self._queue)
+                self._queue.clear()
+                connection, self._connection = self._connection, None
+            if connection is not None:
+                connection.close()
+
     class ReplySender(Worker):
         """
         This Worker is design to send results to process. It is processing a tuple (computed
         value, original subscription message) and will send the result to the address provided by
-        the key 'reply_to' of the SubscriptionMessage.
+        the key 'reply_to' of the SubscriptionMessage, through the
+        :class:`SubscriptionStore.PushChannel` of the subscriber. It can also be given a channel
+        which has to be delivered again, after a failure.
         """
 
-        def work(self, item):
+        def __init__(self, in_queue, store, logger=None):
             """
-            Processes item (which is value, request).
+            Create a new ReplySender.
 
-            :param item: a tuple value, SubscriptionMessage
+            :param in_queue: the notifications that will be sent
+            :param store: the SubscriptionStore owning the channels
             """
-            value, request = item
+            super(SubscriptionStore.ReplySender, self).__init__(in_queue)
+            self._store = store
+            self._logger = logger
 
-            # Create a socket (TCP socket)
-            with socket.create_connection(request.reply_to) as sock:
+        def work(self, item):
+            """
+            Processes item (which is value, request).
 
-                # Create the message and send it
-                sender = Sender(sock, self._logger)
-                sender.send({
+            :param item: a tuple value, SubscriptionMessage, or a PushChannel to retry
+            """
+            if isinstance(item, SubscriptionStore.PushChannel):
+                channel = item
+                if not channel.acquire():
+                    return
+            else:
+                value, request = item
+                channel = self._store.get_channel(request.reply_to)
+                message = InformationMessage({
                     "id": MessageIDGenerator.get_new_message_id(),
                     "linked_to": request.id,
-                    "receiver": sock.getpeername(),
+                    "receiver": channel.address,
+                    "sender": None,  # Set when sending
                     "data": value
                 })
-                if self._logger is not None:
-                    self._logger.debug("Sending back data")
+                if not channel.push(message):
+                    return
+
+            delay = channel.deliver()
+            if delay is not None:
+                self._store.retry_channel(channel, delay)
+            elif self._logger is not None:
+                self._logger.debug("Sending back data")
 
     class ServiceExecutor(Worker):
         """
@@ -230,53 +560,239 @@ class SubscriptionStore(object):
             self._out_queue = out_queue
             self._logger = logger
 
-        def work(self, services):
+        def work(self, subscriptions):
             """
-            Run each service and, if the computed value is different from the last one,
+            Run each service and, if the computed value is different from the last one sent,
             put the data into the out_queue.
 
-            :param services: a list of tuple (service, request, last_value, args, kwargs)
+            :param subscriptions: a list of :class:`SubscriptionStore.Subscription`
             """
-            for service, request, last, args, kwargs in services:
-                result = service.execute(*args, **kwargs)
-                if result != last:
-                    self._out_queue.put((result, request))
-
-    def __init__(self, executors_nb=3, reply_senders_nb=1, logger=None):
+            for subscription in subscriptions:
+                with subscription.lock:
+                    # Notifications received from now on need a new recomputation
+                    subscription.pending = False
+                    subscription.last_run = time.time()
+                    result = subscription.service.execute(
+                        *subscription.args,
+                        **subscription.kwargs
+                    )
+                    # Converted once, for the comparison and for the codec
+                    result = ResultSerializer.to_plain(result)
+                    changed, data = subscription.update(result)
+                    if changed:
+                        self._out_queue.put((data, subscription.request))
+
+    def __init__(self, executors_nb=3, reply_senders_nb=4, logger=None, min_executors_nb=1,
+                 min_interval=0.0, max_retries=5):
         """
-        Create a new SubscriptionStore.
-
-        :param executors_nb: how many threads will be created to handle services execution
-        :param reply_senders_nb: how many threads will be created to handle replies sending
+        Create a new SubscriptionStore. Services are executed by a :class:`WorkerPool`, growing
+        and shrinking with the number of notifications.
+
+        :param executors_nb: the maximum number of threads handling services execution
+        :param reply_senders_nb: how many threads will be created to handle replies sending (each
+                                 subscriber is served by one thread at a time)
+        :param min_executors_nb: the minimum number of threads handling services execution
+        :param min_interval: the default minimum number of seconds between two recomputations
+                             of a subscription
+        :param max_retries: the number of consecutive failures to notify a subscriber after which
+                            its subscriptions are removed
         """
         self._store = dict()  # Store the subscriptions
+        self._index = dict()  # By class name, key name and key value (see Subscription.keys)
+        self._lock = threading.Lock()
+
+        # Delayed recomputations, a heap of (date, sequence number, subscription)
+        self.min_interval = min_interval
+        self._min_intervals = {}  # By subscriber
+        self._delta_modes = {}  # By subscriber, (enabled, snapshot interval)
+        self._delayed = []
+        self._sequence = 0
+        self._scheduler_condition = threading.Condition(self._lock)
+        self._scheduler_stop = False
+        self._scheduler = threading.Thread(target=self._run_scheduler)
+        self._scheduler.daemon = True
+
+        # Push channels, by subscriber address
+        self.max_retries = max_retries
+        self._channels = {}
+        self._retries = set()  # Timers of the channels waiting before a retry
+
+        # Metrics
+        self._notified = 0
+        self._merged = 0
+        self._delayed_nb = 0
+        self._dropped_subscribers = 0
+
         self._waiting_replies = queue.Queue()  # Notifications that need to be sent
         self._waiting_services = queue.Queue()  # Affected services that need to be recomputed
         self._logger = logger
-        self._executors = [
-            SubscriptionStore.ServiceExecutor(
+        self._executors = WorkerPool(
+            self._waiting_services,
+            lambda: SubscriptionStore.ServiceExecutor(
                 self._waiting_services,
                 self._waiting_replies,
                 logger=self._logger
-            ) for
-            _ in range(executors_nb)
-        ]
-        self._reply_senders = [
-            SubscriptionStore.ReplySender(
+            ),
+            min_size=min(min_executors_nb, executors_nb),
+            max_size=executors_nb,
+            logger=self._logger,
+            name="ServiceExecutor pool"
+        )
+        self._reply_senders = WorkerPool(
+            self._waiting_replies,
+            lambda: SubscriptionStore.ReplySender(
                 self._waiting_replies,
+                self,
                 logger=self._logger
-            ) for _ in range(reply_senders_nb)
-        ]
+            ),
+            min_size=reply_senders_nb,
+            logger=self._logger,
+            name="ReplySender pool"
+        )
         self._start_workers()
 
     def _start_workers(self):
         """
         Utility method designed to start every workers (executors and senders)
         """
-        for executor in self._executors:
-            executor.start()
-        for sender in self._reply_senders:
-            sender.start()
+        self._executors.start()
+        self._reply_senders.start()
+        self._scheduler.start()
+
+    def stats(self):
+        """
+        Get metrics about the workers of the store (see :meth:`WorkerPool.stats`).
+
+        :return: a dictionary with the "executors" and "reply_senders" metrics, the
+                 "scheduler" metrics: the number of notified subscriptions, how many of them
+                 were merged into a pending recomputation or delayed by their minimum interval,
+                 and the number of delayed recomputations, and the "channels" metrics: the
+                 number of open channels, of waiting, sent and dropped notifications, of failing
+                 channels and of subscribers dropped after too many failures
+        """
+        with self._lock:
+            scheduler = {
+                "notified": self._notified,
+                "merged": self._merged,
+                "delayed": self._delayed_nb,
+                "waiting": len(self._delayed)
+            }
+            channels = list(self._channels.values())
+            dropped_subscribers = self._dropped_subscribers
+        return {
+            "executors": self._executors.stats(),
+            "reply_senders": self._reply_senders.stats(),
+            "scheduler": scheduler,
+            "channels": {
+                "channels": len(channels),
+                "waiting": sum(channel.waiting for channel in channels),
+                "sent": sum(channel.sent for channel in channels),
+                "dropped": sum(channel.dropped for channel in channels),
+                "failing": len([channel for channel in channels if channel.failures]),
+                "dropped_subscribers": dropped_subscribers
+            }
+        }
+
+    def get_channel(self, address):
+        """
+        Get the push channel of a subscriber, create it if needed.
+
+        :param address: the reply_to address of the subscriber
+        :return: a :class:`SubscriptionStore.PushChannel`
+        """
+        address = tuple(address)
+        with self._lock:
+            channel = self._channels.get(address)
+            if channel is None:
+                channel = SubscriptionStore.PushChannel(
+                    address,
+                    self._logger,
+                    max_retries=self.max_retries
+                )
+                self._channels[address] = channel
+            return channel
+
+    def retry_channel(self, channel, delay):
+        """
+        Deliver a channel again after a delay, or drop its subscriber if it failed too many
+        times.
+
+        :param channel: a :class:`SubscriptionStore.PushChannel` which failed
+        :param delay: the number of seconds to wait
+        """
+        if channel.failures > channel.max_retries:
+            self.remove_subscriber(channel.address)
+            return
+
+        def retry():
+            with self._lock:
+                self._retries.discard(timer)
+            self._waiting_replies.put(channel)
+
+        timer = threading.Timer(delay, retry)
+        timer.daemon = True
+        with self._lock:
+            if channel.closed:
+                return
+            self._retries.add(timer)
+        timer.start()
+
+    def remove_subscriber(self, address):
+        """
+        Remove every subscription replying to the provided address, and close its channel.
+
+        :param address: the reply_to address of the subscriber
+        """
+        address = tuple(address)
+        with self._lock:
+            for class_name, subscriptions in list(self._store.items()):
+                self._remove(class_name, [
+                    item for item in subscriptions
+                    if item.request.reply_to is not None
+                    and tuple(item.request.reply_to) == address
+                ])
+            channel = self._channels.pop(address, None)
+            self._dropped_subscribers += 1
+        if channel is not None:
+            channel.close()
+        if self._logger is not None:
+            self._logger.warn("SubscriptionStore: subscriber {} dropped".format(address))
+
+    def set_delta_mode(self, subscriber, enabled=True, snapshot_interval=None):
+        """
+        Send deltas (or full results) to a subscriber, for its current and future subscriptions.
+        A full snapshot is sent first, and then after every `snapshot_interval` deltas so that
+        a subscriber which missed a notification gets back in sync.
+
+        :param subscriber: the sender of the subscription messages
+        :param enabled: True to send deltas
+        :param snapshot_interval: the number of deltas between two snapshots
+        """
+        subscriber = self._get_subscriber(subscriber)
+        with self._lock:
+            self._delta_modes[subscriber] = (enabled, snapshot_interval)
+            concerned = [
+                subscription
+                for subscriptions in self._store.values() for subscription in subscriptions
+                if self._get_subscriber(subscription.request.sender) == subscriber
+            ]
+        for subscription in concerned:
+            with subscription.lock:
+                subscription.set_delta_mode(enabled, snapshot_interval)
+
+    def set_min_interval(self, subscriber, interval):
+        """
+        Set the minimum number of seconds between two recomputations of the subscriptions of a
+        subscriber.
+
+        :param subscriber: the sender of the subscription messages
+        :param interval: a number of seconds, None to use the default interval of the store
+        """
+        with self._lock:
+            if interval is None:
+                self._min_intervals.pop(self._get_subscriber(subscriber), None)
+            else:
+                self._min_intervals[self._get_subscriber(subscriber)] = interval
 
     def add_subscription(self, service, request, last_value, *args, **kwargs):
         """
@@ -290,91 +806,222 @@ class SubscriptionStore(object):
         """
         # Subscriptions are stored according to the service class name
         class_name = service.__class__.__name__
+        subscription = SubscriptionStore.Subscription(service, request, last_value, args, kwargs)
 
-        if not self._store.get(class_name, False):
-            self._store[class_name] = []
+        with self._lock:
+            subscriptions = self._store.setdefault(class_name, [])
 
-        # Only one subscription per service and process
-        if len([item for item in self._store[class_name] if item.sender == request.sender]) != 0:
-            if self._logger is not None:
-                self._logger.warn(
-                    "SubscriptionStore: {} tried to register itself for {} twice.".format(
-                        request.sender,
-                        class_name
+            # Only one subscription per service, process and parameters
+            if any(item.request.sender == request.sender and item.kwargs == kwargs
+                   for item in subscriptions):
+                if self._logger is not None:
+                    self._logger.warn(
+                        "SubscriptionStore: {} tried to register itself for {} twice.".format(
+                            request.sender,
+                            class_name
+                        )
                     )
-                )
-            return  # TODO : raise an error
-
-        # Register the subscription
-        self._store[class_name].append((
-            service,
-            request,
-            last_value,
-            args,
-            kwargs
-        ))
+                return  # TODO : raise an error
+
+            # Register the subscription
+            delta_mode = self._delta_modes.get(self._get_subscriber(request.sender))
+            if delta_mode is not None:
+                subscription.set_delta_mode(*delta_mode)
+            subscriptions.append(subscription)
+            index = self._index.setdefault(class_name, {})
+            for name in getattr(service.__class__, "NOTIFY_KEYS", ()):
+                by_value = index.setdefault(name, {})
+                by_value.setdefault(subscription.keys.get(name), []).append(subscription)
 
     def remove_subscription(self, request):
         """
         Remove a subscription from the store. Fail silently if the service has not been registered.
+        If the message provides no kwargs, every subscription of the sender to the service is
+        removed.
 
         :param request: the unsubscribe message
         """
         class_name = request.service
-        if class_name in self._store.keys():
-            i = 0
-            while (i < len(self._store[class_name])
-                   and self._store[class_name][i][1].sender != request.sender):
-                i += 1
-            if i < len(self._store[class_name]):
-                self._store[class_name].pop(i)
-            elif self._logger is not None:
-                self._logger.warn(
-                    "SubscriptionStore: sender {}  has no subscription to ".format(
-                        request.sender,
-                        class_name
+        with self._lock:
+            subscriptions = self._store.get(class_name)
+            if not subscriptions:
+                if self._logger is not None:
+                    self._logger.warn(
+                        "SubscriptionStore: the service {} has no active subscription".format(
+                            class_name
+                        )
                     )
-                )
-        elif self._logger is not None:
-            self._logger.warn(
-                "SubscriptionStore: the service {} has no active subscription".format(class_name)
-            )
+                return
+
+            removed = [item for item in subscriptions if item.is_same(request)]
+            if not removed:
+                if self._logger is not None:
+                    self._logger.warn(
+                        "SubscriptionStore: sender {} has no subscription to {}".format(
+                            request.sender,
+                            class_name
+                        )
+                    )
+                return
+
+            self._remove(class_name, removed)
 
-    def notify_subscribers(self, services):
+    def _remove(self, class_name, removed):
+        """
+        Remove subscriptions to a service from the store and from the index. The lock of the
+        store must be held.
+        """
+        if not removed:
+            return
+        self._store[class_name] = [
+            item for item in self._store[class_name] if item not in removed
+        ]
+        for name, by_value in self._index.get(class_name, {}).items():
+            for subscription in removed:
+                value = subscription.keys.get(name)
+                by_value[value].remove(subscription)
+                if not by_value[value]:
+                    del by_value[value]
+
+    def notify_subscribers(self, services, changes=None):
         """
         Called by an observed service, it will notify services with the given service classes.
 
         :param services: a class or a list of class
+        :param changes: a list of dictionaries, each one giving the values of the keys identifying
+                        a changed entity (for instance, [{"name": "A"}]). Only the subscriptions
+                        matching one of them are notified. None means anything may have changed.
         """
         if isinstance(services, type):
             services = [services]
-        for service_type in services:
-            if self._store.get(service_type.__name__, False):
-                self._waiting_services.put(self._store[service_type.__name__])
+        with self._lock:
+            now = time.time()
+            for service_type in services:
+                ready = []
+                for subscription in self._get_affected(service_type, changes):
+                    self._notified += 1
+                    if subscription.pending:
+                        self._merged += 1
+                        continue
+                    subscription.pending = True
+
+                    date = subscription.last_run + self._min_intervals.get(
+                        self._get_subscriber(subscription.request.sender),
+                        self.min_interval
+                    )
+                    if date <= now:
+                        ready.append(subscription)
+                    else:
+                        self._delayed_nb += 1
+                        self._sequence += 1
+                        heapq.heappush(self._delayed, (date, self._sequence, subscription))
+                        self._scheduler_condition.notify()
+                if ready:
+                    self._waiting_services.put(ready)
+
+    def _run_scheduler(self):
+        """
+        Put the delayed recomputations in the queue of the executors when they are due, until
+        the store is stopped.
+        """
+        with self._lock:
+            while not self._scheduler_stop:
+                if not self._delayed:
+                    self._scheduler_condition.wait()
+                    continue
+                remaining = self._delayed[0][0] - time.time()
+                if remaining > 0:
+                    self._scheduler_condition.wait(remaining)
+                    continue
+                ready = []
+                while self._delayed and self._delayed[0][0] <= time.time():
+                    ready.append(heapq.heappop(self._delayed)[2])
+                self._waiting_services.put(ready)
+
+    def _stop_scheduler(self, drain=False):
+        """
+        Stop the scheduler. With `drain`, the delayed recomputations are queued right away,
+        otherwise they are dropped.
+        """
+        with self._lock:
+            self._scheduler_stop = True
+            delayed, self._delayed = self._delayed, []
+            if drain and delayed:
+                self._waiting_services.put([item[2] for item in sorted(delayed)])
+            self._scheduler_condition.notify()
+        if self._scheduler.is_alive():
+            self._scheduler.join()
+
+    @staticmethod
+    def _get_subscriber(sender):
+        """
+        Get a hashable identifier of a subscriber (addresses may be lists once decoded).
+        """
+        return tuple(sender) if isinstance(sender, list) else sender
 
-    def _stop_executors(self):
+    def _get_affected(self, service_type, changes):
+        """
+        Find the subscriptions to a service affected by some changes, using the index.
+        """
+        class_name = service_type.__name__
+        subscriptions = self._store.get(class_name)
+        if not subscriptions or changes is None:
+            return list(subscriptions or [])
+
+        index = self._index.get(class_name, {})
+        affected = collections.OrderedDict()
+        for change in changes:
+            # Look up the subscriptions by the first indexed key, and check the others
+            name = next((name for name in change if name in index), None)
+            if name is None:
+                return list(subscriptions)
+            try:
+                candidates = index[name].get(change[name], []) + index[name].get(None, [])
+            except TypeError:
+                return list(subscriptions)
+            for subscription in candidates:
+                if subscription.matches(change):
+                    affected[id(subscription)] = subscription
+        return list(affected.values())
+
+    def _stop_executors(self, drain=False, timeout=None):
         """
         Stop the executors. Will perform a join on them.
         """
-        for executor in self._executors:
-            executor.stop_soon()
-            executor.join()
+        self._executors.stop(drain, timeout)
 
-    def _stop_reply_senders(self):
+    def _stop_reply_senders(self, drain=False, timeout=None):
         """
         Stop the senders. Will perform a join on them.
         :return:
         """
-        for sender in self._reply_senders:
-            sender.stop_soon()
-            sender.join()
+        self._reply_senders.stop(drain, timeout)
+
+    def stop_workers(self, drain=False, timeout=None):
+        """
+        Stop workers. Block until it's done. With `drain`, waiting notifications (delayed ones
+        included) are computed and sent first (see :meth:`WorkerPool.stop`), the timeout applying
+        to each step.
+
+        :param drain: if True, waiting notifications are handled before stopping
+        :param timeout: when draining, the maximum number of seconds to wait for each step
+        """
+        self._stop_scheduler(drain)
+        self._stop_executors(drain, timeout)
+        self._stop_reply_senders(drain, timeout)
+        self._close_channels()
 
-    def stop_workers(self):
+    def _close_channels(self):
         """
-        Stop workers. Block until it's done.
+        Cancel the retries and close the push channels.
         """
-        self._stop_executors()
-        self._stop_reply_senders()
+        with self._lock:
+            retries, self._retries = self._retries, set()
+            channels, self._channels = list(self._channels.values()), {}
+        for timer in retries:
+            timer.cancel()
+        for channel in channels:
+            channel.close()
 
 
 class Service(object):
@@ -387,6 +1034,10 @@ class Service(object):
     DEPENDENCIES = []
     REQUIRED_PARAMS = set()
 
+    # The parameters identifying the entity a service reads or writes (for instance, the name of a
+    # robot). Writes only notify the subscriptions having the same values for these keys.
+    NOTIFY_KEYS = ()
+
     def __init__(self, sub_store, service_store):
         """
         Create a new Service that will use the given subscription store to notify observers.
@@ -407,6 +1058,11 @@ class Service(object):
                 self.sub_store.notify_subscribers(self.__class__.DEPENDENCIES)
                 return ...  # Return the a value if needed
 
+        Pass the changed entities (see :attr:`NOTIFY_KEYS`) to notify only the concerned
+        subscriptions::
+
+                self.sub_store.notify_subscribers(self.__class__.DEPENDENCIES, [{"name": name}])
+
 
         :param args: additional parameters
         :param kwargs: additional named parameters
@@ -434,7 +1090,10 @@ class DBService(Service):
                 return query
 
     You can create more complex queries by using the kwargs dictionary. Keys and values inside it
-    are exactly the same as the one provided to the execute method. So you can write queries like ::
+    are exactly the same as the one provided to the execute method. Queries are cached by service
+    and parameter names, so the query should only depend on which parameters are present: values
+    should be passed as query parameters (values can be converted in :meth:`_prepare_params`).
+    So you can write queries like ::
 
         @staticmethod
         def _build_query(**kwargs):
@@ -446,12 +1105,29 @@ class DBService(Service):
 
     """
 
+    # Built queries are cached by parameter names (see QueryCache), set it to False if the query
+    # depends on the parameter values
+    CACHE_QUERY = True
+
+    # The number of records of each chunk, when the results are streamed (see stream)
+    CHUNK_SIZE = 500
+
+    # The columns identifying a row of the result, used to tell changed rows from added ones when
+    # subscribers receive deltas (see SubscriptionStore.set_delta_mode). None means the whole row.
+    ROW_KEY = None
+
+    # Read services can keep their results in the ResultCache. The cached results of a service are
+    # dropped when a service depending on it runs (see DEPENDENCIES), or after CACHE_TTL seconds
+    CACHEABLE = False
+    CACHE_TTL = None  # None means the default TTL of the ResultCache
+
     def __init__(self, sub_store, service_store, connection):
         """
         Create a new DBService that will use the given connection to execute the query. It will
-        create a new session and execute a transaction inside it.
+        get a session from the connection and execute a transaction inside it. Give the same
+        :class:`commons.database.SessionPool` to every service, so that sessions are reused.
 
-        :param connection: a :class:`neo4j.v1.GraphDataBase` object
+        :param connection: a :class:`commons.database.SessionPool` or a :class:`neo4j.v1.Driver`
         :param sub_store: a SubscriptionStore
         :param service_store: a ServiceStore
         """
@@ -478,7 +1154,24 @@ class DBService(Service):
         if not self.REQUIRED_PARAMS.issubset(kwargs.keys()):
             raise TypeError()
 
-        query = self._build_query(**kwargs)
+        # Writes may be buffered and executed later, in a batch (see WriteCoalescer)
+        coalescer = WriteCoalescer.get_coalescer(self.__class__)
+        if coalescer is not None and coalescer.running and session is None:
+            if coalescer.submit(**kwargs):
+                return []
+
+        # Reads executed in their own session may be served by the cache
+        cache_key = None
+        if self.CACHEABLE and session is None:
+            cache = ResultCache.get_instance()
+            cache_key = cache.key(self.__class__, kwargs)
+            cached = cache.get(cache_key)
+            if cached is not None:
+                return cached
+            generation = cache.generation(self.__class__)
+
+        kwargs = self._prepare_params(kwargs, session)
+        query = self._get_query(kwargs)
 
         # If a session is provided, the method will use it. Otherwise, it will create its own.
         if session is not None:
@@ -495,11 +1188,149 @@ class DBService(Service):
                         kwargs
                     )
 
+        # Return the result as a dict of things. Careful, it could be nodes and records
+        result = list(result)
+        if cache_key is not None:
+            cache.put(cache_key, result, generation, self.CACHE_TTL)
+
+        self._notify_dependencies([kwargs])
+
+        return result
+
+    def stream(self, chunk_size=None, **kwargs):
+        """
+        Execute the service and get its results by chunks, fetched lazily from the database: at
+        most one chunk is in memory at a time. The session is used until the iteration is over.
+        Use it with :meth:`commons.network.Sender.send_stream` to answer the "stream" reply
+        method.
+
+        :param chunk_size: the number of records of each chunk, CHUNK_SIZE by default
+        :param kwargs: the parameters of the query, and optionally the `session` to use
+        :return: an iterator of lists of records
+        """
+        session = kwargs.pop("session", None)
+        if not self.REQUIRED_PARAMS.issubset(kwargs.keys()):
+            raise TypeError()
+
+        chunk_size = self.CHUNK_SIZE if chunk_size is None else chunk_size
+        kwargs = self._prepare_params(kwargs, session)
+        query = self._get_query(kwargs)
+
+        if session is not None:
+            for chunk in self._stream(session, query, kwargs, chunk_size):
+                yield chunk
+        else:
+            with self.connection.session() as session:
+                for chunk in self._stream(session, query, kwargs, chunk_size):
+                    yield chunk
+
+        self._notify_dependencies([kwargs])
+
+    @staticmethod
+    def _stream(session, query, kwargs, chunk_size):
+        """
+        Run a query in a new transaction of the provided session, and group its records.
+        """
+        with session.begin_transaction() as tx:
+            chunk = []
+            for record in tx.run(query, kwargs):
+                chunk.append(record)
+                if len(chunk) >= chunk_size:
+                    yield chunk
+                    chunk = []
+            if chunk:
+                yield chunk
+
+    def execute_batch(self, batch, session=None):
+        """
+        Execute the service for each item of the batch, in a single transaction. If the service
+        provides a batch query (see :meth:`_build_batch_query`), it is run once for the whole
+        batch. Otherwise, the query is run for each item. Subscribers are notified once.
+
+        :param batch: a list of dictionaries, each one being the kwargs of one execution
+        :param session: a session to use, if None the service gets its own
+        :return: the records returned by every execution, in a single list
+        """
+        batch = list(batch)
+        if not batch:
+            return []
+        for kwargs in batch:
+            if not self.REQUIRED_PARAMS.issubset(kwargs.keys()):
+                raise TypeError()
+        batch = [self._prepare_params(dict(kwargs), session) for kwargs in batch]
+
+        if session is not None:
+            result = self._run_batch(session, batch)
+        else:
+            with self.connection.session() as session:
+                result = self._run_batch(session, batch)
+
+        self._notify_dependencies(batch)
+
+        return result
+
+    def _notify_dependencies(self, executions):
+        """
+        Drop the cached results of the dependencies, and notify their subscribers.
+
+        :param executions: the parameters of the executions which ran, used to tell which
+                           entities changed if the service declares NOTIFY_KEYS
+        """
+        if not self.__class__.DEPENDENCIES:
+            return
+        ResultCache.get_instance().invalidate(self.__class__.DEPENDENCIES)
+
+        changes = None
+        if self.NOTIFY_KEYS:
+            changes = [
+                {name: kwargs[name] for name in self.NOTIFY_KEYS if name in kwargs}
+                for kwargs in executions
+            ]
+
         # Notify the subscription store that somme data has changed
-        self.sub_store.notify_subscribers(self.__class__.DEPENDENCIES)
+        self.sub_store.notify_subscribers(self.__class__.DEPENDENCIES, changes)
 
-        # Return the result as a dict of things. Careful, it could be nodes and records
-        return list(result)
+    def _run_batch(self, session, batch):
+        """
+        Run a batch in a new transaction of the provided session.
+        """
+        batch_query = self._get_query(batch[0], batch=True)
+        with session.begin_transaction() as tx:
+            if batch_query is not None:
+                return list(tx.run(batch_query, {"batch": batch}))
+
+            result = []
+            for kwargs in batch:
+                result.extend(tx.run(self._get_query(kwargs), kwargs))
+            return result
+
+    def _get_query(self, kwargs, batch=False):
+        """
+        Get the query for the provided parameters, from the :class:`QueryCache` if it has
+        already been built for the same parameter names.
+
+        :param kwargs: the parameters of the execution
+        :param batch: if True, get the batch query (see :meth:`_build_batch_query`)
+        :return: a string, which is the CYPHER query
+        """
+        builder = self._build_batch_query if batch else self._build_query
+        if not self.CACHE_QUERY:
+            return builder(**kwargs)
+        return QueryCache.get_instance().get((self.__class__, batch), kwargs, builder)
+
+    def _prepare_params(self, kwargs, session=None):
+        """
+        Complete or convert the parameters of an execution before the query is built. By
+        default, they are left untouched.
+
+        :param kwargs: the parameters given to the execute method (a new dictionary, it can be
+                       modified)
+        :param session: the session given by the caller, if any. Queries run here must use it
+                        rather than borrowing another session from the connection: the caller
+                        holds it, and a bounded pool may have no other one.
+        :return: the parameters passed to the query builder and to the query
+        """
+        return kwargs
 
     @staticmethod
     def _build_query(**kwargs):
@@ -511,8 +1342,479 @@ class DBService(Service):
         """
         raise NotImplementedError()
 
+    @staticmethod
+    def _build_batch_query(**kwargs):
+        """
+        Create the query that will run in the execute_batch method, if the service can run a
+        whole batch at once. The batch is given as the `$batch` parameter, a list of dictionaries
+        (usually iterated with `UNWIND $batch AS row`). When the batch comes from an
+        :class:`IteratedDBService`, each row has an `_index` entry: a query returning records
+        should return `row._index AS _index`, so that records are given back to their execution.
+
+        :param kwargs: the parameters of the first item of the batch
+        :return: a string, which is the CYPHER query, or None if the service doesn't support it
+        """
+        return None
+
+
+class QueryCache(object):
+    """
+    A bounded cache of the queries built by DBServices. Queries are stored by service class and
+    parameter names: a builder only runs once for each shape of query, and the database always
+    receives the same query string for the same shape (so its own plan cache is effective).
+    The least recently used queries are evicted when the cache is full.
+
+    Use :meth:`get_instance` to get the cache shared by every service. Hit rates are available
+    through :meth:`stats`.
+    """
+
+    DEFAULT_SIZE = 256
+
+    _instance = None
+
+    @classmethod
+    def get_instance(cls):
+        """
+        Get the QueryCache shared by every DBService.
+
+        :return: a QueryCache instance
+        """
+        if cls._instance is None:
+            cls._instance = QueryCache()
+        return cls._instance
+
+    def __init__(self, size=DEFAULT_SIZE):
+        """
+        Create a new (empty) QueryCache.
+
+        :param size: the maximum number of cached queries
+        """
+        self.size = size
+        self._queries = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+
+    def get(self, key, kwargs, builder):
+        """
+        Get a cached query, or build it.
+
+        :param key: identifies the builder (for example, the service class)
+        :param kwargs: the parameters of the query, only their names are used
+        :param builder: the function building the query, called with the parameters
+        :return: the query
+        """
+        cache_key = (key, frozenset(kwargs))
+        with self._lock:
+            query = self._queries.get(cache_key)
+            if query is not None:
+                self._hits += 1
+                # Most recently used last (OrderedDict.move_to_end doesn't exist on Python 2)
+                self._queries[cache_key] = self._queries.pop(cache_key)
+                return query
+            self._misses += 1
+
+        query = builder(**kwargs)
+
+        with self._lock:
+            self._queries[cache_key] = query
+            if len(self._queries) > self.size:
+                self._queries.popitem(last=False)
+                self._evictions += 1
+        return query
+
+    def clear(self):
+        """
+        Remove every cached query.
+        """
+        with self._lock:
+            self._queries.clear()
+
+    def stats(self):
+        """
+        Get metrics about the cache.
+
+        :return: a dictionary with the number of cached queries, the maximum size, the number of
+                 hits, misses and evictions and the hit rate
+        """
+        with self._lock:
+            lookups = self._hits + self._misses
+            return {
+                "queries": len(self._queries),
+                "size": self.size,
+                "hits": self._hits,
+                "misses": self._misses,
+                "evictions": self._evictions,
+                "hit_rate": float(self._hits) / lookups if lookups else 0.0
+            }
+
+
+class ResultCache(object):
+    """
+    A read-through cache of the results of DBServices, by service class and parameters. Only
+    the services declaring `CACHEABLE = True` use it. The cached results of a service are dropped
+    when a service having it in its DEPENDENCIES is executed (the same graph is used to notify
+    subscribers), so that a read never returns a result older than the last write. Results also
+    expire after a TTL, and the least recently used ones are evicted when the cache is full.
+
+    Use :meth:`get_instance` to get the cache shared by every service. Metrics are available
+    through :meth:`stats`.
+    """
+
+    DEFAULT_SIZE = 1024
+    DEFAULT_TTL = 10.0
+
+    _instance = None
+
+    @classmethod
+    def get_instance(cls):
+        """
+        Get the ResultCache shared by every DBService.
+
+        :return: a ResultCache instance
+        """
+        if cls._instance is None:
+            cls._instance = ResultCache()
+        return cls._instance
+
+    def __init__(self, size=DEFAULT_SIZE, ttl=DEFAULT_TTL):
+        """
+        Create a new (empty) ResultCache.
+
+        :param size: the maximum number of cached results
+        :param ttl: the default number of seconds a result stays in the cache, None means forever
+        """
+        self.size = size
+        self.ttl = ttl
+        self._results = collections.OrderedDict()  # key -> (expiration date, result)
+        self._generations = collections.defaultdict(int)  # Invalidations of each service class
+        self._lock = threading.Lock()
+
+        # Metrics
+        self._hits = 0
+        self._misses = 0
+        self._invalidations = 0
+        self._expirations = 0
+        self._evictions = 0
+
+    @staticmethod
+    def key(service_class, kwargs):
+        """
+        Get the key of a result.
+
+        :param service_class: the DBService subclass
+        :param kwargs: the parameters given to the service
+        :return: a hashable key, or None if the parameters can't be used as a key
+        """
+        try:
+            key = (service_class, frozenset(kwargs.items()))
+            hash(key)
+        except TypeError:
+            return None
+        return key
+
+    def generation(self, service_class):
+        """
+        Get the number of invalidations of a service class. Give it back to :meth:`put`, so that
+        a result read before an invalidation is not stored.
+
+        :param service_class: the DBService subclass
+        :return: an int
+        """
+        with self._lock:
+            return self._generations[service_class]
+
+    def get(self, key):
+        """
+        Get a cached result.
+
+        :param key: the key of the result (see :meth:`key`)
+        :return: a copy of the result, or None if it is not cached
+        """
+        if key is None:
+            return None
+
+        with self._lock:
+            entry = self._results.get(key)
+            if entry is not None and entry[0] is not None and entry[0] <= time.time():
+                del self._results[key]
+                self._expirations += 1
+                entry = None
+            if entry is None:
+                self._misses += 1
+                return None
+            self._hits += 1
+            # Most recently used last (OrderedDict.move_to_end doesn't exist on Python 2)
+            self._results[key] = self._results.pop(key)
+            return list(entry[1])
+
+    def put(self, key, result, generation, ttl=None):
+        """
+        Store a result, unless its service was invalidated since the provided generation.
+
+        :param key: the key of the result (see :meth:`key`)
+        :param result: a list of records
+        :param generation: the generation of the service class when the result was read
+        :param ttl: overrides the default TTL
+        """
+        if key is None:
+            return
+
+        ttl = self.ttl if ttl is None else ttl
+        with self._lock:
+            if self._generations[key[0]] != generation:
+                return
+            self._results.pop(key, None)
+            self._results[key] = (time.time() + ttl if ttl is not None else None, list(result))
+            if len(self._results) > self.size:
+                self._results.popitem(last=False)
+                self._evictions += 1
+
+    def invalidate(self, services):
+        """
+        Drop the cached results of the given service classes.
+
+        :param services: a class or a list of class
+        """
+        if isinstance(services, type):
+            services = [services]
+        services = set(services)
+        with self._lock:
+            for service_class in services:
+                self._generations[service_class] += 1
+            for key in [key for key in self._results if key[0] in services]:
+                del self._results[key]
+                self._invalidations += 1
+
+    def clear(self):
+        """
+        Remove every cached result.
+        """
+        with self._lock:
+            for service_class in set(key[0] for key in self._results):
+                self._generations[service_class] += 1
+            self._results.clear()
+
+    def stats(self):
+        """
+        Get metrics about the cache.
+
+        :return: a dictionary with the number of cached results, the maximum size, the number of
+                 hits and misses, the hit rate and how many results were invalidated, expired or
+                 evicted
+        """
+        with self._lock:
+            lookups = self._hits + self._misses
+            return {
+                "results": len(self._results),
+                "size": self.size,
+                "hits": self._hits,
+                "misses": self._misses,
+                "hit_rate": float(self._hits) / lookups if lookups else 0.0,
+                "invalidations": self._invalidations,
+                "expirations": self._expirations,
+                "evictions": self._evictions
+            }
+
+
+class WriteCoalescer(object):
+    """
+    A WriteCoalescer buffers the executions of a :class:`DBService` (for example, frequent
+    position updates) and runs them later, in a batch (see :meth:`DBService.execute_batch`).
+    Only the latest execution is kept for each value of the key parameter: if a robot sends
+    ten positions between two flushes, only the last one is written.
+
+    The buffer is flushed `interval` seconds after the first buffered execution, or as soon as
+    it holds `batch_size` executions. Once a coalescer is started, executions of its service go
+    to the coalescer (and return an empty result) unless a session is provided::
+
+        coalescer = WriteCoalescer(
+            SetRobotPosition(sub_store, service_store, session_pool),
+            key="name",
+            interval=0.2
+        )
+        coalescer.start()
+        ...
+        coalescer.stop()  # The remaining executions are flushed
+
+    Metrics are available through :meth:`stats`.
+    """
+
+    # Started coalescers, by service class
+    _coalescers = {}
+
+    def __init__(self, service, key="name", interval=0.1, batch_size=100, logger=None):
+        """
+        Create a new WriteCoalescer.
+
+        :param service: the DBService instance used to flush the buffer
+        :param key: the parameter identifying the updated entity (executions having the same
+                    value replace each other)
+        :param interval: the maximum number of seconds an execution stays in the buffer
+        :param batch_size: the number of buffered executions triggering a flush
+        """
+        self.service = service
+        self.key = key
+        self.interval = interval
+        self.batch_size = batch_size
+        self._logger = logger
+
+        self._condition = threading.Condition()
+        self._pending = {}
+        self._first_pending = None  # When the oldest buffered execution arrived
+        self._stop_flag = False
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+
+        # Metrics
+        self._submitted = 0
+        self._coalesced = 0
+        self._flushes = 0
+        self._written = 0
+        self._errors = 0
+        self._flush_time = 0.0
+
+    @classmethod
+    def get_coalescer(cls, service_class):
+        """
+        Get the started coalescer of a service class.
+
+        :param service_class: a DBService subclass
+        :return: a WriteCoalescer, or None
+        """
+        return cls._coalescers.get(service_class)
+
+    @property
+    def running(self):
+        return self._thread.is_alive() and not self._stop_flag
+
+    def start(self):
+        """
+        Start flushing, and redirect the executions of the service to this coalescer.
+        """
+        self._thread.start()
+        WriteCoalescer._coalescers[self.service.__class__] = self
+
+    def stop(self):
+        """
+        Stop redirecting executions, flush the buffer and stop the flushing thread.
+        """
+        if WriteCoalescer._coalescers.get(self.service.__class__) is self:
+            del WriteCoalescer._coalescers[self.service.__class__]
+        with self._condition:
+            self._stop_flag = True
+            self._condition.notify()
+        if self._thread.is_alive():
+            self._thread.join()
+
+    def submit(self, **kwargs):
+        """
+        Buffer an execution, replacing the buffered one with the same key (if any).
+
+        :param kwargs: the parameters of the execution
+        :return: True if the execution is buffered, False if the coalescer is stopping (the
+                 last flush may be over, the caller should execute it itself)
+        """
+        with self._condition:
+            if self._stop_flag:
+                return False
+            self._submitted += 1
+            key = kwargs.get(self.key)
+            if key in self._pending:
+                self._coalesced += 1
+                del self._pending[key]  # Keep the arrival order of the latest executions
+            elif not self._pending:
+                self._first_pending = time.time()
+            self._pending[key] = kwargs
+
+            if len(self._pending) == 1 or len(self._pending) >= self.batch_size:
+                self._condition.notify()
+            return True
+
+    def flush(self):
+        """
+        Execute the buffered executions now, in a single batch.
+        """
+        with self._condition:
+            batch, self._pending = list(self._pending.values()), {}
+        if not batch:
+            return
+
+        start = time.time()
+        try:
+            self.service.execute_batch(batch)
+            self._written += len(batch)
+        except Exception as e:
+            self._errors += 1
+            if self._logger is not None:
+                self._logger.warn("WriteCoalescer : can't flush {} executions of {} ({})".format(
+                    len(batch),
+                    self.service.__class__.__name__,
+                    e
+                ))
+        self._flushes += 1
+        self._flush_time += time.time() - start
+
+    def stats(self):
+        """
+        Get metrics about the coalescer.
+
+        :return: a dictionary with the number of buffered executions, the number of submitted
+                 ones, how many were replaced by a newer one, the number of flushes (and their
+                 total duration, in seconds), of written executions and of failed flushes
+        """
+        with self._condition:
+            return {
+                "pending": len(self._pending),
+                "submitted": self._submitted,
+                "coalesced": self._coalesced,
+                "flushes": self._flushes,
+                "written": self._written,
+                "errors": self._errors,
+                "flush_time": self._flush_time
+            }
+
+    def _run(self):
+        """
+        Flush the buffer when it is full or when its oldest execution is `interval` seconds old,
+        until the coalescer is stopped.
+        """
+        while True:
+            with self._condition:
+                while not self._pending and not self._stop_flag:
+                    self._condition.wait()
+
+                while not self._stop_flag and len(self._pending) < self.batch_size:
+                    remaining = self._first_pending + self.interval - time.time()
+                    if remaining <= 0:
+                        break
+                    self._condition.wait(remaining)
+
+                stopping = self._stop_flag
+
+            self.flush()
+            if stopping:
+                return
+
 
 class IteratedDBService(DBService):
+    """
+    This service executes another DBService many times, in a single session. It is given the
+    name of the service and then a tuple (args, kwargs) for each execution::
+
+        IteratedDBService(sub_store, service_store, connection).execute(
+            "AddExperience",
+            ([], {"begin_time": 0, "passage_time": 3, "concerned_name": "S1"}),
+            ([], {"begin_time": 5, "passage_time": 4, "concerned_name": "S2"})
+        )
+
+    If the iterated service has a batch query (see :meth:`DBService._build_batch_query`), the
+    executions are sent by chunks of BATCH_SIZE, one query per chunk. Otherwise, the service is
+    executed once per tuple.
+    """
+
+    BATCH_SIZE = 1000
 
     @staticmethod
     def _build_query(**kwargs):
@@ -523,7 +1825,8 @@ class IteratedDBService(DBService):
         Execute the service and get results. You can provide you own session by using the named
         parameter `session`.
 
-        :param args: A list of tuples, each one being args and kwargs of the repeated service
+        :param args: The name of the repeated service, followed by a tuple (args, kwargs) for
+                     each execution
         :param kwargs: not used in IteratedDBService
         :return: a list of each result
         """
@@ -537,32 +1840,41 @@ class IteratedDBService(DBService):
         if not self.REQUIRED_PARAMS.issubset(kwargs.keys()):
             raise TypeError()
 
-        # Future results
-        result = []
-
-        services_args = args[1:]
         service_name = args[0]
+        services_args = args[1:]
+        service = self.service_store.get_service_class(service_name)(
+            connection=self.connection,
+            sub_store=self.sub_store,
+            service_store=self.service_store
+        )
 
         # If a session is provided, the method will use it. Otherwise, it will create its own.
         if session is not None:
-            for a, k in args:
-                result.append(
-                    self.service_store.get_service_class(service_name)(
-                        connection=self.connection,
-                        sub_store=self.sub_store,
-                        service_store=self.service_store
-                    ).execute(*a, session=session, **k)
-                )
-        else:
-            with self.connection.session() as session:
-                for a, k in args:
-                    result.append(
-                        self.service_store.get_service_class(service_name)(
-                            connection=self.connection,
-                            sub_store=self.sub_store,
-                            service_store=self.service_store
-                        ).execute(*a, session=session, **k)
+            return self._execute_all(service, services_args, session)
+        with self.connection.session() as session:
+            return self._execute_all(service, services_args, session)
+
+    def _execute_all(self, service, services_args, session):
+        """
+        Execute the service for each tuple (args, kwargs), by batch if the service supports it.
+        """
+        kwargs_list = [dict(k) for _, k in services_args]
+        if not kwargs_list or service._build_batch_query(**kwargs_list[0]) is None:
+            return [service.execute(*a, session=session, **k) for a, k in services_args]
+
+        result = [[] for _ in kwargs_list]
+        for start in range(0, len(kwargs_list), self.BATCH_SIZE):
+            batch = kwargs_list[start:start + self.BATCH_SIZE]
+            for i, k in enumerate(batch):
+                k["_index"] = start + i
+            for record in service.execute_batch(batch, session=session):
+                if "_index" not in record.keys():
+                    raise ValueError(
+                        "The batch query of {} should return row._index AS _index".format(
+                            service.__class__.__name__
+                        )
                     )
+                result[record["_index"]].append(record)
         return result
 
 
@@ -583,6 +1895,8 @@ class FindExperiencesBefore(DBService):
     """
     REQUIRED_PARAMS = {"begin_time"}
 
+    CACHEABLE = True
+
     @staticmethod
     def _build_query(**kwargs):
         query = "MATCH (e:Experience)"
@@ -598,11 +1912,74 @@ class FindExperiencesAfter(DBService):
     """
     REQUIRED_PARAMS = {"begin_time"}
 
+    CACHEABLE = True
+
     @staticmethod
     def _build_query(**kwargs):
         query = "MATCH (e:Experience)"
         query += " WHERE e.beginTime >= $begin_time"
         query += " RETURN e"
+        return query
+
+
+class ExperienceStatistics(DBService):
+    """
+    This Service computes passage time statistics (count, mean, min, max and std) for each
+    concerned intersection or section. These parameters are optional:
+    min_begin_time, max_begin_time, min_passage_time, max_passage_time, concerned_name : they
+    select the experiences, like in FindExperience
+    window : a duration, the statistics are also grouped by time window of this duration (each
+    result then has a window_start)
+
+    The statistics are computed from the ExperienceStore, without querying the database, unless
+    NumPy is not installed.
+    """
+
+    FLOAT_PARAMS = ("min_begin_time", "max_begin_time", "min_passage_time", "max_passage_time",
+                    "window")
+
+    def execute(self, *args, **kwargs):
+        store = ExperienceStore.get_instance()
+        if kwargs.get("session") is None and store.ensure_loaded(self.connection):
+            kwargs = self._prepare_params(dict(kwargs))
+            return store.statistics(**{
+                name: kwargs.get(name) for name in ExperienceStatistics.FLOAT_PARAMS
+                + ("concerned_name",)
+            })
+        return super(ExperienceStatistics, self).execute(*args, **kwargs)
+
+    def _prepare_params(self, kwargs, session=None):
+        kwargs.pop("session", None)
+        for name in ExperienceStatistics.FLOAT_PARAMS:
+            if kwargs.get(name) is not None:
+                kwargs[name] = float(kwargs[name])
+        return kwargs
+
+    @staticmethod
+    def _build_query(**kwargs):
+        query = "MATCH (e:Experience)-[:CONCERNS]->(c"
+        if "concerned_name" in kwargs:
+            query += " {name: $concerned_name}"
+        query += ")"
+
+        conditions = []
+        if "min_begin_time" in kwargs:
+            conditions.append("e.beginTime >= $min_begin_time")
+        if "max_begin_time" in kwargs:
+            conditions.append("e.beginTime <= $max_begin_time")
+        if "min_passage_time" in kwargs:
+            conditions.append("e.passageTime >= $min_passage_time")
+        if "max_passage_time" in kwargs:
+            conditions.append("e.passageTime <= $max_passage_time")
+        if conditions:
+            query += " WHERE " + " AND ".join(conditions)
+
+        query += " RETURN c.name AS concerned_name"
+        if "window" in kwargs:
+            query += ", floor(e.beginTime / $window) * $window AS window_start"
+        query += ", count(e) AS count, avg(e.passageTime) AS mean, min(e.passageTime) AS min"
+        query += ", max(e.passageTime) AS max, stDevP(e.passageTime) AS std"
+        return query
 
 
 class AddExperience(DBService):
@@ -613,7 +1990,7 @@ class AddExperience(DBService):
     passageTime : a number of minutes
     concerned_name : The name of the section or intersection concerned by the experience
     """
-    DEPENDENCIES = [FindExperiencesAfter, FindExperiencesBefore]
+    DEPENDENCIES = [FindExperiencesAfter, FindExperiencesBefore, ExperienceStatistics]
 
     REQUIRED_PARAMS = {"begin_time", "passage_time", "concerned_name"}
 
@@ -624,8 +2001,74 @@ class AddExperience(DBService):
         query += "beginTime: $begin_time, "
         query += "passageTime: $passage_time})"
         query += "-[:CONCERNS]->(c)"
+        query += " RETURN e.beginTime AS begin_time, e.passageTime AS passage_time,"
+        query += " c.name AS concerned_name"
+        return query
+
+    @staticmethod
+    def _build_batch_query(**kwargs):
+        query = "UNWIND $batch AS row"
+        query += " MATCH (c{name: row.concerned_name}) WHERE c:Intersection or c:Section "
+        query += "CREATE (e:Experience {"
+        query += "beginTime: row.begin_time, "
+        query += "passageTime: row.passage_time})"
+        query += "-[:CONCERNS]->(c)"
+        query += " RETURN row._index AS _index, e.beginTime AS begin_time,"
+        query += " e.passageTime AS passage_time, c.name AS concerned_name"
         return query
 
+    def execute(self, *args, **kwargs):
+        states = self._get_load_states()
+        result = super(AddExperience, self).execute(*args, **kwargs)
+        self._store_experiences(result, states)
+        return result
+
+    def execute_batch(self, batch, session=None):
+        states = self._get_load_states()
+        result = super(AddExperience, self).execute_batch(batch, session)
+        self._store_experiences(result, states)
+        return result
+
+    @staticmethod
+    def _get_load_states():
+        """
+        Get the state of the in-memory copies of the experiences (the ExperienceStore and the
+        MapGraph) before a write: a tuple (copy, method adding experiences, generation, loaded)
+        for each one.
+        """
+        store = ExperienceStore.get_instance()
+        graph = MapGraph.get_instance()
+        states = []
+        for target, add in ((store, store.add_many), (graph, graph.add_experiences)):
+            # The generation is read first, a load starting in between changes it
+            generation = target.generation
+            states.append((target, add, generation, target.loaded))
+        return states
+
+    @staticmethod
+    def _store_experiences(records, states):
+        """
+        Add the created experiences to the ExperienceStore and to the MapGraph. A copy which
+        wasn't loaded will read them with the others. A copy loaded while the experiences were
+        written may already hold them: it is invalidated rather than risking duplicates.
+
+        :param records: the records returned by the write
+        :param states: the states of the copies before the write (see _get_load_states)
+        """
+        experiences = [
+            (record["begin_time"], record["passage_time"], record["concerned_name"])
+            for record in records
+        ]
+        if not experiences:
+            return
+        for target, add, generation, loaded in states:
+            if not target.loaded:
+                continue
+            if not loaded or generation % 2 or target.generation != generation:
+                target.invalidate()
+            else:
+                add(experiences)
+
 
 class FindExperience(DBService):
     """
@@ -639,6 +2082,16 @@ class FindExperience(DBService):
 
     If concerned_name is not given, for each experience, the service will also return the concerned node
     """
+
+    # Bounds given as strings are converted
+    INT_PARAMS = ("min_begin_time", "max_begin_time", "min_passage_time", "max_passage_time")
+
+    def _prepare_params(self, kwargs, session=None):
+        for name in FindExperience.INT_PARAMS:
+            if name in kwargs:
+                kwargs[name] = int(kwargs[name])
+        return kwargs
+
     @staticmethod
     def _build_query(**kwargs):
         query = "MATCH (e:Experience)-[:CONCERNS]-(a"
@@ -658,16 +2111,12 @@ class FindExperience(DBService):
             # an array of conditions
             conditions = []
             if "min_begin_time" in kwargs.keys():
-                kwargs["min_begin_time"] = int(kwargs["min_begin_time"])
                 conditions.append("e.beginTime>= $min_begin_time")
             if "max_begin_time" in kwargs.keys():
-                kwargs["max_begin_time"] = int(kwargs["max_begin_time"])
                 conditions.append("e.beginTime<= $max_begin_time")
             if "min_passage_time" in kwargs.keys():
-                kwargs["min_passage_time"] = int(kwargs["min_passage_time"])
                 conditions.append("e.passageTime>= $min_passage_time")
             if "max_passage_time" in kwargs.keys():
-                kwargs["max_passage_time"] = int(kwargs["max_passage_time"])
                 conditions.append("e.passageTime<= $max_passage_time")
             # joining the conditions with an AND
             query += " AND ".join(conditions)+" "
@@ -684,17 +2133,160 @@ class GetMapGraph(DBService):
     """
     This Service is used to retrieve the map in a graph form
     """
+
+    # The map doesn't change while the simulation runs
+    CACHEABLE = True
+    CACHE_TTL = 300.0
+
     @staticmethod
     def _build_query(**kwargs):
         query = "match (a)-[:LINK]-(b) return a, b"
         return query
 
 
+class GetPath(DBService):
+    """
+    This Service is used to find the way to a section or an intersection, through the LINK
+    graph. It requires the destination parameter (the name of the node to reach), and accepts
+    a source (the name of the starting node). It returns the positions [x, y] to go through
+    (see MapGraph.waypoints), computed in memory: the database is only read once, to load the
+    map.
+    """
+    REQUIRED_PARAMS = {"destination"}
+
+    def execute(self, *args, **kwargs):
+        if not self.REQUIRED_PARAMS.issubset(kwargs.keys()):
+            raise TypeError()
+        graph = MapGraph.get_instance()
+        if not graph.ensure_loaded(self.connection, kwargs.get("session")):
+            return []
+        return graph.waypoints(kwargs.get("source"), kwargs["destination"])
+
+
 class FindAbstractionsService(DBService):
 
+    def _prepare_params(self, kwargs, session=None):
+        index = SpatialIndex.get_instance()
+        if index.ensure_loaded(self.connection, session):
+            kwargs["containers"] = index.containing(kwargs["x"], kwargs["y"], "r")
+        return kwargs
+
     @staticmethod
     def _build_query(**kwargs):
         query = "MATCH p = (i)-[:CONTAINS*]-(z) "
-        query += " WHERE sqrt((i.x - $x) ^ 2 + (i.y - $y) ^ 2) <= i.r"
+        if "containers" in kwargs:
+            query += " WHERE id(i) IN $containers"
+        else:
+            query += " WHERE sqrt((i.x - $x) ^ 2 + (i.y - $y) ^ 2) <= i.r"
         query += " RETURN nodes(p)"
         return query
+
+
+class PlaceService(DBService):
+    """
+    Base class of the services writing places (sections, intersections and zones, the nodes with
+    a position and a radius). Their queries return the written places, which are applied to the
+    SpatialIndex (see _update_index), so the index stays in sync without being loaded again.
+    The map graph holds positions too: it is loaded again when needed.
+    """
+    DEPENDENCIES = [GetMapGraph, FindAbstractionsService]
+
+    LABELS = ("Intersection", "Section", "Zone")
+
+    def execute(self, *args, **kwargs):
+        result = super(PlaceService, self).execute(*args, **kwargs)
+        self._sync(result)
+        return result
+
+    def execute_batch(self, batch, session=None):
+        result = super(PlaceService, self).execute_batch(batch, session)
+        self._sync(result)
+        return result
+
+    def _sync(self, records):
+        """
+        Apply the written places to the in-memory copies of the map.
+
+        :param records: the records returned by the write
+        """
+        if not records:
+            return
+        MapGraph.get_instance().invalidate()
+        index = SpatialIndex.get_instance()
+        # An index that is not loaded will read the places from the graph
+        if index.loaded:
+            self._update_index(index, records)
+
+    @staticmethod
+    def _update_index(index, records):
+        """
+        Apply the written places to the index.
+
+        :param index: the SpatialIndex
+        :param records: the records returned by the write
+        """
+        raise NotImplementedError()
+
+
+class SetPlace(PlaceService):
+    """
+    This Service is used to create or move a place
+    It requires four parameters:
+    name : the name of the place
+    label : Intersection, Section or Zone
+    x : the x coordinate of the center of the place
+    y : the y coordinate of the center of the place
+    It also accepts the radius and r parameters (the radius of the place)
+    """
+    REQUIRED_PARAMS = {"name", "label", "x", "y"}
+
+    # The label is part of the query, not a parameter
+    CACHE_QUERY = False
+
+    def _prepare_params(self, kwargs, session=None):
+        if kwargs["label"] not in self.LABELS:
+            raise ValueError("SetPlace : unknown label {}".format(kwargs["label"]))
+        return kwargs
+
+    @staticmethod
+    def _build_query(**kwargs):
+        query = "MERGE (i:{} {{name: $name}}) ".format(kwargs["label"])
+        query += "SET i.x = $x, i.y = $y"
+        for name in SpatialIndex.RADIUS_PROPERTIES:
+            if name in kwargs:
+                query += ", i.{0} = ${0}".format(name)
+        query += " RETURN id(i) AS id, i.x AS x, i.y AS y, i.radius AS radius, i.r AS r,"
+        query += " labels(i) AS labels"
+        return query
+
+    @staticmethod
+    def _update_index(index, records):
+        for record in records:
+            index.upsert(
+                record["id"],
+                record["x"],
+                record["y"],
+                {name: record[name] for name in SpatialIndex.RADIUS_PROPERTIES},
+                record["labels"]
+            )
+
+
+class RemovePlace(PlaceService):
+    """
+    This Service is used to remove a place (and its relationships)
+    It requires one parameter:
+    name : the name of the place
+    """
+    REQUIRED_PARAMS = {"name"}
+
+    @staticmethod
+    def _build_query(**kwargs):
+        query = "MATCH (i {name: $name}) WHERE "
+        query += " OR ".join("i:{}".format(label) for label in PlaceService.LABELS)
+        query += " WITH i, id(i) AS id DETACH DELETE i RETURN id"
+        return query
+
+    @staticmethod
+    def _update_index(index, records):
+        for record in records:
+            index.remove(record["id"])
@@ -0,0 +1,241 @@
+# -*- coding: utf-8 -*-
+"""
+An in-process spatial index over the places of the map (intersections, sections, zones...),
+which are circles in the graph: a center (`x`, `y`) and a radius (stored in the `radius` or in
+the `r` property). Services use it to find the places containing a point, instead of computing
+the distance to every node in their query.
+"""
+import collections
+import math
+import threading
+import time
+
+
+class SpatialIndex(object):
+    """
+    A uniform grid over the circles of the map. Each circle is registered in every cell its
+    bounding box overlaps, so finding the circles containing a point only checks the circles of
+    one cell: the lookup time doesn't depend on the size of the map.
+
+    The index is loaded from the graph the first time it is needed (see :meth:`ensure_loaded`)
+    and is then kept in sync by the code writing places, through :meth:`upsert`, :meth:`remove`
+    or :meth:`invalidate` (see :class:`commons.services.common.PlaceService`). As a fallback, in
+    case places were written by another process, it is also loaded again once it is older than
+    `ttl` seconds. Use :meth:`get_instance` to get
+    the index shared by every service of the process::
+
+        index = SpatialIndex.get_instance()
+        index.ensure_loaded(session_pool)
+
+        # Ids of the intersections and sections whose "radius" contains the point
+        ids = index.containing(x, y, "radius", labels=("Intersection", "Section"))
+
+    """
+
+    # Properties holding the radius of a place
+    RADIUS_PROPERTIES = ("radius", "r")
+
+    LOAD_QUERY = (
+        "MATCH (i) WHERE exists(i.x) AND exists(i.y) AND (exists(i.radius) OR exists(i.r))"
+        " RETURN id(i) AS id, i.x AS x, i.y AS y, i.radius AS radius, i.r AS r,"
+        " labels(i) AS labels"
+    )
+
+    DEFAULT_TTL = 60.0
+
+    _instance = None
+
+    @classmethod
+    def get_instance(cls):
+        """
+        Get the SpatialIndex shared by the services of the process.
+
+        :return: a SpatialIndex instance
+        """
+        if cls._instance is None:
+            cls._instance = SpatialIndex()
+        return cls._instance
+
+    def __init__(self, cell_size=None, ttl=DEFAULT_TTL, logger=None):
+        """
+        Create a new (empty) SpatialIndex.
+
+        :param cell_size: the size of the cells of the grid. By default, it is computed when the
+                          index is loaded (the average diameter of the places).
+        :param ttl: how long (in seconds) the loaded index is used before being loaded again,
+                    None means forever
+        """
+        self.cell_size = cell_size
+        self.ttl = ttl
+        self._logger = logger
+        self._lock = threading.RLock()
+        self._places = {}  # id -> (x, y, radii, labels)
+        self._cells = collections.defaultdict(set)
+        self._loaded = False
+        self._loaded_at = 0.0
+
+    @property
+    def loaded(self):
+        if self._loaded and self.ttl is not None and time.time() - self._loaded_at > self.ttl:
+            self._loaded = False
+        return self._loaded
+
+    def __len__(self):
+        return len(self._places)
+
+    def ensure_loaded(self, connection, session=None):
+        """
+        Load the index from the graph, if it is not loaded yet (or too old). An empty graph
+        doesn't count as loaded: the map may not be imported yet.
+
+        :param connection: a :class:`commons.database.SessionPool` or a Neo4j driver
+        :param session: a session to use instead of borrowing one from the connection (give
+                        the session you hold, if any: a bounded pool may have no other one)
+        :return: True if the index is loaded
+        """
+        if self.loaded:
+            return True
+
+        with self._lock:
+            if self.loaded:
+                return True
+            try:
+                if session is not None:
+                    records = list(session.run(SpatialIndex.LOAD_QUERY))
+                else:
+                    with connection.session() as session:
+                        records = list(session.run(SpatialIndex.LOAD_QUERY))
+            except Exception as e:
+                if self._logger is not None:
+                    self._logger.warn("SpatialIndex : can't load the places ({})".format(e))
+                return False
+            if not records:
+                return False
+
+            self.load([
+                (record["id"], record["x"], record["y"],
+                 {name: record[name] for name in SpatialIndex.RADIUS_PROPERTIES},
+                 record["labels"])
+                for record in records
+            ])
+            return True
+
+    def load(self, places):
+        """
+        Replace the content of the index.
+
+        :param places: an iterable of tuples (id, x, y, radii, labels), see :meth:`upsert`
+        """
+        places = list(places)
+        with self._lock:
+            self._places = {}
+            self._cells = collections.defaultdict(set)
+            if self.cell_size is None:
+                diameters = [2 * max(self._radii(radii).values() or [0])
+                             for _, _, _, radii, _ in places]
+                diameters = [diameter for diameter in diameters if diameter > 0]
+                self.cell_size = sum(diameters) / len(diameters) if diameters else 1.0
+            for place in places:
+                self.upsert(*place)
+            self._loaded = True
+            self._loaded_at = time.time()
+
+    def invalidate(self):
+        """
+        Forget the content of the index, it will be loaded again when needed.
+        """
+        with self._lock:
+            self._loaded = False
+
+    def refresh(self, connection, session=None):
+        """
+        Load the index from the graph again, now.
+
+        :param connection: a :class:`commons.database.SessionPool` or a Neo4j driver
+        :param session: a session to use instead of borrowing one from the connection
+        :return: True if the index is loaded
+        """
+        with self._lock:
+            self._loaded = False
+            return self.ensure_loaded(connection, session)
+
+    def upsert(self, node_id, x, y, radii, labels=()):
+        """
+        Add or move a place.
+
+        :param node_id: the id of the node
+        :param x: the x coordinate of the center
+        :param y: the y coordinate of the center
+        :param radii: a dictionary, the radius of the place for each radius property (missing
+                      or None values are ignored)
+        :param labels: the labels of the node
+        """
+        radii = self._radii(radii)
+        with self._lock:
+            self.remove(node_id)
+            if not radii:
+                return
+            self._places[node_id] = (x, y, radii, frozenset(labels))
+            for cell in self._cells_of(x, y, max(radii.values())):
+                self._cells[cell].add(node_id)
+
+    def remove(self, node_id):
+        """
+        Remove a place, if it is indexed.
+
+        :param node_id: the id of the node
+        """
+        with self._lock:
+            place = self._places.pop(node_id, None)
+            if place is None:
+                return
+            x, y, radii, _ = place
+            for cell in self._cells_of(x, y, max(radii.values())):
+                self._cells[cell].discard(node_id)
+                if not self._cells[cell]:
+                    del self._cells[cell]
+
+    def containing(self, x, y, radius_property="radius", labels=None):
+        """
+        Find the places containing the provided point.
+
+        :param x: the x coordinate of the point
+        :param y: the y coordinate of the point
+        :param radius_property: the property holding the radius to use
+        :param labels: if provided, only places having one of these labels are returned
+        :return: a list of node ids
+        """
+        labels = frozenset(labels) if labels is not None else None
+        result = []
+        with self._lock:
+            for node_id in self._cells.get(self._cell(x, y), ()):
+                place_x, place_y, radii, place_labels = self._places[node_id]
+                radius = radii.get(radius_property)
+                if radius is None or (labels is not None and labels.isdisjoint(place_labels)):
+                    continue
+                if (place_x - x) ** 2 + (place_y - y) ** 2 <= radius ** 2:
+                    result.append(node_id)
+        return result
+
+    def _cell(self, x, y):
+        return int(math.floor(x / self.cell_size)), int(math.floor(y / self.cell_size))
+
+    def _cells_of(self, x, y, radius):
+        """
+        Get the cells overlapped by the bounding box of a circle.
+        """
+        if self.cell_size is None:
+            self.cell_size = 2.0 * radius if radius > 0 else 1.0
+        min_x, min_y = self._cell(x - radius, y - radius)
+        max_x, max_y = self._cell(x + radius, y + radius)
+        return [(i, j) for i in range(min_x, max_x + 1) for j in range(min_y, max_y + 1)]
+
+    @staticmethod
+    def _radii(radii):
+        """
+        Keep the known radius properties having a value.
+        """
+        return {
+            name: value for name, value in radii.items()
+            if name in SpatialIndex.RADIUS_PROPERTIES and value is not None
+        }
@@ -2,14 +2,17 @@
 """
 This module holds some classes for making your life easier.
 """
+import collections
+import itertools
 import logging
 import json
 import os
-import threading
+import time
 
 from logging.handlers import RotatingFileHandler
-from neo4j.v1 import Record, Node
+from neo4j.v1 import Record, Node, Relationship, Path
 from datetime import datetime
+from future.utils import string_types
 
 
 class LoggerConfigurator(object):
@@ -79,37 +82,135 @@ class CustomJSONEncoder(json.JSONEncoder):
 
         json.dumps(data, cls=CustomJSONEncoder)
 
+    Each neo4j object met by the encoder is converted with its content in one pass (see
+    :class:`ResultSerializer`). Converting a whole result with :meth:`ResultSerializer.to_plain`
+    before encoding it is faster for big results.
     """
     def record_node_to_dict(self, o):
-        result = dict()
-        if isinstance(o, Record):
-            for key, value in o.items():
-                result[key] = self.record_node_to_dict(value)
-        if isinstance(o, Node):
-            for key, item in o.properties.items():
-                result[key] = item
-        return result
+        return record_node_to_dict(o)
 
     def default(self, o):
         """
-        Is able to parse o if o is either a Record or a Node. Otherwise, call the super default
-        method which raises TypeError.
+        Is able to parse o if o is a Record, a Node, a Relationship or a Path. Otherwise, call
+        the super default method which raises TypeError.
 
         :param o: an object
         :return: a json encoded object
         :raise: TypeError
         """
-        d = self.record_node_to_dict(o)
-        return d
-        '''
-        if isinstance(o, (Record, Node)):
+        if isinstance(o, ResultSerializer.GRAPH_TYPES):
+            return ResultSerializer.to_plain(o)
+        return super(CustomJSONEncoder, self).default(o)
+
+
+_SCALAR_TYPES = frozenset((str, type(u""), int, float, bool, type(None)))
+
+
+def _to_plain(value):
+    """
+    The conversion done by :meth:`ResultSerializer.to_plain`. The most frequent types are
+    checked first, by their exact type.
+    """
+    value_type = type(value)
+    if value_type in _SCALAR_TYPES:
+        return value
+    if value_type is Node:
+        return dict(value.properties)
+    if value_type is Record:
+        return dict(zip(value.keys(), map(_to_plain, value.values())))
+    if value_type is list or value_type is tuple:
+        return list(map(_to_plain, value))
+    if value_type is dict:
+        return {key: _to_plain(item) for key, item in value.items()}
+
+    # Subclasses and less frequent types
+    if isinstance(value, Node):
+        return dict(value.properties)
+    if isinstance(value, Record):
+        return dict(zip(value.keys(), map(_to_plain, value.values())))
+    if isinstance(value, Relationship):
         return {
-            str(key): self.encode(value) if not isinstance(value, str) else value
-            for key, value in o.items()
+            "id": value.id,
+            "type": value.type,
+            "start": value.start,
+            "end": value.end,
+            "properties": dict(value.properties)
         }
-        return super(CustomJSONEncoder, self).default(o)
-        '''
+    if isinstance(value, Path):
+        return {
+            "nodes": [_identified_node(node) for node in value.nodes],
+            "relationships": list(map(_to_plain, value.relationships))
+        }
+    return value
+
 
+def _identified_node(node):
+    """
+    Convert a Node, keeping its id and labels (the start and end of relationships are node ids).
+    """
+    return {
+        "id": node.id,
+        "labels": sorted(node.labels),
+        "properties": dict(node.properties)
+    }
+
+
+class ResultSerializer(object):
+    """
+    Convert the results of a DBService (lists of Records holding Nodes, Relationships and
+    Paths) into plain lists and dictionaries, in a single pass, so that codecs encode them
+    without calling back Python code for each object::
+
+        data = ResultSerializer.to_plain(records)
+
+        # Or, for big results, the keys once and then a list of values for each record
+        data = ResultSerializer.to_columns(records)
+        records = ResultSerializer.from_columns(data)
+
+    Records become dictionaries and Nodes the dictionary of their properties. Relationships
+    become `{"id": ..., "type": ..., "start": ..., "end": ..., "properties": {...}}` (start and
+    end are node ids) and Paths `{"nodes": [...], "relationships": [...]}`, where each node is
+    `{"id": ..., "labels": [...], "properties": {...}}`, so that the relationships of a path can
+    be joined with its nodes.
+    """
+
+    GRAPH_TYPES = (Record, Node, Relationship, Path)
+
+    @staticmethod
+    def to_plain(value):
+        """
+        Convert a value and its content.
+
+        :param value: a result, a Record, a graph object or any JSON-like value
+        :return: the plain value (other objects are left untouched)
+        """
+        return _to_plain(value)
+
+    @staticmethod
+    def to_columns(records):
+        """
+        Convert records into a columnar layout: the keys are given once.
+
+        :param records: a list of Records (having the same keys)
+        :return: a dictionary {"columns": [keys], "rows": [[values of a record], ...]}
+        """
+        records = list(records)
+        columns = list(records[0].keys()) if records else []
+        return {
+            "columns": columns,
+            "rows": [list(map(_to_plain, record.values())) for record in records]
+        }
+
+    @staticmethod
+    def from_columns(data):
+        """
+        Rebuild the records given by :meth:`to_columns`, as dictionaries.
+
+        :param data: the columnar layout
+        :return: a list of dictionaries
+        """
+        columns = data["columns"]
+        return [dict(zip(columns, row)) for row in data["rows"]]
 
 
 class MessageIDGenerator(object):
@@ -117,12 +218,26 @@ class MessageIDGenerator(object):
     This utility class is designed to give you a unique id for your process. To produce such ids, it
     will get your process' pid and add it a number. Produced ids are like **1234_4**.
 
+    Ids also exist in a compact form, a 63 bits integer (useful for binary codecs), packing the
+    pid, an epoch (the time at which the process started producing ids, to tell apart processes
+    having the same pid) and the number. Both forms of an id give the same key with
+    :meth:`get_key`.
+
     **Notice**: this class is threadsafe, which means you will never get the same id, even if two
     threads are requiring a number at the same time.
     """
 
-    # Keep track of the current id
-    _current_id = 0
+    PID_BITS = 22
+    EPOCH_BITS = 9
+    COUNTER_BITS = 32
+
+    # The counter is shared by both forms, next() on it is atomic
+    _counter = itertools.count()
+
+    # Computed for the current process (again after a fork)
+    _pid = None
+    _prefix = None
+    _int_prefix = None
 
     @classmethod
     def get_new_message_id(cls):
@@ -131,10 +246,54 @@ class MessageIDGenerator(object):
 
         :return: a string like **1234_4**
         """
-        with threading.Lock():
-            result = cls._current_id
-            cls._current_id += 1
-        return str(os.getpid()) + "_" + str(result)
+        n = next(cls._counter)
+        if cls._pid != os.getpid():
+            cls._init_process()
+        return cls._prefix + str(n)
+
+    @classmethod
+    def get_new_int_message_id(cls):
+        """
+        This method returns a new unique id, in its compact form.
+
+        :return: an integer (pid, epoch and number packed on 63 bits)
+        """
+        n = next(cls._counter)
+        if cls._pid != os.getpid():
+            cls._init_process()
+        return cls._int_prefix | (n & ((1 << cls.COUNTER_BITS) - 1))
+
+    @classmethod
+    def get_key(cls, message_id):
+        """
+        Get the key of an id, which is the same for both forms of the ids produced by this
+        process. The compact form of the id is used as key, other ids are returned unchanged.
+
+        :param message_id: an id, in any form
+        :return: the key
+        """
+        if cls._pid != os.getpid():
+            cls._init_process()
+        # JSON decoding gives unicode strings on Python 2
+        if isinstance(message_id, string_types) and message_id.startswith(cls._prefix):
+            n = message_id[len(cls._prefix):]
+            if n.isdigit():
+                return cls._int_prefix | (int(n) & ((1 << cls.COUNTER_BITS) - 1))
+        return message_id
+
+    @classmethod
+    def _init_process(cls):
+        """
+        Compute the prefixes of the ids for the current process.
+        """
+        pid = os.getpid()
+        epoch = int(time.time()) & ((1 << cls.EPOCH_BITS) - 1)
+        cls._prefix = str(pid) + "_"
+        cls._int_prefix = (
+            (pid & ((1 << cls.PID_BITS) - 1)) << (cls.EPOCH_BITS + cls.COUNTER_BITS)
+            | epoch << cls.COUNTER_BITS
+        )
+        cls._pid = pid
 
     def __init__(self):
         """
@@ -248,7 +407,9 @@ class ConfigurationLoader(object):
 
 class HandlerStore(object):
     """
-    A HandlerStore is where you can store callbacks for a provided message id.
+    A HandlerStore is where you can store callbacks for a provided message id. Handlers are
+    stored according to the key of the id (see :meth:`MessageIDGenerator.get_key`), so a handler
+    registered with the string form of an id is found with its compact form, and the reverse.
     """
     def __init__(self):
         self._store = {}
@@ -261,9 +422,10 @@ class HandlerStore(object):
         :param message_id: the message id
         :param handler: a callback function
         """
-        if not self._store.get(message_id, False):
-            self._store[message_id] = []
-        self._store[message_id].append(handler)
+        key = MessageIDGenerator.get_key(message_id)
+        if not self._store.get(key, False):
+            self._store[key] = []
+        self._store[key].append(handler)
 
     def set_handlers_for(self, message_id, handlers):
         """
@@ -272,7 +434,7 @@ class HandlerStore(object):
         :param message_id: the message id
         :param handlers: the new handlers
         """
-        self._store[message_id] = handlers[:]
+        self._store[MessageIDGenerator.get_key(message_id)] = handlers[:]
 
     def get_handlers_for(self, message_id):
         """
@@ -281,7 +443,7 @@ class HandlerStore(object):
         :param message_id: the message id
         :return: an empty list if no handlers provided, the list of handlers else
         """
-        return self._store.get(message_id, [])[:]
+        return self._store.get(MessageIDGenerator.get_key(message_id), [])[:]
 
     def remove_handlers_for(self, message_id):
         """
@@ -289,8 +451,99 @@ class HandlerStore(object):
 
         :param message_id: the message id
         """
-        if self._store.get(message_id, False):
-            del self._store[message_id]
+        key = MessageIDGenerator.get_key(message_id)
+        if self._store.get(key, False):
+            del self._store[key]
+
+
+def record_node_to_dict(o):
+    """
+    Convert a Record or a graph object into a dictionary (see :class:`ResultSerializer`).
+    Records are converted recursively, only the properties of Nodes are kept.
+
+    :param o: a Record, a Node, a Relationship or a Path
+    :return: a dictionary (empty for other objects)
+    """
+    if isinstance(o, ResultSerializer.GRAPH_TYPES):
+        return ResultSerializer.to_plain(o)
+    return dict()
+
+
+class DeltaView(object):
+    """
+    Rebuild the result of a subscription from the snapshots and deltas sent by a
+    SubscriptionStore in delta mode (see :meth:`SubscriptionStore.set_delta_mode`)::
+
+        view = DeltaView()
+
+        def on_notification(message):
+            if view.apply_delta(message.data):
+                print(view.rows)
+
+    Rows are the dictionary form of the records. Deltas don't keep the order of the rows: added
+    and changed rows are put at the end.
+    """
+
+    SNAPSHOT = "snapshot"
+    DELTA = "delta"
+
+    def __init__(self):
+        self.rows = None
+        self.sequence = None
+
+    @property
+    def synchronized(self):
+        return self.sequence is not None
+
+    def apply_delta(self, data):
+        """
+        Apply a snapshot or a delta. A delta which doesn't follow the last applied notification
+        is ignored, and the view waits for the next snapshot.
+
+        :param data: the data of the notification
+        :return: True if the rows were updated
+        """
+        if data.get("mode") == DeltaView.SNAPSHOT:
+            self.rows = list(data["rows"])
+            self.sequence = data["sequence"]
+            return True
+
+        if data.get("mode") != DeltaView.DELTA or data["base"] != self.sequence:
+            self.sequence = None  # A notification was missed
+            return False
+
+        key = data.get("key")
+        if key is not None:
+            identify = lambda row: DeltaView.get_row_key(row, key)
+        else:
+            identify = lambda row: json.dumps(row, sort_keys=True)
+
+        # Changed rows replace the rows having the same key
+        replaced = collections.Counter(identify(row) for row in data["removed"] + data["changed"])
+        rows = []
+        for row in self.rows:
+            identity = identify(row)
+            if replaced[identity] > 0:
+                replaced[identity] -= 1
+            else:
+                rows.append(row)
+        rows.extend(data["changed"])
+        rows.extend(data["added"])
+
+        self.rows = rows
+        self.sequence = data["sequence"]
+        return True
+
+    @staticmethod
+    def get_row_key(row, key):
+        """
+        Get the identity of a row (in its dictionary form).
+
+        :param row: a dictionary
+        :param key: the names of the identifying columns
+        :return: a string
+        """
+        return json.dumps([row.get(name) for name in key], sort_keys=True)
 
 
 def get_final_classes(base_class):
@@ -313,6 +566,21 @@ def get_final_classes(base_class):
     return result
 
 
+def get_all_classes(base_class):
+    """
+    This function retrieves every class that derives from a given class, including itself
+
+    :param base_class:
+    The root class
+    :return:
+    A set of classes
+    """
+    result = {base_class}
+    for sub_class in base_class.__subclasses__():
+        result.update(get_all_classes(sub_class))
+    return result
+
+
 def create_datetime_from_time(t):
     """
     This method creates a datetime from a given time object